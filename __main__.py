@@ -1,18 +1,70 @@
-import os
+import argparse
+from importlib.util import find_spec
 
 import uvicorn
-from dotenv import load_dotenv
 
+import config
 import db
 
-load_dotenv()
+
+def parse_args() -> argparse.Namespace:
+    settings = config.get_settings()
+    parser = argparse.ArgumentParser(description="Run the HeavyMetal backend")
+    parser.add_argument(
+        "--prod",
+        action="store_true",
+        default=settings.production,
+        help="Run multiple workers without reload (also ENVIRONMENT=production)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.workers,
+        help="Number of worker processes in production mode",
+    )
+    parser.add_argument("--host", default=settings.host)
+    parser.add_argument("--port", type=int, default=settings.port)
+    return parser.parse_args()
+
+
+def production_options(workers: int) -> dict:
+    """
+    uvicorn settings for production: uvloop and httptools when they are
+    installed, tuned keep-alive and accept backlog, and a graceful shutdown
+    window that lets in-flight streams drain after SIGTERM.
+    """
+    settings = config.get_settings()
+    return {
+        "workers": workers,
+        "loop": "uvloop" if find_spec("uvloop") else "asyncio",
+        "http": "httptools" if find_spec("httptools") else "h11",
+        "timeout_keep_alive": settings.keep_alive_timeout,
+        "backlog": settings.backlog,
+        "timeout_graceful_shutdown": settings.graceful_timeout,
+        "access_log": settings.access_log,
+        "proxy_headers": True,
+    }
+
 
 if __name__ == "__main__":
+    # Before anything reads the environment, workers inherit it from here
+    config.load_env()
+    args = parse_args()
     db.init_db()
-    uvicorn.run(
-        "main:app",
-        host=os.getenv("HOST", "127.0.0.1"),
-        port=int(os.getenv("PORT", 8080)),
-        # reload
-        reload=True,
-    )
+    if args.prod:
+        # Each worker is a fresh process that builds its own engine and runs
+        # the warmup in main.lifespan before it starts accepting requests.
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            **production_options(args.workers),
+        )
+    else:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            # reload
+            reload=True,
+        )
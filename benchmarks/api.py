@@ -0,0 +1,530 @@
+"""
+End-to-end API benchmark.
+
+Builds a synthetic library and database, then drives the app in-process
+(straight through the ASGI interface) and over a real uvicorn socket:
+
+    uv run python -m benchmarks.api --tracks 5000
+    uv run python -m benchmarks.api --save-baseline
+    uv run python -m benchmarks.api --baseline benchmarks/baseline.json
+    uv run python -m benchmarks.api --ci --baseline path/to/baseline.json
+
+Results are written as JSON. When a baseline is given, every metric that is
+worse than the baseline by more than --tolerance fails the run with exit
+code 1. Baselines are machine-specific and not committed; with --ci a
+missing baseline fails the run with exit code 2 instead of passing.
+Metrics ending in _ms or _kb_per_listener are lower-is-better, the others
+(_mb_s, _rps) higher-is-better.
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from benchmarks import synthetic
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+USERNAME, PASSWORD = "benchmark", "benchmark-password"
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(prefix: str, samples: List[float]) -> Dict[str, float]:
+    return {
+        f"{prefix}.p50_ms": round(statistics.median(samples) * 1000, 3),
+        f"{prefix}.p99_ms": round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def expect(condition: bool, message: object) -> None:
+    if not condition:
+        raise RuntimeError(f"Unexpected response: {message}")
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+# Setup
+
+
+def prepare(workdir: Path, tracks: int, stream_mb: int) -> Dict[str, str]:
+    """
+    Generates the library and database, returns the environment for the app
+    """
+    media = workdir / "media"
+    env = {
+        "SQLALCHEMY_DATABASE_URL": f"sqlite:///{workdir / 'bench.sqlite3'}",
+        "MEDIA_ROOTS": f"default={media}",
+        "LOGFILE": str(workdir / "library_builder.log"),
+    }
+    os.environ.update(env)
+
+    started = time.perf_counter()
+    synthetic.generate_library(media, tracks=tracks)
+    synthetic.write_stream_file(media / "stream.mp3", megabytes=stream_mb)
+    added = synthetic.build_database(media)
+    print(
+        f"Built synthetic library: {added} files in "
+        f"{time.perf_counter() - started:.1f}s"
+    )
+    return env
+
+
+def pick_ids() -> Dict[str, str]:
+    import db
+    from media import resolve_path
+
+    with db.SessionLocal() as session:
+        track = session.query(db.Track).filter(db.Track.name != "Stream Benchmark").first()
+        stream = session.query(db.Track).filter(db.Track.name == "Stream Benchmark").first()
+        if track is None or stream is None:
+            raise RuntimeError("The synthetic library was not imported")
+        audio = (
+            session.query(db.Audio)
+            .filter(db.Audio.uuid == stream.audio, db.Audio.path.is_not(None))
+            .first()
+        )
+        location = resolve_path(audio.root, audio.path) if audio and audio.path else None
+        if not (track.uuid and track.name and stream.uuid and location):
+            raise RuntimeError("The synthetic library was imported incompletely")
+        return {
+            "track": track.uuid,
+            "stream": stream.uuid,
+            "stream_size": str(os.path.getsize(location)),
+            "query": track.name.split()[0],
+        }
+
+
+# In-process
+
+
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    headers: Optional[Dict[str, str]] = None,
+    body: bytes = b"",
+) -> Tuple[int, bytes]:
+    path, _, query = path.partition("?")
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    if body:
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+    sent = False
+    status = 0
+    chunks: List[bytes] = []
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
+
+
+async def run_inprocess(ids: Dict[str, str], requests: int) -> Dict[str, float]:
+    import main
+
+    main.warmup()
+    app = main.app
+    json_headers = {"content-type": "application/json"}
+    credentials = json.dumps({"username": USERNAME, "password": PASSWORD}).encode()
+    await asgi_request(app, "POST", "/api/v1/auth/register", json_headers, credentials)
+    status, body = await asgi_request(
+        app, "POST", "/api/v1/auth/login", json_headers, credentials
+    )
+    expect(status == 200, body)
+    auth = {"authorization": f"Bearer {json.loads(body)['access_token']}"}
+
+    async def measure(count: int, call: Callable) -> List[float]:
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            status, body = await call()
+            samples.append(time.perf_counter() - started)
+            expect(status < 400, (status, body[:200]))
+        return samples
+
+    results: Dict[str, float] = {}
+    results.update(
+        summarize(
+            "inprocess.list",
+            await measure(
+                requests,
+                lambda: asgi_request(app, "GET", "/api/v1/songs/list?limit=50", auth),
+            ),
+        )
+    )
+    results.update(
+        summarize(
+            "inprocess.info",
+            await measure(
+                requests,
+                lambda: asgi_request(app, "GET", f"/api/v1/songs/info/{ids['track']}", auth),
+            ),
+        )
+    )
+    results.update(
+        summarize(
+            "inprocess.search",
+            await measure(
+                requests,
+                lambda: asgi_request(
+                    app, "GET", f"/api/v1/songs/search/{quote(ids['query'])}", auth
+                ),
+            ),
+        )
+    )
+    results.update(
+        summarize(
+            "inprocess.login",
+            await measure(
+                max(requests // 20, 5),
+                lambda: asgi_request(
+                    app, "POST", "/api/v1/auth/login", json_headers, credentials
+                ),
+            ),
+        )
+    )
+    return results
+
+
+# Over a socket
+
+
+class Server:
+    def __init__(self, env: Dict[str, str], port: int, workers: int):
+        self.port = port
+        command = [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--no-access-log",
+            "--log-level",
+            "warning",
+        ]
+        self.process = subprocess.Popen(  # noqa: S603
+            command, cwd=ROOT, env={**os.environ, **env}
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                self.request("GET", "/ping")
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("uvicorn did not start")
+
+    def connection(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: Optional[bytes] = None,
+        connection: Optional[http.client.HTTPConnection] = None,
+    ) -> Tuple[int, bytes]:
+        conn = connection or self.connection()
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        if connection is None:
+            conn.close()
+        return response.status, data
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def run_socket(
+    env: Dict[str, str],
+    ids: Dict[str, str],
+    requests: int,
+    port: int,
+    concurrency: int,
+    duration: float,
+    listeners: int,
+) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+    server = Server(env, port, workers=1)
+    try:
+        credentials = json.dumps({"username": USERNAME, "password": PASSWORD}).encode()
+        json_headers = {"Content-Type": "application/json"}
+        server.request("POST", "/api/v1/auth/register", json_headers, credentials)
+        status, body = server.request(
+            "POST", "/api/v1/auth/login", json_headers, credentials
+        )
+        expect(status == 200, body)
+        auth = {"Authorization": f"Bearer {json.loads(body)['access_token']}"}
+
+        conn = server.connection()
+        for name, path in (
+            ("list", "/api/v1/songs/list?limit=50"),
+            ("info", f"/api/v1/songs/info/{ids['track']}"),
+            ("search", f"/api/v1/songs/search/{quote(ids['query'])}"),
+        ):
+            samples = []
+            for _ in range(requests):
+                started = time.perf_counter()
+                status, _ = server.request("GET", path, auth, connection=conn)
+                samples.append(time.perf_counter() - started)
+                expect(status < 400, (name, status))
+            results.update(summarize(f"socket.{name}", samples))
+        conn.close()
+
+        results.update(
+            stream_throughput(
+                server,
+                ids["stream"],
+                int(ids["stream_size"]),
+                auth,
+                concurrency,
+                duration,
+            )
+        )
+        per_listener = memory_per_listener(server, ids["stream"], auth, listeners)
+        if per_listener is not None:
+            results["socket.stream.kb_per_listener"] = per_listener
+    finally:
+        server.stop()
+    return results
+
+
+def stream_throughput(
+    server: Server,
+    song_id: str,
+    file_size: int,
+    auth: Dict[str, str],
+    concurrency: int,
+    duration: float,
+    range_size: int = 1024 * 1024,
+) -> Dict[str, float]:
+    """
+    Concurrent clients fetching 1 MiB ranges over keep-alive connections
+    """
+    path = f"/api/v1/songs/stream/{song_id}"
+    status, _ = server.request("GET", path, {**auth, "Range": "bytes=0-0"})
+    expect(status == 206, status)
+    total_bytes = 0
+    total_requests = 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(index: int) -> None:
+        nonlocal total_bytes, total_requests
+        conn = server.connection()
+        offset = index * range_size
+        received = requests_done = 0
+        while time.monotonic() < deadline:
+            start = offset % max(file_size - range_size, 1)
+            headers = {**auth, "Range": f"bytes={start}-{start + range_size - 1}"}
+            status, body = server.request("GET", path, headers, connection=conn)
+            expect(status == 206, status)
+            received += len(body)
+            requests_done += 1
+            offset += range_size
+        conn.close()
+        with lock:
+            total_bytes += received
+            total_requests += requests_done
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "socket.stream.mb_s": round(total_bytes / elapsed / 1024 / 1024, 2),
+        "socket.stream.rps": round(total_requests / elapsed, 2),
+    }
+
+
+def memory_per_listener(
+    server: Server, song_id: str, auth: Dict[str, str], listeners: int
+) -> Optional[float]:
+    """
+    Opens `listeners` full-file streams that read slowly and reports the
+    server RSS growth per open stream, in KiB
+    """
+    before = rss_kb(server.process.pid)
+    if before is None:
+        return None
+    connections = []
+    try:
+        for _ in range(listeners):
+            conn = server.connection()
+            conn.request("GET", f"/api/v1/songs/stream/{song_id}", headers=auth)
+            response = conn.getresponse()
+            response.read(64 * 1024)
+            connections.append((conn, response))
+        time.sleep(1.0)
+        during = rss_kb(server.process.pid)
+    finally:
+        for conn, _ in connections:
+            conn.close()
+    if during is None:
+        return None
+    return round(max(during - before, 0) / max(listeners, 1), 1)
+
+
+# Baselines
+
+
+def lower_is_better(metric: str) -> bool:
+    return metric.endswith("_ms") or metric.endswith("_per_listener")
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], tolerance: float
+) -> List[str]:
+    regressions = []
+    for metric, value in sorted(results.items()):
+        reference = baseline.get(metric)
+        if not reference:
+            continue
+        change = (value - reference) / reference
+        worse = change > tolerance if lower_is_better(metric) else -change > tolerance
+        marker = "REGRESSION" if worse else "ok"
+        print(f"{marker:>10}  {metric:<40} {reference:>10} -> {value:<10} ({change:+.1%})")
+        if worse:
+            regressions.append(metric)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="HeavyMetal API benchmark")
+    parser.add_argument("--tracks", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--listeners", type=int, default=50)
+    parser.add_argument("--stream-mb", type=int, default=8)
+    parser.add_argument("--port", type=int, default=18181)
+    parser.add_argument("--skip-socket", action="store_true")
+    parser.add_argument("--output", type=Path, default=Path("bench_output.json"))
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--ci", action="store_true", help="fail when there is no baseline to compare with"
+    )
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or (DEFAULT_BASELINE if DEFAULT_BASELINE.exists() else None)
+    if args.ci and not args.save_baseline and not (baseline_path and baseline_path.exists()):
+        print(f"No baseline at {baseline_path or DEFAULT_BASELINE}, record one with --save-baseline")
+        return 2
+
+    sys.path.insert(0, str(ROOT))
+    with tempfile.TemporaryDirectory(prefix="heavymetal-bench-") as tmp:
+        env = prepare(Path(tmp), args.tracks, args.stream_mb)
+        ids = pick_ids()
+
+        results = asyncio.run(run_inprocess(ids, args.requests))
+        if not args.skip_socket:
+            results.update(
+                run_socket(
+                    env,
+                    ids,
+                    args.requests,
+                    args.port,
+                    args.concurrency,
+                    args.duration,
+                    args.listeners,
+                )
+            )
+
+    report = {
+        "meta": {
+            "tracks": args.tracks,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "metrics": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        DEFAULT_BASELINE.write_text(json.dumps(report, indent=2))
+        print(f"Saved baseline to {DEFAULT_BASELINE}")
+        return 0
+
+    if baseline_path is None:
+        print("No baseline to compare with, pass --baseline or --save-baseline")
+        return 0
+    baseline = json.loads(baseline_path.read_text())["metrics"]
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
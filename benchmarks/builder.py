@@ -0,0 +1,109 @@
+"""
+Library builder throughput benchmark.
+
+Generates a synthetic media tree, runs the builder against a fresh database
+and appends the per-stage report to a JSON Lines history file, so stage
+throughput can be compared across commits. The default history file,
+benchmarks/builder_history.jsonl, is machine-specific and ignored by git:
+
+    uv run python -m benchmarks.builder --tracks 20000
+    uv run python -m benchmarks.builder --tracks 20000 --profile sampling
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from benchmarks import synthetic
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_HISTORY = Path(__file__).resolve().parent / "builder_history.jsonl"
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(  # noqa: S603
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="HeavyMetal builder benchmark")
+    parser.add_argument("--tracks", type=int, default=5000)
+    parser.add_argument("--flac-ratio", type=float, default=0.3)
+    parser.add_argument("--profile", choices=["cprofile", "sampling"], default=None)
+    parser.add_argument("--history", type=Path, default=DEFAULT_HISTORY)
+    parser.add_argument(
+        "--media",
+        type=Path,
+        default=None,
+        help="Reuse an existing synthetic tree instead of generating one",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="heavymetal-builder-bench-") as tmp:
+        workdir = Path(tmp)
+        media = args.media or workdir / "media"
+        os.environ.update(
+            {
+                "SQLALCHEMY_DATABASE_URL": f"sqlite:///{workdir / 'bench.sqlite3'}",
+                "MEDIA_ROOTS": f"bench={media}",
+                "LOGFILE": str(workdir / "library_builder.log"),
+            }
+        )
+
+        if args.media is None:
+            started = time.perf_counter()
+            synthetic.generate_library(
+                media, tracks=args.tracks, flac_ratio=args.flac_ratio
+            )
+            print(
+                f"Generated {args.tracks} files in {time.perf_counter() - started:.1f}s"
+            )
+
+        sys.path.insert(0, str(ROOT))
+        cwd = os.getcwd()
+        os.chdir(workdir)  # keeps the log and profile output out of the tree
+        try:
+            import db_builder
+
+            report = db_builder.run(
+                profile=args.profile, profile_output=str(workdir / "builder.prof")
+            )
+        finally:
+            os.chdir(cwd)
+
+    record = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "tracks": args.tracks,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "files_per_second": report["files_per_second"],
+        "elapsed_seconds": report["elapsed_seconds"],
+        "stages": {
+            name: stage["items_per_second"] for name, stage in report["stages"].items()
+        },
+        "report": report,
+    }
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Appended run to {args.history}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
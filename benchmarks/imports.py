@@ -0,0 +1,144 @@
+"""
+Import time and import side effect checks.
+
+Imports each entry module in a fresh interpreter with `-X importtime`, keeps
+the fastest of a few runs and compares it with a budget. It also fails when
+a module pulls in a heavy dependency it should only load on first use, or
+when importing the app configures logging, creates an engine or changes the
+environment:
+
+    uv run python -m benchmarks.imports
+    uv run python -m benchmarks.imports --runs 9 --scale 2   # slow machines
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Milliseconds of cumulative import time, with room for a noisy machine
+BUDGETS: Dict[str, float] = {
+    "config": 25,
+    "db": 550,
+    "db_builder": 700,
+    "scan_jobs": 150,
+    "main": 1200,
+}
+
+# Loaded on first use: audio parsing, progress bars, NumPy, password hashing
+FORBIDDEN: Dict[str, List[str]] = {
+    "config": ["dotenv", "sqlalchemy"],
+    "db": ["numpy", "mutagen", "tqdm", "argon2", "dotenv"],
+    "db_builder": ["numpy", "mutagen", "tqdm", "argon2", "dotenv", "pydantic"],
+    "scan_jobs": ["numpy", "mutagen", "tqdm", "argon2", "dotenv"],
+    "main": ["numpy", "mutagen", "tqdm", "argon2"],
+}
+
+SIDE_EFFECTS = """
+import json, logging, os, sys
+before = dict(os.environ)
+import db, db_builder, main
+print(json.dumps({
+    "handlers": len(logging.getLogger().handlers),
+    "engines": db._engines is not None,
+    "environ": sorted(set(os.environ.items()) ^ set(before.items())),
+}))
+"""
+
+
+def _clean_env() -> Dict[str, str]:
+    # PYTHONSTARTUP and friends would be measured too
+    env = {k: v for k, v in os.environ.items() if not k.startswith("PYTHON")}
+    env["PYTHONPATH"] = str(ROOT)
+    return env
+
+
+def import_time(module: str) -> float:
+    """
+    Cumulative import time of `module` in milliseconds, from -X importtime
+    """
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=_clean_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in reversed(result.stderr.splitlines()):
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def loaded_modules(module: str) -> List[str]:
+    result = subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print('\\n'.join(sys.modules))",
+        ],
+        cwd=ROOT,
+        env=_clean_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def side_effects() -> Dict:
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", SIDE_EFFECTS],
+        cwd=ROOT,
+        env=_clean_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="HeavyMetal import checks")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply every budget by this"
+    )
+    args = parser.parse_args()
+
+    failures = []
+    for module, budget in BUDGETS.items():
+        elapsed = min(import_time(module) for _ in range(args.runs))
+        limit = budget * args.scale
+        status = "ok" if elapsed <= limit else "OVER"
+        print(f"{module:<12} {elapsed:8.1f} ms  budget {limit:8.1f} ms  {status}")
+        if elapsed > limit:
+            failures.append(f"{module} imports in {elapsed:.0f} ms")
+
+        loaded = loaded_modules(module)
+        for name in FORBIDDEN.get(module, []):
+            if name in loaded:
+                failures.append(f"{module} imports {name}")
+
+    effects = side_effects()
+    if effects["handlers"]:
+        failures.append("importing the app configures logging")
+    if effects["engines"]:
+        failures.append("importing the app creates database engines")
+    if effects["environ"]:
+        failures.append(f"importing the app changes the environment: {effects['environ']}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Synthetic media library for benchmarks.
+
+Generates tagged dummy MP3 (ID3v2) and FLAC (Vorbis comment) files that
+mutagen parses like real ones, and builds a database from them with
+db_builder. Nothing here imports the application at module level, callers
+set SQLALCHEMY_DATABASE_URL and MEDIA_ROOTS first.
+"""
+
+import random
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from mutagen.flac import FLAC
+from mutagen.id3 import ID3, TALB, TCON, TDRC, TIT2, TPE1, TRCK
+
+GENRES = [
+    "Heavy Metal",
+    "Thrash Metal",
+    "Doom Metal",
+    "Hard Rock",
+    "Progressive Rock",
+    "Punk",
+    "Blues",
+    "Jazz",
+    "Electronic",
+    "Classical",
+]
+WORDS = [
+    "iron",
+    "night",
+    "fire",
+    "storm",
+    "shadow",
+    "steel",
+    "thunder",
+    "dream",
+    "black",
+    "river",
+    "ghost",
+    "crown",
+]
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, joint stereo: 417 byte frames
+_MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+_MP3_FRAMES_PER_SECOND = 44100 / 1152
+
+
+def write_mp3(path: Path, tags: Dict[str, str], seconds: float = 2.0) -> None:
+    frames = max(int(seconds * _MP3_FRAMES_PER_SECOND), 4)
+    path.write_bytes(_MP3_FRAME * frames)
+    id3 = ID3()
+    id3.add(TIT2(encoding=3, text=tags["title"]))
+    id3.add(TPE1(encoding=3, text=tags["artist"]))
+    id3.add(TALB(encoding=3, text=tags["album"]))
+    id3.add(TCON(encoding=3, text=tags["genre"]))
+    id3.add(TRCK(encoding=3, text=tags["track_number"]))
+    id3.add(TDRC(encoding=3, text=tags["year"]))
+    id3.save(path)
+
+
+def write_flac(path: Path, tags: Dict[str, str], seconds: float = 2.0) -> None:
+    sample_rate, channels, bits = 44100, 2, 16
+    packed = (
+        (sample_rate << 44)
+        | ((channels - 1) << 41)
+        | ((bits - 1) << 36)
+        | int(sample_rate * seconds)
+    )
+    streaminfo = (
+        struct.pack(">HH", 4096, 4096)
+        + bytes(6)  # min/max frame size unknown
+        + packed.to_bytes(8, "big")
+        + bytes(16)  # MD5 of the (absent) audio
+    )
+    path.write_bytes(b"fLaC" + b"\x80" + len(streaminfo).to_bytes(3, "big") + streaminfo)
+    flac = FLAC(path)
+    flac["TITLE"] = tags["title"]
+    flac["ARTIST"] = tags["artist"]
+    flac["ALBUM"] = tags["album"]
+    flac["GENRE"] = tags["genre"]
+    flac["TRACKNUMBER"] = tags["track_number"]
+    flac["DATE"] = tags["year"]
+    flac.save()
+
+
+def generate_library(
+    root: Path,
+    tracks: int = 1000,
+    artists: Optional[int] = None,
+    tracks_per_album: int = 10,
+    flac_ratio: float = 0.3,
+    folders_per_level: int = 16,
+    seed: int = 42,
+) -> List[Path]:
+    """
+    Writes a synthetic library of tagged audio files
+
+    Args:
+        root (Path): Directory the library is created in
+        tracks (int): Number of files to create
+        artists (int, optional): Number of distinct artists, defaults to tracks / 50
+        tracks_per_album (int): Tracks per album
+        flac_ratio (float): Share of files written as FLAC instead of MP3
+        folders_per_level (int): Fan-out of the artist/album folder tree
+        seed (int): Seed for the pseudo-random tags
+
+    Returns:
+        List[Path]: The created files
+    """
+    rng = random.Random(seed)  # noqa: S311
+    artists = artists or max(tracks // 50, 1)
+    root.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(tracks):
+        album_index = i // tracks_per_album
+        artist_index = album_index % artists
+        tags = {
+            "title": f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {i}",
+            "artist": f"Artist {artist_index:05d}",
+            "album": f"Album {album_index:06d}",
+            "genre": GENRES[artist_index % len(GENRES)],
+            "track_number": str(i % tracks_per_album + 1),
+            "year": str(1970 + artist_index % 50),
+        }
+        folder = (
+            root
+            / f"{artist_index % folders_per_level:02d}"
+            / f"{album_index % folders_per_level:02d}"
+        )
+        folder.mkdir(parents=True, exist_ok=True)
+        if rng.random() < flac_ratio:
+            path = folder / f"{i:07d}.flac"
+            write_flac(path, tags)
+        else:
+            path = folder / f"{i:07d}.mp3"
+            write_mp3(path, tags)
+        paths.append(path)
+    return paths
+
+
+def write_stream_file(path: Path, megabytes: int = 8) -> Path:
+    """
+    Writes one large MP3 used by the streaming benchmarks
+    """
+    seconds = megabytes * 1024 * 1024 / (len(_MP3_FRAME) * _MP3_FRAMES_PER_SECOND)
+    write_mp3(
+        path,
+        {
+            "title": "Stream Benchmark",
+            "artist": "Benchmark",
+            "album": "Benchmark",
+            "genre": "Noise",
+            "track_number": "1",
+            "year": "2000",
+        },
+        seconds=seconds,
+    )
+    return path
+
+
+def build_database(root: Path, name: str = "default") -> int:
+    """
+    Builds the database from a generated library with the db_builder pipeline
+
+    Args:
+        root (Path): The generated library
+        name (str): Media root name the library is configured under
+
+    Returns:
+        int: Number of files added
+    """
+    import db
+    import db_builder
+
+    db.init_db()
+    session = db.SessionLocal()
+    try:
+        _, added = db_builder.build_library({name: root}, session)
+    finally:
+        session.close()
+    return added
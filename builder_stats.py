@@ -0,0 +1,201 @@
+"""
+Per-stage timers, counters and optional profilers for the library builder.
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class BuilderStats:
+    """
+    Accumulates wall time and item counts per builder stage.
+
+    Stages are free-form names such as "walk", "stat", "sniff", "parse.mp3",
+    "resolve" or "commit". Use `add` in hot loops and `stage` elsewhere.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}  # name -> [seconds, calls, items]
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, items: int = 1) -> None:
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = [seconds, 1, items]
+            else:
+                stage[0] += seconds
+                stage[1] += 1
+                stage[2] += items
+
+    @contextmanager
+    def stage(self, name: str, items: int = 1) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    def timed_iter(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """
+        Charges the time spent producing each item of `iterable` to `name`
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, 0)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def report(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        files = self.counters.get("files", 0)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "files_per_second": round(files / elapsed, 2) if elapsed > 0 else 0.0,
+            "counters": dict(self.counters),
+            "stages": {
+                name: {
+                    "seconds": round(seconds, 4),
+                    "calls": int(calls),
+                    "items": int(items),
+                    "items_per_second": round(items / seconds, 2) if seconds > 0 else None,
+                    "share": round(seconds / elapsed, 4) if elapsed > 0 else None,
+                }
+                for name, (seconds, calls, items) in sorted(
+                    self.stages.items(), key=lambda stage: -stage[1][0]
+                )
+            },
+        }
+
+    def summary_lines(self) -> List[str]:
+        report = self.report()
+        lines = []
+        for name, stage in report["stages"].items():
+            share = stage["share"] or 0
+            lines.append(
+                f"{name:<12} {stage['seconds']:>9.2f}s {share:>6.1%}"
+                f" {stage['items']:>9} items"
+            )
+        return lines
+
+    def write_report(self, path: str, extra: Optional[Dict[str, Any]] = None) -> None:
+        report = self.report()
+        if extra:
+            report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler: a background thread records the stack
+    of the profiled thread every `interval` seconds.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.leaf: Counter = Counter()
+        self.cumulative: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            seen = set()
+            leaf = True
+            while frame is not None:
+                code = frame.f_code
+                key = f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+                if leaf:
+                    self.leaf[key] += 1
+                    leaf = False
+                if key not in seen:
+                    self.cumulative[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, top: int = 25) -> Dict[str, Any]:
+        def share(counter: Counter) -> List[List[Any]]:
+            return [
+                [key, round(count / self.samples, 4)]
+                for key, count in counter.most_common(top)
+            ]
+
+        return {
+            "samples": self.samples,
+            "interval": self.interval,
+            "self": share(self.leaf) if self.samples else [],
+            "cumulative": share(self.cumulative) if self.samples else [],
+        }
+
+
+@contextmanager
+def profiled(
+    mode: Optional[str], output: Optional[str] = None
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Runs the block under cProfile ("cprofile") or the sampling profiler
+    ("sampling"), or not at all when mode is None. The yielded dict receives
+    a summary once the block is done.
+
+    Args:
+        mode (str, optional): "cprofile", "sampling" or None
+        output (str, optional): Where cProfile writes its .prof stats
+    """
+    result: Dict[str, Any] = {}
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            if output:
+                profiler.dump_stats(output)
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(25)
+            result["cprofile"] = stream.getvalue()
+    elif mode == "sampling":
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            yield result
+        finally:
+            sampler.stop()
+            result["sampling"] = sampler.report()
+    else:
+        yield result
@@ -0,0 +1,234 @@
+"""
+Library change log used for delta sync.
+
+Sessions that write to the library call `enable` so every insert, update and
+delete of a Track, Album, Artist or Audio row is appended to the changelog
+table in the same transaction. Bulk `query.update()`/`delete()` and Core
+statements bypass the unit of work, so code using them on these tables
+logs the rows it touched with `record`. Clients then ask for everything
+after the last seq they have seen, or get a full snapshot when the log no
+longer goes back that far.
+"""
+
+import json
+import os
+from typing import Dict, Generator, Iterable, List, Optional, Protocol, Type
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Mapped, Session
+
+import db
+
+# Number of log entries kept by `compact`
+CHANGELOG_RETENTION = int(os.getenv("CHANGELOG_RETENTION", "100000"))
+
+
+class Entity(Protocol):
+    """
+    A logged row, all ENTITIES have a uuid primary key
+    """
+
+    uuid: Mapped[Optional[str]]
+
+
+ENTITIES: Dict[str, Type[Entity]] = {
+    "artist": db.Artist,
+    "album": db.Album,
+    "audio": db.Audio,
+    "track": db.Track,
+}
+ENTITY_NAMES = {model: name for name, model in ENTITIES.items()}
+
+
+def _before_flush(session: Session, flush_context, instances) -> None:
+    changes = []
+    for op, objects in (
+        ("insert", session.new),
+        ("update", session.dirty),
+        ("delete", session.deleted),
+    ):
+        for obj in objects:
+            entity = ENTITY_NAMES.get(type(obj))
+            if entity is None:
+                continue
+            if op == "update" and not session.is_modified(obj):
+                continue
+            changes.append(db.ChangeLog(entity=entity, entity_uuid=obj.uuid, op=op))
+    session.add_all(changes)
+
+
+def enable(session: Session) -> None:
+    """
+    Records library changes made through this session in the change log
+    """
+    if not event.contains(session, "before_flush", _before_flush):
+        event.listen(session, "before_flush", _before_flush)
+
+
+def record(
+    session: Session, entity: str, uuids: Iterable[str], op: str = "update"
+) -> None:
+    """
+    Logs rows changed by a bulk statement, if the session logs changes
+
+    Args:
+        session (Session): The session that ran the statement
+        entity (str): One of ENTITIES
+        uuids (Iterable[str]): The rows it changed
+        op (str): "insert", "update" or "delete"
+    """
+    if not event.contains(session, "before_flush", _before_flush):
+        return
+    session.add_all(
+        [db.ChangeLog(entity=entity, entity_uuid=uuid, op=op) for uuid in uuids]
+    )
+
+
+def current_seq(session: Session) -> int:
+    """
+    Returns the seq of the newest change, which doubles as the library generation
+    """
+    return session.query(func.max(db.ChangeLog.seq)).scalar() or 0
+
+
+def compact(session: Session, keep: int = CHANGELOG_RETENTION) -> int:
+    """
+    Drops all but the newest `keep` entries, the newest one is always kept so
+    clients can tell how far the log has been compacted
+
+    Returns:
+        int: Number of entries removed
+    """
+    cutoff = current_seq(session) - max(keep, 1)
+    if cutoff <= 0:
+        return 0
+    removed = (
+        session.query(db.ChangeLog)
+        .filter(db.ChangeLog.seq <= cutoff)
+        .delete(synchronize_session=False)
+    )
+    session.commit()
+    return removed
+
+
+def _encode(entity: str, row) -> dict:
+    if entity == "track":
+        return {
+            "name": row.name,
+            "album": row.album,
+            "artist": row.artist,
+            "audio": row.audio,
+            "genre": row.genre,
+            "track_number": row.track_number,
+            "disc": row.disc,
+            "year": row.year,
+        }
+    if entity == "audio":
+        # Tracks whose audio has a canonical copy are hidden duplicates
+        return {"name": row.name, "canonical": row.canonical}
+    return {"name": row.name}
+
+
+def _dump(value: dict) -> str:
+    return json.dumps(value, separators=(",", ":")) + "\n"
+
+
+def _load_rows(session: Session, entity: str, uuids: Iterable[str]) -> dict:
+    model = ENTITIES[entity]
+    rows: List[Entity] = session.query(model).filter(model.uuid.in_(list(uuids))).all()
+    return {row.uuid: row for row in rows}
+
+
+def _delta_lines(
+    session: Session, entries: List[db.ChangeLog]
+) -> Generator[str, None, None]:
+    # Only the latest change of each row matters, and its current state is
+    # read in one query per entity type instead of one per change.
+    latest: Dict[tuple, db.ChangeLog] = {}
+    for entry in entries:
+        latest[(entry.entity, entry.entity_uuid)] = entry
+
+    by_entity: Dict[str, List[str]] = {}
+    for entity, uuid in latest:
+        by_entity.setdefault(entity, []).append(uuid)
+    rows = {
+        entity: _load_rows(session, entity, uuids)
+        for entity, uuids in by_entity.items()
+    }
+
+    for (entity, uuid), entry in sorted(latest.items(), key=lambda i: i[1].seq or 0):
+        row: Optional[Entity] = rows[entity].get(uuid)
+        if row is None or entry.op == "delete":
+            yield _dump({"seq": entry.seq, "op": "delete", "type": entity, "uuid": uuid})
+        else:
+            yield _dump(
+                {
+                    "seq": entry.seq,
+                    "op": "upsert",
+                    "type": entity,
+                    "uuid": uuid,
+                    "data": _encode(entity, row),
+                }
+            )
+
+
+def _snapshot_lines(session: Session) -> Generator[str, None, None]:
+    for entity, model in ENTITIES.items():
+        for row in session.query(model).yield_per(1000):
+            yield _dump(
+                {
+                    "op": "upsert",
+                    "type": entity,
+                    "uuid": row.uuid,
+                    "data": _encode(entity, row),
+                }
+            )
+
+
+def iter_changes(
+    since: int, limit: int, session: Optional[Session] = None
+) -> Generator[str, None, None]:
+    """
+    Streams the changes after `since` as NDJSON
+
+    The first line tells whether the client must drop its copy (`reset`), the
+    following lines are upserts/deletes, and the last line carries the resume
+    token `next` and whether more changes are waiting.
+
+    Args:
+        since (int): The last seq the client has applied, 0 for a snapshot
+        limit (int): Maximum number of log entries read
+        session (Session, optional): Session to read from, a new one is opened
+            (and closed) when omitted
+    """
+    owns_session = session is None
+    session = session or db.ReadSession()
+    try:
+        newest = current_seq(session)
+        oldest = session.query(func.min(db.ChangeLog.seq)).scalar() or 0
+        # New clients, clients from before a DB reset and clients whose
+        # position has been compacted away all get a full snapshot.
+        reset = since <= 0 or since > newest or oldest > since + 1
+
+        if reset:
+            yield _dump({"since": since, "reset": True})
+            yield from _snapshot_lines(session)
+            yield _dump({"next": newest, "more": False})
+            return
+
+        entries = (
+            session.query(db.ChangeLog)
+            .filter(db.ChangeLog.seq > since)
+            .order_by(db.ChangeLog.seq)
+            .limit(limit + 1)
+            .all()
+        )
+        more = len(entries) > limit
+        entries = entries[:limit]
+
+        yield _dump({"since": since, "reset": False})
+        yield from _delta_lines(session, entries)
+        yield _dump({"next": entries[-1].seq if entries else since, "more": more})
+    finally:
+        if owns_session:
+            session.close()
@@ -0,0 +1,100 @@
+"""
+Process settings, resolved once.
+
+Importing a module of this app must not depend on whether .env has been
+loaded yet, and must not open anything. Settings that decide how the
+process starts (database, pools, log file, server) are therefore read on
+first use, after load_env() has merged .env into the environment, and
+kept for the life of the process.
+
+Feature modules still read their own tuning knobs at import time, so the
+entry points (`python .` and `python db_builder.py`) call load_env()
+before importing the rest of the app. Worker and scan processes inherit
+the environment of the process that started them.
+"""
+
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+
+def load_env() -> None:
+    """
+    Merges .env into the environment once, variables already set win
+    """
+    global _env_loaded
+    with _env_lock:
+        if _env_loaded:
+            return
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        _env_loaded = True
+
+
+def _flag(name: str, default: str = "") -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+@dataclass(frozen=True)
+class Settings:
+    database_url: str
+    read_url: Optional[str]  # Read replica, not for SQLite
+    pool_size: int
+    max_overflow: int
+    pool_timeout: float
+    pool_recycle: int
+    sqlite_mmap_size: int
+    sqlite_cache_size: int  # KiB per connection
+    sqlite_busy_timeout: int  # Milliseconds
+    sqlite_writer_overflow: int
+    log_file: str
+    production: bool
+    workers: int
+    host: str
+    port: int
+    keep_alive_timeout: int
+    backlog: int
+    graceful_timeout: int
+    access_log: bool
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            database_url=os.getenv("SQLALCHEMY_DATABASE_URL", "sqlite:///./db.sqlite3"),
+            read_url=os.getenv("SQLALCHEMY_READ_URL") or None,
+            pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+            sqlite_mmap_size=int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+            sqlite_cache_size=int(os.getenv("SQLITE_CACHE_SIZE", str(64 * 1024))),
+            sqlite_busy_timeout=int(os.getenv("SQLITE_BUSY_TIMEOUT", "10000")),
+            sqlite_writer_overflow=int(os.getenv("SQLITE_WRITER_OVERFLOW", "4")),
+            log_file=os.getenv(
+                "LOGFILE", os.path.join(tempfile.gettempdir(), "library_builder.log")
+            ),
+            production=os.getenv("ENVIRONMENT", "").lower() == "production",
+            workers=int(os.getenv("WORKERS", str(os.cpu_count() or 1))),
+            host=os.getenv("HOST", "127.0.0.1"),
+            port=int(os.getenv("PORT", "8080")),
+            keep_alive_timeout=int(os.getenv("KEEP_ALIVE_TIMEOUT", "15")),
+            backlog=int(os.getenv("BACKLOG", "4096")),
+            graceful_timeout=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+            access_log=_flag("ACCESS_LOG", "0"),
+        )
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Returns the settings, read from the environment (and .env) on first use
+    """
+    load_env()
+    return Settings.from_env()
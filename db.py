@@ -1,24 +1,224 @@
 """
 Database Controller to make sure that Database is connected and switching is easier as well.
+
+There are two engines. `engine` is the writer, used by the library builder,
+play events and account changes. `read_engine` serves request handlers.
+
+On SQLite both point at the same file in WAL mode, so readers never wait
+for a running import. The writer keeps one pooled connection and opens up
+to SQLITE_WRITER_OVERFLOW more while sessions overlap, e.g. a play flush
+during a long playlist update. Every writer transaction starts with BEGIN
+IMMEDIATE, so writers in this process and in others take turns on the
+write lock through busy_timeout instead of failing on a lock upgrade, and
+a writer session holds the lock from its first statement until it commits
+or rolls back. Read connections are query_only and run every SELECT
+in its own implicit transaction, so a long response never pins an old
+snapshot and holds back WAL checkpoints.
+
+On other databases both engines share the pool settings, and
+SQLALCHEMY_READ_URL routes reads to a replica. Reads there may lag the
+writer by the replication delay.
+
+Both engines are created on first use from config.get_settings(), so
+importing this module (or anything importing it) never reads the database
+settings before .env is loaded.
 """
 
-import os
+import threading
 import uuid
+from typing import Callable, List, Optional, Tuple
 
-from sqlalchemy import Boolean, Column, ForeignKey, String, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    create_engine,
+    event,
+    inspect,
+    text,
+)
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
 from sqlalchemy.orm.decl_api import DeclarativeMeta
 
-SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL", "sqlite:///./db.sqlite3")
+from config import get_settings
+
+
+def _sqlite_pragmas(engine: Engine, writer: bool) -> None:
+    settings = get_settings()
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if writer:
+            # Let the begin hook below issue BEGIN instead of the driver
+            dbapi_connection.isolation_level = None
+            cursor.execute("PRAGMA journal_mode=WAL")
+        else:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout:d}")
+        cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size:d}")
+        cursor.execute(f"PRAGMA cache_size=-{settings.sqlite_cache_size:d}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    if writer:
+
+        @event.listens_for(engine, "begin")
+        def on_begin(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def create_engines(
+    url: Optional[str] = None, read_url: Optional[str] = None
+) -> Tuple[Engine, Engine]:
+    """
+    Creates the writer and the read engine, see the module docstring
+
+    Args:
+        url (str, optional): Database URL, SQLALCHEMY_DATABASE_URL by default
+        read_url (str, optional): Replica URL, SQLALCHEMY_READ_URL by default
+
+    Returns:
+        Tuple[Engine, Engine]: The writer and the read engine, the same
+        engine when reads cannot be split (in-memory SQLite, no replica)
+    """
+    settings = get_settings()
+    if url is None:
+        url, read_url = settings.database_url, read_url or settings.read_url
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite":
+        connect_args = {"check_same_thread": False}
+        if parsed.database in (None, "", ":memory:"):
+            # Every connection would be a separate database
+            engine = create_engine(url, connect_args=connect_args)
+            return engine, engine
+        writer = create_engine(
+            url,
+            connect_args=connect_args,
+            pool_size=1,
+            max_overflow=settings.sqlite_writer_overflow,
+            pool_timeout=settings.pool_timeout,
+        )
+        _sqlite_pragmas(writer, writer=True)
+        reader = create_engine(
+            url,
+            connect_args=connect_args,
+            pool_size=settings.pool_size,
+            max_overflow=settings.max_overflow,
+            pool_timeout=settings.pool_timeout,
+        )
+        _sqlite_pragmas(reader, writer=False)
+        return writer, reader
+
+    options = {
+        "pool_size": settings.pool_size,
+        "max_overflow": settings.max_overflow,
+        "pool_timeout": settings.pool_timeout,
+        "pool_recycle": settings.pool_recycle,
+        "pool_pre_ping": True,
+    }
+    writer = create_engine(url, **options)
+    reader = create_engine(read_url, **options) if read_url else writer
+    return writer, reader
+
+
+_engines: Optional[Tuple[Engine, Engine]] = None
+_engines_lock = threading.Lock()
+_engine_hooks: List[Callable[[Engine], None]] = []
+
+
+def get_engines() -> Tuple[Engine, Engine]:
+    """
+    Returns the writer and the read engine, created on first use
+    """
+    global _engines
+    if _engines is None:
+        with _engines_lock:
+            if _engines is None:
+                engines = create_engines()
+                for engine in dict.fromkeys(engines):
+                    for hook in _engine_hooks:
+                        hook(engine)
+                _engines = engines
+    return _engines
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def get_engine() -> Engine:
+    return get_engines()[0]
+
+
+def get_read_engine() -> Engine:
+    return get_engines()[1]
+
+
+def on_engine(hook: Callable[[Engine], None]) -> None:
+    """
+    Calls `hook` with every engine once it exists, for instrumentation that
+    has to be registered before the first connection
+    """
+    with _engines_lock:
+        _engine_hooks.append(hook)
+        engines = _engines
+    for engine in dict.fromkeys(engines or ()):
+        hook(engine)
+
+
+def dispose_engines(close: bool = True) -> None:
+    """
+    Empties the pools of the engines that have been created
+    """
+    for engine in dict.fromkeys(_engines or ()):
+        engine.dispose(close=close)
+
+
+def __getattr__(name: str):
+    # `db.engine` and `db.read_engine` create the engines on first access
+    if name == "engine":
+        return get_engine()
+    if name == "read_engine":
+        return get_read_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _WriterSession(Session):
+    """
+    Binds to its engine on first use, so importing this module creates none
+    """
+
+    def get_bind(self, *args, **kwargs):
+        if self.bind is None:
+            self.bind = get_engine()
+        return super().get_bind(*args, **kwargs)
+
+
+class _ReadSession(Session):
+    def get_bind(self, *args, **kwargs):
+        if self.bind is None:
+            self.bind = get_read_engine()
+        return super().get_bind(*args, **kwargs)
+
+
+SessionLocal = sessionmaker(class_=_WriterSession, autocommit=False, autoflush=False)
+ReadSession = sessionmaker(class_=_ReadSession, autocommit=False, autoflush=False)
 
 Base:DeclarativeMeta = declarative_base()
 
 
+class UnixTime(Float[float]):
+    """
+    A Float of Unix time, typed as float so timestamps can be used in
+    arithmetic without the generic Float's unbound number type
+    """
+
+    cache_ok = True
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -27,8 +227,42 @@ def get_db():
         db.close()
 
 
+def get_read_db():
+    """
+    Session for request handlers that only read, see the module docstring
+    """
+    db = ReadSession()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
+    add_missing_columns()
+
+
+def add_missing_columns():
+    """
+    create_all only creates missing tables, this adds the (nullable) columns
+    and the indexes introduced since an existing table was created.
+    """
+    engine = get_engine()
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
 
 
 # Models
@@ -37,7 +271,7 @@ def init_db():
 class User(Base):
     __tablename__ = "users"
 
-    uuid = Column(String, primary_key=True, index=True, default=str(uuid.uuid4()))
+    uuid = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, index=True)  # username
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
@@ -47,31 +281,162 @@ class User(Base):
 class Audio(Base):
     __tablename__ = "audio"
 
-    uuid = Column(String, primary_key=True, index=True, default=str(uuid.uuid4()))
+    uuid = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, index=True)
-    path = Column(String, index=True)
+    root = Column(String, index=True)  # Media root name, None for absolute paths
+    path = Column(String, index=True)  # Relative to the root
+    size = Column(Integer)
+    quick_hash = Column(String, index=True)  # See fingerprint.quick_hash
+    content_hash = Column(String, index=True)  # Only set once quick hashes collide
+    canonical = Column(String, ForeignKey("audio.uuid"), index=True)  # None if canonical
+    duration = Column(Float)  # Seconds
+    loudness = Column(Float)  # ReplayGain track gain in dB
 
 
 class Artist(Base):
     __tablename__ = "artists"
 
-    uuid = Column(String, primary_key=True, index=True, default=str(uuid.uuid4()))
+    uuid = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, index=True)
 
 
 class Album(Base):
     __tablename__ = "albums"
 
-    uuid = Column(String, primary_key=True, index=True, default=str(uuid.uuid4()))
+    uuid = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, index=True)
 
 
 class Track(Base):
     __tablename__ = "tracks"
+    __table_args__ = (
+        # Album listings in play order and artist listings by year
+        Index(
+            "ix_tracks_album_disc_number", "album", "disc", "track_number", "uuid"
+        ),
+        Index("ix_tracks_artist_year", "artist", "year"),
+        # Smart playlist rules on the release year
+        Index("ix_tracks_year", "year"),
+    )
 
-    uuid = Column(String, primary_key=True, index=True, default=str(uuid.uuid4()))
+    uuid = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, index=True)
     album = Column(String, ForeignKey("albums.uuid"))
     artist = Column(String, ForeignKey("artists.uuid"))
     audio = Column(String, ForeignKey("audio.uuid"))
     genre = Column(String, index=True)
+    track_number = Column(Integer)
+    disc = Column(Integer)
+    year = Column(Integer)
+
+
+class Genre(Base):
+    """
+    A normalized genre, see genres.py. `tracks` is maintained by the builder.
+    """
+
+    __tablename__ = "genres"
+
+    uuid = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    key = Column(String, unique=True)  # genres.genre_key of the name
+    name = Column(String)  # As first seen in a tag
+    tracks = Column(Integer, default=0, index=True)
+
+
+class TrackGenre(Base):
+    __tablename__ = "track_genres"
+    __table_args__ = (Index("ix_track_genres_genre_track", "genre", "track"),)
+
+    track = Column(String, ForeignKey("tracks.uuid"), primary_key=True)
+    genre = Column(String, ForeignKey("genres.uuid"), primary_key=True)
+
+
+class GenreArtist(Base):
+    """
+    Tracks per genre and artist, for the artist facet of a genre
+    """
+
+    __tablename__ = "genre_artists"
+    __table_args__ = (Index("ix_genre_artists_genre_tracks", "genre", "tracks"),)
+
+    genre = Column(String, ForeignKey("genres.uuid"), primary_key=True)
+    artist = Column(String, ForeignKey("artists.uuid"), primary_key=True)
+    tracks = Column(Integer, default=0)
+
+
+class ChangeLog(Base):
+    """
+    Append-only log of library changes, read by clients doing a delta sync.
+    AUTOINCREMENT keeps seq monotonic even after old rows are compacted away.
+    """
+
+    __tablename__ = "changelog"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String)  # track, album, artist or audio
+    entity_uuid = Column(String, index=True)
+    op = Column(String)  # insert, update or delete
+
+
+class PlayEvent(Base):
+    """
+    Play history, written in batches by plays.PlayRecorder
+    """
+
+    __tablename__ = "play_events"
+    __table_args__ = (Index("ix_play_events_user_at", "user", "at"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user = Column(String)
+    track = Column(String, ForeignKey("tracks.uuid"), index=True)
+    event = Column(String)  # start or complete
+    at = Column(Float, index=True)  # Unix time
+
+
+class PlayCount(Base):
+    """
+    Per-track play counters rolled up from the play events
+    """
+
+    __tablename__ = "play_counts"
+
+    track = Column(String, ForeignKey("tracks.uuid"), primary_key=True)
+    plays = Column(Integer, default=0, index=True)
+    completions = Column(Integer, default=0)
+    last_played = Column(Float)
+
+
+class Playlist(Base):
+    """
+    A user's playlist, see playlists.py. Static playlists are the ordered
+    entries their owner saved, smart playlists keep their rules as JSON and
+    materialize the matching tracks into the same entries.
+    """
+
+    __tablename__ = "playlists"
+
+    uuid = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    owner = Column(String, index=True)  # users.uuid
+    name = Column(String)
+    rules = Column(String)  # schemas.SmartRules as JSON, None for static playlists
+    tracks = Column(Integer, default=0)
+    generation = Column(Integer, default=0)  # Library generation the entries reflect
+    refreshed = Column(UnixTime)  # Last full materialization
+    updated = Column(UnixTime)
+
+
+class PlaylistEntry(Base):
+    """
+    The tracks of a playlist as an ordered array, positions start at 1 and
+    may have gaps where tracks were removed
+    """
+
+    __tablename__ = "playlist_entries"
+    __table_args__ = (Index("ix_playlist_entries_playlist_track", "playlist", "track"),)
+
+    playlist = Column(String, ForeignKey("playlists.uuid"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    # No foreign key: entries of tracks removed from the library are dropped
+    # when the playlist is refreshed
+    track = Column(String)
@@ -1,53 +1,96 @@
+import argparse
 import datetime
 import logging
 import os
-import tempfile
+import queue
+import threading
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Callable, Dict, Generator, Optional, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    Union,
+)
+
+import config
+
+if __name__ == "__main__":
+    # Run as a script: .env has to be in the environment before the modules
+    # below read their settings
+    config.load_env()
 
 from colorama import Fore, Style, init
-from dotenv import load_dotenv
-from mutagen import File
-from mutagen.flac import FLAC
-from mutagen.mp3 import MP3
-from mutagen.oggvorbis import OggFileType as OGG
-from mutagen.wave import WAVE as WAV
-from tqdm import tqdm  # For progress bars
 
+import changelog
 import db
+import fingerprint
+import genres
+import resolver
+import similar
+import tagreader
+from builder_stats import BuilderStats, profiled
+from media import get_roots, resolve_path
+
+if TYPE_CHECKING:
+    from mutagen.flac import FLAC
+    from mutagen.mp3 import MP3
+    from mutagen.oggvorbis import OggFileType as OGG
+    from mutagen.wave import WAVE as WAV
+
+    # Define a type alias for audio file classes
+    AudioFile = Union[MP3, FLAC, WAV, OGG]
+
+
+@lru_cache(maxsize=1)
+def extension_map() -> Dict[str, Callable[[Path], "AudioFile"]]:
+    """
+    Mapping of file extensions to their mutagen classes. mutagen is only the
+    fallback for files the tag reader does not handle, so it is imported on
+    first use.
+    """
+    from mutagen.flac import FLAC
+    from mutagen.mp3 import MP3
+    from mutagen.oggvorbis import OggFileType as OGG
+    from mutagen.wave import WAVE as WAV
+
+    return {
+        ".mp3": MP3,
+        ".flac": FLAC,
+        ".wv": WAV,
+        ".ogg": OGG,
+    }
 
-# Define a type alias for audio file classes
-AudioFile = Union[MP3, FLAC, WAV, OGG]
 
-# Mapping of file extensions to their corresponding classes
-EXTENSION_MAP: dict[str, Callable[[Path], AudioFile]] = {
-    ".mp3": MP3,
-    ".flac": FLAC,
-    ".wv": WAV,
-    ".ogg": OGG,
-}
+logger = logging.getLogger("HeavyMetal")
 
 
-# Setup logging
-filename = os.getenv(
-    "LOGFILE",
-    os.path.join(
-        tempfile.gettempdir(),
-        "library_builder.log"
+def configure_logging() -> None:
+    """
+    Sends the builder log to LOGFILE and sets up colored console output, for
+    the command line and scan processes. Importing this module does neither.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        filename=config.get_settings().log_file,
     )
-)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    filename=filename,
-)
-logger = logging.getLogger("HeavyMetal")
-
-load_dotenv()
-init(autoreset=True)
+    init(autoreset=True)
 
 CODES = {
     "OK": f"[{Fore.GREEN}+{Style.RESET_ALL}]",
@@ -56,9 +99,24 @@ CODES = {
     "ERROR": f"[{Fore.RED}!{Style.RESET_ALL}]",
 }
 
-# Cache for artists and albums to reduce database queries
-artist_cache:dict = {}
-album_cache:dict = {}
+# Artist and album names to uuids, see resolver.NameResolver
+artists = resolver.NameResolver(db.Artist)
+albums = resolver.NameResolver(db.Album)
+# (size, quick hash) -> audio files sharing them, see find_duplicate
+fingerprint_index: Dict[Tuple[int, str], List["FingerprintEntry"]] = {}
+# Genre uuids and the facet count changes of the current batch
+genre_links = genres.GenreLinker()
+
+# Per-stage timers and counters of the current run
+stats = BuilderStats()
+
+
+class CancelFlag(Protocol):
+    """
+    What a scan polls to stop early, a threading.Event or scan_jobs' marker
+    """
+
+    def is_set(self) -> bool: ...
 
 
 def log_and_print(level: str, message: str) -> None:
@@ -78,24 +136,41 @@ def log_and_print(level: str, message: str) -> None:
     elif level == "ERROR":
         logger.error(message)
 
-if os.getenv("MEDIA_FOLDER"):
-    MEDIA_FOLDER = Path(
-        os.getenv("MEDIA_FODLER", "")
-    )
-else:
-    log_and_print("ERROR", "MEDIA_FOLDER env variable is not set")
-    exit(1)
-
 BATCH_SIZE = int(
     os.getenv("BATCH_SIZE", "100")
 )  # Number of files to process before committing
 MAX_WORKERS = int(
     os.getenv("MAX_WORKERS", "4")
 )  # Number of parallel workers for metadata extraction
-CHECKPOINT_FILE = "library_builder_checkpoint.txt"
+DEVICE_IO_LIMIT = int(
+    os.getenv("DEVICE_IO_LIMIT", str(MAX_WORKERS))
+)  # Walks and file reads allowed per device at once, 1 for spinning disks
+SCAN_QUEUE_SIZE = 1000  # Discovered files buffered between walkers and parsers
+
+
+class ScannedFile(NamedTuple):
+    root: str  # Name of the media root
+    root_path: Path
+    path: Path
+    metadata: Dict[str, Any]
+    fingerprint: Optional[Tuple[int, str, bool]] = None  # See fingerprint.quick_hash
+
+
+class FingerprintEntry:
+    __slots__ = ("uuid", "canonical", "path", "content_hash", "audio", "unsaved")
+
+    def __init__(self, uuid, canonical, path, content_hash, audio=None):
+        self.uuid = uuid
+        self.canonical = canonical
+        self.path = path  # Absolute, None if its root is not configured
+        self.content_hash = content_hash
+        self.audio = audio  # Pending db.Audio added by this run
+        self.unsaved = False  # content_hash computed, not written yet
 
 def traverse_directory(
-    path: Path, filter_: Optional[Callable[[Path], bool]] = None
+    path: Path,
+    filter_: Optional[Callable[[Path], bool]] = None,
+    io_limit: Optional[threading.Semaphore] = None,
 ) -> Generator[Path, None, None]:
     """
     Recursively traverses a directory and yields files one by one
@@ -103,19 +178,40 @@ def traverse_directory(
     Args:
         path (Path): The directory to traverse
         filter (Callable, optional): A function to filter the files. Defaults to None.
+        io_limit (Semaphore, optional): Held while a directory is listed and
+            its entries are classified and filtered, so walkers of one disk
+            take turns per directory. Never held while a file is yielded.
 
     Yields:
         Path: File paths one at a time
     """
+    limit: ContextManager = io_limit or nullcontext()
     try:
-        for entry in path.iterdir():
-            if entry.is_dir():
-                yield from traverse_directory(entry, filter_)
-            elif entry.is_file() and (filter_ is None or filter_(entry)):
-                yield entry
+        directories: List[Path] = []
+        files: List[Path] = []
+        with limit:
+            start = time.perf_counter()
+            # scandir knows the entry types from the listing on most file
+            # systems, so classifying them rarely needs a stat
+            with os.scandir(path) as listing:
+                entries = list(listing)
+            stats.add("walk", time.perf_counter() - start, len(entries))
+            start = time.perf_counter()
+            for entry in entries:
+                entry_path = Path(entry.path)
+                if entry.is_dir():
+                    directories.append(entry_path)
+                elif entry.is_file() and (filter_ is None or filter_(entry_path)):
+                    files.append(entry_path)
+            stats.add("stat", time.perf_counter() - start, len(entries))
+        yield from files
+        for directory in directories:
+            yield from traverse_directory(directory, filter_, io_limit)
     except PermissionError:
+        stats.count("walk_errors")
         log_and_print("WARNING", f"Permission denied accessing {path}")
     except Exception as e:
+        stats.count("walk_errors")
         log_and_print("ERROR", f"Error traversing {path}: {e}")
 
 
@@ -132,17 +228,28 @@ def isAudioFile(path: Path) -> bool:
     # Check extension first (much faster than parsing with mutagen)
     audio_extensions = {".mp3", ".flac", ".ogg", ".wav", ".m4a", ".aac", ".wma"}
     if path.suffix.lower() not in audio_extensions:
+        stats.count("skipped")
         return False
 
+    # The tag reader fast path confirms these while parsing, sniffing them
+    # here would cost another read of every file
+    if path.suffix.lower() in tagreader.EXTENSIONS:
+        return True
+
     # Then try to parse with mutagen to confirm
+    start = time.perf_counter()
     try:
+        from mutagen import File
+
         audio = File(path)
         return bool(audio)
     except Exception:
         return False
+    finally:
+        stats.add("sniff", time.perf_counter() - start)
 
 
-def check_format(path: Path) -> Optional[AudioFile]:
+def check_format(path: Path) -> Optional["AudioFile"]:
     """
     Check if the file is FLAC, MP3, WAV, OGG, etc.
 
@@ -155,15 +262,18 @@ def check_format(path: Path) -> Optional[AudioFile]:
     try:
         # Identify by extension
         ext = path.suffix.lower()
-        if ext in EXTENSION_MAP:
-            return EXTENSION_MAP[ext](path)
+        classes = extension_map()
+        if ext in classes:
+            return classes[ext](path)
 
         # Fall back to MIME type detection
+        from mutagen import File
+
         f = File(path)
         if not f:
             return None
         mime_type = "".join(f.mime)
-        for ext, cls in EXTENSION_MAP.items():
+        for ext, cls in classes.items():
             if ext.strip('.') in mime_type:
                 return cls(path)
         return None
@@ -210,33 +320,56 @@ def check_format(path: Path) -> Optional[AudioFile]:
 #         return None
 
 
-def parseAudioMetadata(path: Path) -> Dict[str, Any]:
+def parseAudioMetadata(
+    path: Path, head: Optional[tagreader.FileHead] = None
+) -> Dict[str, Any]:
     """
     Parses the metadata of an audio file
 
     Args:
         path (Path): The audio file to parse
+        head (FileHead, optional): The file, already open, see scanFile
 
     Returns:
         dict: A dictionary containing the metadata
     """
-    metadata = {
+    metadata: Dict[str, Any] = {
         "title": None,
         "artist": None,
         "album": None,
         "genre": None,
         "track_number": None,
+        "disc": None,
         "year": None,
+        "duration": None,
+        "loudness": None,
         "path": str(path),
         "filename": path.name,
     }
 
+    start = time.perf_counter()
     try:
+        record = tagreader.read_tags(path, head=head)
+        if record is not None:
+            stats.count("fast_path")
+            for field in tagreader.TagRecord.__slots__:
+                metadata[field] = getattr(record, field)
+            if record.loudness:
+                metadata["loudness"] = parseGain(record.loudness)
+            metadata["title"] = metadata["title"] or path.stem
+            return metadata
+
         audio_file = check_format(path)
         if not audio_file:
             logger.warning(f"Could not parse metadata for {path}")
+            stats.count("unparsed")
+            if path.suffix.lower() in tagreader.EXTENSIONS:
+                # Not sniffed by isAudioFile, and neither reader accepted it
+                metadata["not_audio"] = True
             return metadata
 
+        from mutagen.mp3 import MP3  # Loaded by check_format already
+
         # Extract metadata based on file type
         if isinstance(audio_file, MP3):
             tags = audio_file.tags
@@ -251,8 +384,14 @@ def parseAudioMetadata(path: Path) -> Dict[str, Any]:
                     metadata["genre"] = str(tags["TCON"])
                 if "TRCK" in tags:  # Track number
                     metadata["track_number"] = str(tags["TRCK"])
+                if "TPOS" in tags:  # Disc number
+                    metadata["disc"] = str(tags["TPOS"])
                 if "TDRC" in tags:  # Year
                     metadata["year"] = str(tags["TDRC"])
+                if "TXXX:REPLAYGAIN_TRACK_GAIN" in tags:
+                    metadata["loudness"] = parseGain(
+                        str(tags["TXXX:REPLAYGAIN_TRACK_GAIN"])
+                    )
 
         # For FLAC, OGG, etc. which use Vorbis comment style tags
         elif hasattr(audio_file, "tags") and audio_file.tags:
@@ -262,10 +401,19 @@ def parseAudioMetadata(path: Path) -> Dict[str, Any]:
             metadata["album"] = tags.get("ALBUM", [None])[0]
             metadata["genre"] = tags.get("GENRE", [None])[0]
             metadata["track_number"] = tags.get("TRACKNUMBER", [None])[0]
+            metadata["disc"] = tags.get("DISCNUMBER", [None])[0]
             metadata["year"] = tags.get("DATE", [None])[0]
+            gain = tags.get("REPLAYGAIN_TRACK_GAIN", [None])[0]
+            metadata["loudness"] = parseGain(gain) if gain else None
+
+        info = getattr(audio_file, "info", None)
+        if info is not None and getattr(info, "length", None):
+            metadata["duration"] = float(info.length)
 
     except Exception as e:
         logger.warning(f"Error parsing metadata for {path}: {e}")
+    finally:
+        stats.add(f"parse{path.suffix.lower()}", time.perf_counter() - start)
 
     # Use filename as fallback for title if not found in metadata
     if not metadata["title"]:
@@ -274,6 +422,36 @@ def parseAudioMetadata(path: Path) -> Dict[str, Any]:
     return metadata
 
 
+def parseGain(value: str) -> Optional[float]:
+    """
+    Parses a ReplayGain value such as "-6.52 dB"
+    """
+    try:
+        return float(value.lower().replace("db", "").strip())
+    except ValueError:
+        return None
+
+
+def parseNumber(value: Optional[str]) -> Optional[int]:
+    """
+    Extracts a track or disc number from tags such as "3", "03" or "3/12"
+    """
+    if not value:
+        return None
+    number = str(value).split("/")[0].strip()
+    return int(number) if number.isdigit() else None
+
+
+def parseYear(value: Optional[str]) -> Optional[int]:
+    """
+    Extracts the year from a date tag such as "1984", "1984-05" or "1984-05-12"
+    """
+    if not value:
+        return None
+    digits = str(value).strip()[:4]
+    return int(digits) if digits.isdigit() else None
+
+
 def get_or_create_artist(session, artist_name: str) -> Tuple[str, bool] | Tuple[None, bool]:
     """
     Gets or creates an artist in the database
@@ -288,24 +466,14 @@ def get_or_create_artist(session, artist_name: str) -> Tuple[str, bool] | Tuple[
     if not artist_name:
         return None, False
 
-    # Check cache first
-    if artist_name in artist_cache:
-        return artist_cache[artist_name], False
-
-    # Check database
-    artist = session.query(db.Artist).filter(db.Artist.name == artist_name).first()
-    if artist:
-        # Add to cache
-        artist_cache[artist_name] = artist.uuid
-        return artist.uuid, False
+    artist_uuid = artists.get(session, artist_name)
+    if artist_uuid is not None:
+        return artist_uuid, False
 
     # Create new artist
     artist_uuid = str(uuid.uuid4())
-    artist = db.Artist(uuid=artist_uuid, name=artist_name)
-    session.add(artist)
-
-    # Add to cache
-    artist_cache[artist_name] = artist_uuid
+    session.add(db.Artist(uuid=artist_uuid, name=artist_name))
+    artists.add(artist_name, artist_uuid)
     return artist_uuid, True
 
 
@@ -323,66 +491,278 @@ def get_or_create_album(session, album_name: str) -> Tuple[str, bool] | Tuple[No
     if not album_name:
         return None, False
 
-    # Check cache first
-    if album_name in album_cache:
-        return album_cache[album_name], False
-
-    # Check database
-    album = session.query(db.Album).filter(db.Album.name == album_name).first()
-    if album:
-        # Add to cache
-        album_cache[album_name] = album.uuid
-        return album.uuid, False
+    album_uuid = albums.get(session, album_name)
+    if album_uuid is not None:
+        return album_uuid, False
 
     # Create new album
     album_uuid = str(uuid.uuid4())
-    album = db.Album(uuid=album_uuid, name=album_name)
-    session.add(album)
-
-    # Add to cache
-    album_cache[album_name] = album_uuid
+    session.add(db.Album(uuid=album_uuid, name=album_name))
+    albums.add(album_name, album_uuid)
     return album_uuid, True
 
 
-def makeDBEntry(path: Path, session) -> bool:
+def fingerprintFile(
+    path: Path, head: Optional[tagreader.FileHead] = None
+) -> Optional[Tuple[int, str, bool]]:
+    """
+    Computes the quick fingerprint of a file, None if it cannot be read
+    """
+    start = time.perf_counter()
+    try:
+        if head is not None:
+            return fingerprint.quick_hash(path, head.size, head.read)
+        return fingerprint.quick_hash(path)
+    except OSError as e:
+        logger.warning(f"Could not fingerprint {path}: {e}")
+        return None
+    finally:
+        stats.add("fingerprint", time.perf_counter() - start)
+
+
+def scanFile(
+    path: Path, io_limit: Optional[threading.Semaphore] = None
+) -> Tuple[Dict[str, Any], Optional[Tuple[int, str, bool]]]:
+    """
+    Parses and fingerprints a file, runs on the parsing pool. The file is
+    opened and stat'ed once, and its head read once for both, while
+    `io_limit` is held.
+    """
+    with io_limit or nullcontext():
+        return _scan_file(path)
+
+
+def _scan_file(path: Path) -> Tuple[Dict[str, Any], Optional[Tuple[int, str, bool]]]:
+    try:
+        with open(path, "rb") as f:
+            head = tagreader.FileHead(f, os.fstat(f.fileno()).st_size)
+            return parseAudioMetadata(path, head), fingerprintFile(path, head)
+    except OSError:
+        # Unreadable, both log why on their own
+        return parseAudioMetadata(path), fingerprintFile(path)
+
+
+def load_fingerprints(session) -> None:
+    """
+    Fills fingerprint_index with the audio files fingerprinted by earlier runs
+    """
+    fingerprint_index.clear()
+    rows = session.query(
+        db.Audio.uuid,
+        db.Audio.canonical,
+        db.Audio.root,
+        db.Audio.path,
+        db.Audio.size,
+        db.Audio.quick_hash,
+        db.Audio.content_hash,
+    ).filter(db.Audio.quick_hash.isnot(None))
+    for audio_uuid, canonical, root, path, size, quick, content in rows:
+        fingerprint_index.setdefault((size, quick), []).append(
+            FingerprintEntry(audio_uuid, canonical, resolve_path(root, path), content)
+        )
+
+
+def _full_hash(path: Path) -> Optional[str]:
+    start = time.perf_counter()
+    try:
+        return fingerprint.full_hash(path)
+    except OSError as e:
+        logger.warning(f"Could not hash {path}: {e}")
+        return None
+    finally:
+        stats.add("full_hash", time.perf_counter() - start)
+
+
+def hash_candidates(
+    files_batch: List[ScannedFile],
+    known: Optional[Dict[Tuple[Optional[str], str], str]] = None,
+) -> Dict[Path, str]:
+    """
+    Computes the full hashes find_duplicate will compare for a batch, before
+    the batch opens its write transaction, so a writer never waits on them
+
+    Files whose size and quick hash match an indexed file, or an earlier file
+    of the batch, are hashed along with those files. Indexed files keep their
+    hash on their FingerprintEntry until find_duplicate stores it.
+
+    Returns:
+        Dict[Path, str]: Full hashes of the new files of the batch that need one
+    """
+    hashes: Dict[Path, str] = {}
+    first: Dict[Tuple[int, str], Tuple[Path, bool]] = {}
+    for scanned in files_batch:
+        if scanned.fingerprint is None or (
+            known
+            and known_audio(known, scanned.root, scanned.root_path, scanned.path)
+        ):
+            continue
+        size, quick, whole = scanned.fingerprint
+        key = (size, quick)
+        candidates = [
+            entry
+            for entry in fingerprint_index.get(key, ())
+            if entry.canonical is None
+        ]
+        earlier = first.setdefault(key, (scanned.path, whole))
+        if not candidates and earlier[0] == scanned.path:
+            continue
+        for path, hashed in (earlier, (scanned.path, whole)):
+            # Files read whole already use their quick hash as full hash
+            if not hashed and path not in hashes:
+                content = _full_hash(path)
+                if content is not None:
+                    hashes[path] = content
+        for entry in candidates:
+            if entry.content_hash is None and entry.path is not None:
+                entry.content_hash = _full_hash(Path(entry.path))
+                entry.unsaved = entry.content_hash is not None
+    return hashes
+
+
+def _content_hash(entry: FingerprintEntry, session) -> Optional[str]:
+    if entry.content_hash is None and entry.path is not None:
+        # Not hashed ahead by hash_candidates
+        entry.content_hash = _full_hash(Path(entry.path))
+        entry.unsaved = entry.content_hash is not None
+    if entry.unsaved:
+        entry.unsaved = False
+        if entry.audio is not None:
+            entry.audio.content_hash = entry.content_hash
+        else:
+            session.query(db.Audio).filter(db.Audio.uuid == entry.uuid).update(
+                {db.Audio.content_hash: entry.content_hash}, synchronize_session=False
+            )
+            changelog.record(session, "audio", [entry.uuid])
+    return entry.content_hash
+
+
+def find_duplicate(
+    audio,
+    path: Path,
+    fingerprint_: Tuple[int, str, bool],
+    session,
+    content_hash: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Records the fingerprint on a new audio row and links it to the canonical
+    copy if the same content is already in the library. Full hashes are only
+    computed for files whose size and quick hash collide, ahead of the write
+    transaction by hash_candidates.
+
+    Returns:
+        Optional[str]: UUID of the canonical audio file, None if it is new
+    """
+    size, quick, whole = fingerprint_
+    audio.size = size
+    audio.quick_hash = quick
+    entry = FingerprintEntry(audio.uuid, None, str(path.absolute()), None, audio)
+    if whole:
+        entry.content_hash = audio.content_hash = quick
+    elif content_hash is not None:
+        entry.content_hash = audio.content_hash = content_hash
+
+    candidates = fingerprint_index.setdefault((size, quick), [])
+    try:
+        for candidate in candidates:
+            if candidate.canonical is not None:
+                continue
+            content = _content_hash(entry, session)
+            if content is None:
+                return None
+            if _content_hash(candidate, session) == content:
+                entry.canonical = audio.canonical = candidate.uuid
+                stats.count("duplicates")
+                return candidate.uuid
+        return None
+    finally:
+        candidates.append(entry)
+
+
+def track_values(metadata: Dict[str, Any], session) -> Dict[str, Any]:
+    """
+    Track columns for parsed metadata, creating its artist and album if needed
+    """
+    start = time.perf_counter()
+
+    # Handle Artist
+    artist_uuid, artist_created = get_or_create_artist(session, metadata["artist"])
+
+    # Handle Album
+    album_uuid, album_created = get_or_create_album(session, metadata["album"])
+
+    stats.add("resolve", time.perf_counter() - start)
+    stats.count("artists_created", artist_created)
+    stats.count("albums_created", album_created)
+
+    return {
+        "name": metadata["title"],
+        "album": album_uuid,
+        "artist": artist_uuid,
+        "genre": metadata["genre"],
+        "track_number": parseNumber(metadata.get("track_number")),
+        # Single disc releases rarely tag the disc, they are disc 1
+        "disc": parseNumber(metadata.get("disc")) or 1,
+        "year": parseYear(metadata.get("year")),
+    }
+
+
+def makeDBEntry(
+    path: Path,
+    session,
+    metadata: Optional[Dict[str, Any]] = None,
+    root: Optional[str] = None,
+    root_path: Optional[Path] = None,
+    fingerprint_: Optional[Tuple[int, str, bool]] = None,
+    content_hash: Optional[str] = None,
+) -> bool:
     """
     Creates a database entry for a file
 
     Args:
         path (Path): The file to create the database entry for
         session: SQLAlchemy database session
+        metadata (dict, optional): Already parsed metadata, parsed here if omitted
+        root (str, optional): Name of the media root the file was found in, the
+            path is then stored relative to root_path
+        root_path (Path, optional): Location of that media root
+        fingerprint_ (tuple, optional): Quick fingerprint used to link duplicates
+        content_hash (str, optional): Full hash computed by hash_candidates
 
     Returns:
         bool: True if successful, False otherwise
     """
     try:
         # Parse metadata
-        metadata = parseAudioMetadata(path)
+        if metadata is None:
+            metadata = parseAudioMetadata(path)
 
         # Create or get Audio entry
         audio_uuid = str(uuid.uuid4())
+        if root and root_path is not None:
+            stored_path = path.relative_to(root_path).as_posix()
+        else:
+            stored_path = str(path.absolute())
         audio = db.Audio(
-            uuid=audio_uuid, name=metadata["filename"], path=str(path.absolute())
+            uuid=audio_uuid,
+            name=metadata["filename"],
+            root=root,
+            path=stored_path,
+            duration=metadata.get("duration"),
+            loudness=metadata.get("loudness"),
         )
         session.add(audio)
-
-        # Handle Artist
-        artist_uuid, artist_created = get_or_create_artist(session, metadata["artist"])
-
-        # Handle Album
-        album_uuid, album_created = get_or_create_album(session, metadata["album"])
+        if fingerprint_ is not None:
+            find_duplicate(audio, path, fingerprint_, session, content_hash)
 
         # Create Track entry
         track_uuid = str(uuid.uuid4())
         track = db.Track(
-            uuid=track_uuid,
-            name=metadata["title"],
-            album=album_uuid,
-            artist=artist_uuid,
-            audio=audio_uuid,
-            genre=metadata["genre"],
+            uuid=track_uuid, audio=audio_uuid, **track_values(metadata, session)
         )
         session.add(track)
+        # Duplicates stay out of the genre facets, like out of listings
+        if audio.canonical is None:
+            genre_links.link(session, track_uuid, track.artist, track.genre)
 
         return True
 
@@ -391,31 +771,100 @@ def makeDBEntry(path: Path, session) -> bool:
         return False
 
 
-def process_files_batch(files_batch, session):
+def updateDBEntry(audio_uuid: str, metadata: Dict[str, Any], session) -> bool:
+    """
+    Refreshes the audio and track rows of a file already in the database,
+    only columns whose value changed are written
+
+    Args:
+        audio_uuid (str): The audio row of the file
+        metadata (dict): Freshly parsed metadata
+        session: SQLAlchemy database session
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        audio = session.get(db.Audio, audio_uuid)
+        track = session.query(db.Track).filter(db.Track.audio == audio_uuid).first()
+        if audio is None or track is None:
+            return False
+        audio.name = metadata["filename"]
+        audio.duration = metadata.get("duration")
+        audio.loudness = metadata.get("loudness")
+        old_genre, old_artist = track.genre, track.artist
+        for column, value in track_values(metadata, session).items():
+            setattr(track, column, value)
+        if audio.canonical is None and (old_genre, old_artist) != (track.genre, track.artist):
+            genre_links.unlink(session, {track.uuid: old_artist})
+            genre_links.link(session, track.uuid, track.artist, track.genre)
+        return True
+    except Exception as e:
+        logger.error(f"Error updating DB entry for {metadata['path']}: {e}")
+        return False
+
+
+def process_files_batch(
+    files_batch: List[ScannedFile],
+    session,
+    known: Optional[Dict[Tuple[Optional[str], str], str]] = None,
+):
     """
     Process a batch of files and add them to the database
 
     Args:
-        files_batch: List of file paths to process
+        files_batch: List of scanned and parsed files to process
         session: SQLAlchemy database session
+        known (dict, optional): Known paths and their audio rows, files
+            found in it are updated instead of added
 
     Returns:
         int: Number of successfully processed files
     """
     success_count = 0
+    content_hashes = hash_candidates(files_batch, known)
 
-    for file_path in files_batch:
-        if makeDBEntry(file_path, session):
+    for scanned in files_batch:
+        existing = (
+            known_audio(known, scanned.root, scanned.root_path, scanned.path)
+            if known
+            else None
+        )
+        if existing is not None:
+            if updateDBEntry(existing[1], scanned.metadata, session):
+                success_count += 1
+                stats.count("updated")
+        elif makeDBEntry(
+            scanned.path,
+            session,
+            scanned.metadata,
+            scanned.root,
+            scanned.root_path,
+            scanned.fingerprint,
+            content_hashes.get(scanned.path),
+        ):
             success_count += 1
 
     # Commit the batch
+    start = time.perf_counter()
     try:
+        genre_links.apply(session)
         session.commit()
+        artists.commit()
+        albums.commit()
     except Exception as e:
         logger.error(f"Error committing batch to database: {e}")
         session.rollback()
+        genre_links.reset()
+        artists.rollback()
+        albums.rollback()
+        stats.count("commit_errors")
         return 0
+    finally:
+        stats.add("commit", time.perf_counter() - start, len(files_batch))
 
+    stats.count("files", len(files_batch))
+    stats.count("added", success_count)
     return success_count
 
 
@@ -440,157 +889,548 @@ def get_audio_file_count(directory: Path) -> int:
     return count
 
 
-def save_checkpoint(processed_path: str) -> None:
+def device_limits(roots: Dict[str, Path]) -> Dict[str, threading.Semaphore]:
     """
-    Save the last processed file path as a checkpoint
+    Maps every accessible root to the semaphore of its device
+
+    Roots on the same device share DEVICE_IO_LIMIT permits, taken by the
+    walkers for each directory and by the parsing pool for each file. By
+    default that is one per parsing worker, DEVICE_IO_LIMIT=1 makes a
+    spinning disk serve one reader at a time instead of seeking between
+    them, while disks (or mounts) of their own are still read concurrently.
+    """
+    by_device: Dict[int, threading.Semaphore] = {}
+    limits = {}
+    for name, root in roots.items():
+        try:
+            device = root.stat().st_dev
+        except OSError as e:
+            stats.count("walk_errors")
+            log_and_print("ERROR", f"Cannot access media root {name} ({root}): {e}")
+            continue
+        limits[name] = by_device.setdefault(
+            device, threading.BoundedSemaphore(DEVICE_IO_LIMIT)
+        )
+    return limits
+
+
+def scan_roots(
+    roots: Dict[str, Path], limits: Optional[Dict[str, threading.Semaphore]] = None
+) -> Generator[Tuple[str, Path, Path], None, None]:
+    """
+    Walks every media root in its own thread and yields the audio files found
 
     Args:
-        processed_path: Path of the last processed file
+        roots (dict): Media root names and their locations
+        limits (dict, optional): Device semaphores by root, see device_limits
+
+    Yields:
+        Tuple[str, Path, Path]: Root name, root path and file path
+    """
+    found: queue.Queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    stop = threading.Event()
+    done = object()
+    if limits is None:
+        limits = device_limits(roots)
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                found.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def walk(name: str, root: Path, limit: threading.Semaphore) -> None:
+        try:
+            for path in traverse_directory(root, filter_=isAudioFile, io_limit=limit):
+                if not put((name, root, path)):
+                    return
+        finally:
+            put(done)
+
+    walkers = [
+        threading.Thread(
+            target=walk, args=(name, roots[name], limit), name=f"walk-{name}", daemon=True
+        )
+        for name, limit in limits.items()
+    ]
+
+    for walker in walkers:
+        walker.start()
+    remaining = len(walkers)
+    try:
+        while remaining:
+            item = found.get()
+            if item is done:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+
+
+def parse_files(
+    files: Iterable[Tuple[str, Path, Path]],
+    workers: int = MAX_WORKERS,
+    limits: Optional[Dict[str, threading.Semaphore]] = None,
+) -> Generator[ScannedFile, None, None]:
+    """
+    Parses and fingerprints files on a pool of workers, keeping a bounded
+    window in flight. With `limits` (see device_limits) each file is read
+    under the semaphore of its root's device.
     """
-    with open(CHECKPOINT_FILE, "w") as f:
-        f.write(processed_path)
+    limits = limits or {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parse") as pool:
+        pending: deque = deque()
+        for name, root, path in files:
+            future = pool.submit(scanFile, path, limits.get(name))
+            pending.append((name, root, path, future))
+            if len(pending) >= workers * 4:
+                name, root, path, future = pending.popleft()
+                yield ScannedFile(name, root, path, *future.result())
+        while pending:
+            name, root, path, future = pending.popleft()
+            yield ScannedFile(name, root, path, *future.result())
+
+
+def load_known_paths(session) -> Dict[Tuple[Optional[str], str], str]:
+    """
+    Returns the (root, path) of every audio file already in the database,
+    mapped to its audio row
+    """
+    return {
+        (root, path): audio_uuid
+        for audio_uuid, root, path in session.query(
+            db.Audio.uuid, db.Audio.root, db.Audio.path
+        )
+    }
 
 
-def load_checkpoint() -> Optional[str]:
+def known_audio(
+    known: Dict[Tuple[Optional[str], str], str], name: str, root: Path, path: Path
+) -> Optional[Tuple[Tuple[Optional[str], str], str]]:
     """
-    Load the last processed file path from checkpoint
+    Looks a scanned file up in `known`
 
     Returns:
-        Optional[str]: Path of the last processed file, if any
+        Optional[tuple]: The matching (root, path) key and audio row, if any
+    """
+    key: Tuple[Optional[str], str] = (name, path.relative_to(root).as_posix())
+    if key not in known:
+        # Rows from before media roots were stored with absolute paths
+        key = (None, str(path.absolute()))
+    audio_uuid = known.get(key)
+    return None if audio_uuid is None else (key, audio_uuid)
+
+
+def remove_missing(
+    session,
+    roots: Dict[str, Path],
+    known: Dict[Tuple[Optional[str], str], str],
+    seen: Set[Tuple[Optional[str], str]],
+) -> int:
     """
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, "r") as f:
-            return f.read().strip()
-    return None
+    Deletes the tracks and audio rows of files under `roots` that a full
+    scan did not find anymore, along with their play history
 
+    Returns:
+        int: Number of files removed
+    """
+    def under_roots(root: Optional[str], path: str) -> bool:
+        if root is not None:
+            return root in roots
+        return any(Path(path).is_relative_to(location) for location in roots.values())
+
+    missing = [
+        audio_uuid
+        for key, audio_uuid in known.items()
+        if key not in seen and under_roots(*key)
+    ]
+    missing_set = set(missing)
+    for start in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[start : start + BATCH_SIZE]
+        tracks = session.query(db.Track).filter(db.Track.audio.in_(chunk)).all()
+        track_uuids = [track.uuid for track in tracks]
+        genre_links.unlink(session, {track.uuid: track.artist for track in tracks})
+        # One surviving duplicate of each removed canonical file takes its
+        # place, the others become duplicates of that one
+        replacements: Dict[str, List[str]] = {}
+        for audio_uuid, canonical in (
+            session.query(db.Audio.uuid, db.Audio.canonical)
+            .filter(db.Audio.canonical.in_(chunk))
+            .order_by(db.Audio.canonical, db.Audio.uuid)
+        ):
+            if audio_uuid not in missing_set:
+                replacements.setdefault(canonical, []).append(audio_uuid)
+        promoted_audio = [duplicates[0] for duplicates in replacements.values()]
+        promoted = session.query(db.Track.uuid, db.Track.artist, db.Track.genre).filter(
+            db.Track.audio.in_(promoted_audio)
+        ).all()
+        session.query(db.PlayEvent).filter(db.PlayEvent.track.in_(track_uuids)).delete(
+            synchronize_session=False
+        )
+        session.query(db.PlayCount).filter(db.PlayCount.track.in_(track_uuids)).delete(
+            synchronize_session=False
+        )
+        session.query(db.Audio).filter(db.Audio.uuid.in_(promoted_audio)).update(
+            {db.Audio.canonical: None}, synchronize_session=False
+        )
+        for first, *others in replacements.values():
+            if others:
+                session.query(db.Audio).filter(db.Audio.uuid.in_(others)).update(
+                    {db.Audio.canonical: first}, synchronize_session=False
+                )
+        changelog.record(
+            session, "audio", [audio for group in replacements.values() for audio in group]
+        )
+        for track_uuid, artist_uuid, genre in promoted:
+            genre_links.link(session, track_uuid, artist_uuid, genre)
+        for track in tracks:
+            session.delete(track)
+        for audio in session.query(db.Audio).filter(db.Audio.uuid.in_(chunk)):
+            session.delete(audio)
+        genre_links.apply(session)
+        session.commit()
+    stats.count("removed", len(missing))
+    return len(missing)
 
-def main():
-    start_time = time.time()
-    log_and_print("INFO", "Hello from HeavyMetal library builder!")
 
-    # Initialize the database
-    db.init_db()
+def build_library(
+    roots: Dict[str, Path],
+    session,
+    on_batch: Optional[Callable[[int, int], None]] = None,
+    full: bool = False,
+    cancel: Optional[CancelFlag] = None,
+) -> Tuple[int, int]:
+    """
+    Scans the roots and adds every file that is not in the database yet
 
-    # Check for checkpoint
-    last_processed = load_checkpoint()
-    if last_processed:
-        log_and_print("INFO", f"Resuming from checkpoint: {last_processed}")
+    Args:
+        roots (dict): Media root names and their locations
+        session: SQLAlchemy database session
+        on_batch (Callable, optional): Called with (batch size, successes)
+            after every committed batch
+        full (bool): Also re-read files already in the database and remove
+            the ones that are gone, instead of only adding new files
+        cancel (Event, optional): Stops the scan once set, files parsed so
+            far are still committed
 
-    # Get estimated file count for progress bar
-    log_and_print("INFO", f"Estimating number of audio files in {MEDIA_FOLDER}...")
-    estimated_total = get_audio_file_count(MEDIA_FOLDER)
-    log_and_print("OK", f"Estimated {estimated_total} audio files to process")
+    Returns:
+        Tuple[int, int]: Files processed and files added or updated
+    """
+    known = load_known_paths(session)
+    load_fingerprints(session)
+    # End the transaction these reads opened, on SQLite it holds the write
+    # lock, which nobody else should wait on while the first batch is parsed
+    session.commit()
+    seen: Set[Tuple[Optional[str], str]] = set()
+    processed_count = success_count = 0
+    batch: List[ScannedFile] = []
+    limits = device_limits(roots)
+
+    def flush() -> None:
+        nonlocal processed_count, success_count
+        batch_success = process_files_batch(batch, session, known if full else None)
+        processed_count += len(batch)
+        success_count += batch_success
+        if on_batch:
+            on_batch(len(batch), batch_success)
+        batch.clear()
+
+    def wanted(name: str, root: Path, path: Path) -> bool:
+        match = known_audio(known, name, root, path)
+        if match is None:
+            return True
+        seen.add(match[0])
+        return full
+
+    files = (
+        (name, root, path)
+        for name, root, path in scan_roots(roots, limits)
+        if wanted(name, root, path)
+    )
+    cancelled = False
+    try:
+        for scanned in parse_files(files, limits=limits):
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            if scanned.metadata.get("not_audio"):
+                stats.count("skipped")
+                continue
+            batch.append(scanned)
+            if len(batch) >= BATCH_SIZE:
+                flush()
+    finally:
+        # Also on KeyboardInterrupt: already parsed files are kept, and the
+        # next run skips everything that made it into the database.
+        if batch:
+            flush()
+    # A root or folder that could not be read is not a reason to drop its files
+    if full and not cancelled and not stats.counters.get("walk_errors"):
+        remove_missing(session, roots, known, seen)
+    return processed_count, success_count
 
-    # Initialize session
-    session = db.SessionLocal()
 
-    try:
-        # Cache existing artists and albums
-        log_and_print("INFO", "Caching existing artists and albums...")
-        for artist in session.query(db.Artist).all():
-            artist_cache[artist.name] = artist.uuid
+def reset_state() -> None:
+    """
+    Clears the caches and statistics of a previous run in this process
+    """
+    global stats
+    artists.reset()
+    albums.reset()
+    fingerprint_index.clear()
+    genre_links.reset()
+    stats = BuilderStats()
 
-        for album in session.query(db.Album).all():
-            album_cache[album.name] = album.uuid
-        log_and_print(
-            "OK", f"Cached {len(artist_cache)} artists and {len(album_cache)} albums"
+
+def cache_library(session) -> None:
+    """
+    Indexes existing artists and albums by name
+    """
+    artists.load(session)
+    albums.load(session)
+    stats.count("resolver_bytes", artists.memory() + albums.memory())
+
+
+def genres_missing(session) -> bool:
+    """
+    Whether the library has genre tags but no genre index yet
+    """
+    if session.query(db.Genre.uuid).first() is not None:
+        return False
+    return session.query(db.Track.uuid).filter(db.Track.genre.isnot(None)).first() is not None
+
+
+def run_scan(
+    full: bool = False,
+    cancel: Optional[CancelFlag] = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    roots: Optional[Dict[str, Path]] = None,
+    estimate: bool = False,
+) -> Dict[str, Any]:
+    """
+    Runs one library scan, used by the command line and by scan jobs
+
+    Args:
+        full (bool): Re-read known files and drop missing ones, see build_library
+        cancel (Event, optional): Stops the scan once set
+        progress (Callable, optional): Called with the progress dict after
+            every stage change and committed batch
+        roots (dict, optional): Media roots to scan, the configured ones by default
+        estimate (bool): Count the audio files first, for a progress total
+
+    Returns:
+        dict: Final progress: stage, total, processed, added, errors, elapsed
+        and files_per_second
+    """
+    reset_state()
+    db.init_db()
+    roots = get_roots() if roots is None else roots
+    started = time.time()
+    state: Dict[str, Any] = {
+        "stage": "starting",
+        "full": full,
+        "total": None,
+        "processed": 0,
+        "added": 0,
+        "errors": 0,
+    }
+
+    def report(stage: Optional[str] = None) -> None:
+        if stage:
+            state["stage"] = stage
+        elapsed = time.time() - started
+        state["elapsed"] = round(elapsed, 3)
+        state["files_per_second"] = (
+            round(state["processed"] / elapsed, 2) if elapsed > 0 else 0.0
         )
+        state["errors"] = (
+            state["processed"] - state["added"] + stats.counters.get("walk_errors", 0)
+        )
+        if progress:
+            progress(dict(state))
 
-        # Process files
-        log_and_print("INFO", f"Scanning {MEDIA_FOLDER} for audio files...")
+    if estimate:
+        report("estimating")
+        with stats.stage("estimate"):
+            state["total"] = sum(get_audio_file_count(root) for root in roots.values())
 
-        file_generator = traverse_directory(MEDIA_FOLDER, filter_=isAudioFile)
+    session = db.SessionLocal()
+    changelog.enable(session)
+    try:
+        report("caching")
+        cache_library(session)
+        if genres_missing(session):
+            report("genres")
+            with stats.stage("genres"):
+                state["genres_linked"] = genre_links.rebuild(session)
+
+        def on_batch(size: int, batch_success: int) -> None:
+            state["processed"] += size
+            state["added"] += batch_success
+            report()
+
+        report("scanning")
+        build_library(roots, session, on_batch, full=full, cancel=cancel)
+        stats.count("resolve_queries", artists.queries + albums.queries)
+        cancelled = cancel is not None and cancel.is_set()
+
+        if not cancelled and similar.available():
+            report("similar")
+            with stats.stage("similar"):
+                state["indexed"] = similar.build_index(session)
+
+        # Before compacting, so playlists can still catch up from the log
+        report("playlists")
+        with stats.stage("playlists"):
+            import playlists  # Pulls in pydantic, only needed here
+
+            state["playlists"] = playlists.refresh_all(session)
+
+        report("compacting")
+        state["compacted"] = changelog.compact(session)
+        state["removed"] = stats.counters.get("removed", 0)
+        report("cancelled" if cancelled else "done")
+    finally:
+        session.close()
+    return state
 
-        # Skip files until checkpoint if resuming
-        if last_processed:
-            for i, file_path in enumerate(file_generator):
-                if str(file_path.absolute()) == last_processed:
-                    log_and_print(
-                        "OK", f"Skipped {i+1} previously processed files"
-                    )
-                    break
-
-        # Process remaining files with progress bar
-        batch = []
-        processed_count = 0
-        success_count = 0
-
-        with tqdm(total=estimated_total, desc="Processing files") as pbar:
-            for file_path in file_generator:
-                batch.append(file_path)
-
-                if len(batch) >= BATCH_SIZE:
-                    batch_success = process_files_batch(batch, session)
-                    success_count += batch_success
-                    processed_count += len(batch)
-                    pbar.update(len(batch))
-
-                    # Save checkpoint
-                    save_checkpoint(str(batch[-1].absolute()))
-
-                    # Calculate and display stats
-                    elapsed = time.time() - start_time
-                    files_per_second = processed_count / elapsed if elapsed > 0 else 0
-                    success_rate = (
-                        (success_count / processed_count * 100)
-                        if processed_count > 0
-                        else 0
-                    )
 
-                    log_and_print(
-                        "INFO",
-                        f"Processed {processed_count} files ({files_per_second:.2f} files/sec), {success_rate:.1f}% success",
-                    )
+def main(full: bool = False):
+    from tqdm import tqdm  # For progress bars
 
-                    batch = []
+    configure_logging()
+    log_and_print("INFO", "Hello from HeavyMetal library builder!")
 
-            # Process remaining files
-            if batch:
-                batch_success = process_files_batch(batch, session)
-                success_count += batch_success
-                processed_count += len(batch)
-                pbar.update(len(batch))
-                save_checkpoint(str(batch[-1].absolute()))
+    roots = get_roots()
+    for name, root in roots.items():
+        log_and_print("INFO", f"Media root {name}: {root}")
+
+    pbar = tqdm(desc="Processing files")
+    stage = None
+
+    def progress(state: Dict[str, Any]) -> None:
+        nonlocal stage
+        if state["stage"] != stage:
+            stage = state["stage"]
+            log_and_print("INFO", f"Stage: {stage}")
+            if stage == "caching" and state["total"] is not None:
+                log_and_print("OK", f"Estimated {state['total']} audio files")
+                pbar.total = state["total"]
+                pbar.refresh()
+        if stage == "scanning" and state["processed"] > pbar.n:
+            pbar.update(state["processed"] - pbar.n)
+            success_rate = state["added"] / state["processed"] * 100
+            log_and_print(
+                "INFO",
+                f"Processed {state['processed']} files ({state['files_per_second']:.2f} files/sec), {success_rate:.1f}% success",
+            )
+
+    try:
+        with pbar:
+            state = run_scan(full=full, progress=progress, roots=roots, estimate=True)
 
         # Final stats
-        elapsed = time.time() - start_time
-        elapsed_str = str(datetime.timedelta(seconds=int(elapsed)))
-        files_per_second = processed_count / elapsed if elapsed > 0 else 0
+        processed_count = state["processed"]
+        success_count = state["added"]
+        elapsed_str = str(datetime.timedelta(seconds=int(state["elapsed"])))
         success_rate = (
             (success_count / processed_count * 100) if processed_count > 0 else 0
         )
 
         log_and_print("OK", "Database build complete!")
         log_and_print("OK", f"Processed {processed_count} files in {elapsed_str}")
-        log_and_print("OK", f"Average speed: {files_per_second:.2f} files/second")
+        log_and_print("OK", f"Average speed: {state['files_per_second']:.2f} files/second")
         log_and_print("OK", f"Success rate: {success_rate:.1f}%")
         log_and_print("OK", f"Successful entries: {success_count}")
-
-        # Clean up checkpoint if completed successfully
-        if os.path.exists(CHECKPOINT_FILE):
-            os.remove(CHECKPOINT_FILE)
+        if state.get("removed"):
+            log_and_print("OK", f"Removed {state['removed']} missing files")
+        for line in stats.summary_lines():
+            log_and_print("INFO", line)
+
+        if "indexed" in state:
+            log_and_print("OK", f"Indexed {state['indexed']} tracks for similar track search")
+        elif not similar.available():
+            log_and_print("WARNING", "NumPy is not installed, skipping the similarity index")
+        if state.get("compacted"):
+            log_and_print("INFO", f"Compacted {state['compacted']} old change log entries")
 
     except KeyboardInterrupt:
-        log_and_print("WARNING", "Process interrupted! Saving progress...")
-        if batch:
-            process_files_batch(batch, session)
-            if batch:
-                save_checkpoint(str(batch[-1].absolute()))
+        log_and_print(
+            "WARNING", "Process interrupted! Files added so far are kept, rerun to resume."
+        )
     except Exception as e:
         log_and_print("ERROR", f"Error during database build: {e}")
         logger.exception("Fatal error during database build")
-    finally:
-        session.close()
+
+
+def run(
+    profile: Optional[str] = None,
+    report_path: Optional[str] = None,
+    profile_output: Optional[str] = None,
+    full: bool = False,
+) -> Dict[str, Any]:
+    """
+    Runs the builder, optionally under a profiler, and returns the stage report
+
+    Args:
+        profile (str, optional): "cprofile" or "sampling"
+        report_path (str, optional): Where to write the JSON report
+        profile_output (str, optional): Where cProfile dumps its stats
+        full (bool): Re-read every file instead of only adding new ones
+    """
+    with profiled(profile, profile_output) as profile_result:
+        main(full)
+
+    extra: Dict[str, Any] = {
+        "media_roots": {name: str(root) for name, root in get_roots().items()}
+    }
+    if "sampling" in profile_result:
+        extra["sampling"] = profile_result["sampling"]
+    if "cprofile" in profile_result:
+        print(profile_result["cprofile"])
+    if report_path:
+        stats.write_report(report_path, extra)
+        log_and_print("OK", f"Report written to {report_path}")
+    return {**stats.report(), **extra}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="HeavyMetal library builder")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-read files already in the database and remove missing ones",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sampling"],
+        default=None,
+        help="Profile the run with cProfile or the sampling profiler",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default="library_builder.prof",
+        help="Where cProfile stats are dumped",
+    )
+    parser.add_argument(
+        "--report",
+        default=os.getenv("BUILDER_REPORT"),
+        help="Write a JSON report with per-stage timings to this path",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    if not MEDIA_FOLDER:
+    args = parse_args()
+    if not get_roots():
         log_and_print(
             "ERROR",
-            "Please set MEDIA_FOLDER environment variable either in the .env file or as a system variable.",
+            "Please set MEDIA_ROOTS (or MEDIA_FOLDER) environment variable either in the .env file or as a system variable.",
         )
         exit(1)
-    else:
-        log_and_print("OK", f"{MEDIA_FOLDER=}")
-    main()
-    print(f"{CODES['OK']} Logs have been written to {filename}")
+    run(args.profile, args.report, args.profile_output, args.full)
+    print(f"{CODES['OK']} Logs have been written to {config.get_settings().log_file}")
@@ -0,0 +1,161 @@
+"""
+Full catalog export, streamed in constant memory.
+
+Tracks are read joined with their album, artist and audio rows through a
+streaming cursor, encoded one record at a time, grouped into ~64 KiB chunks
+and optionally gzip-compressed on the fly, so the size of the catalog never
+shows up in the memory footprint.
+"""
+
+import json
+import struct
+import zlib
+from typing import Any, Dict, Generator, Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import db
+
+CHUNK_SIZE = 64 * 1024
+YIELD_PER = 1000
+
+FIELDS = (
+    "uuid",
+    "name",
+    "genre",
+    "album",
+    "album_name",
+    "artist",
+    "artist_name",
+    "audio",
+    "audio_name",
+    "root",
+    "path",
+)
+
+
+def iter_catalog(session: Session) -> Generator[Dict[str, Any], None, None]:
+    """
+    Yields every track joined with its album, artist and audio fields
+
+    Paths are exported as stored, relative to the media root named by `root`
+    (None for absolute paths), so they stay valid when a root is moved and do
+    not reveal where the library lives on the server.
+    """
+    stmt = (
+        select(
+            db.Track.uuid,
+            db.Track.name,
+            db.Track.genre,
+            db.Track.album,
+            db.Album.name,
+            db.Track.artist,
+            db.Artist.name,
+            db.Track.audio,
+            db.Audio.name,
+            db.Audio.root,
+            db.Audio.path,
+        )
+        .outerjoin(db.Album, db.Album.uuid == db.Track.album)
+        .outerjoin(db.Artist, db.Artist.uuid == db.Track.artist)
+        .outerjoin(db.Audio, db.Audio.uuid == db.Track.audio)
+        .execution_options(stream_results=True, yield_per=YIELD_PER)
+    )
+    for row in session.execute(stmt):
+        yield dict(zip(FIELDS, row, strict=True))
+
+
+def encode_ndjson(records: Iterable[Dict[str, Any]]) -> Generator[bytes, None, None]:
+    for record in records:
+        yield (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+
+def _pack(value: Any) -> bytes:
+    # Just enough MessagePack for export records: nil, bool, int, str, map
+    if value is None:
+        return b"\xc0"
+    if value is True:
+        return b"\xc3"
+    if value is False:
+        return b"\xc2"
+    if isinstance(value, int):
+        if 0 <= value < 0x80:
+            return struct.pack("B", value)
+        return b"\xd3" + struct.pack(">q", value)
+    if isinstance(value, str):
+        data = value.encode()
+        size = len(data)
+        if size < 32:
+            return struct.pack("B", 0xA0 | size) + data
+        if size < 0x100:
+            return b"\xd9" + struct.pack("B", size) + data
+        if size < 0x10000:
+            return b"\xda" + struct.pack(">H", size) + data
+        return b"\xdb" + struct.pack(">I", size) + data
+    if isinstance(value, dict):
+        size = len(value)
+        header = (
+            struct.pack("B", 0x80 | size)
+            if size < 16
+            else b"\xde" + struct.pack(">H", size)
+        )
+        return header + b"".join(_pack(k) + _pack(v) for k, v in value.items())
+    raise TypeError(f"Cannot pack {type(value).__name__}")
+
+
+def encode_binary(records: Iterable[Dict[str, Any]]) -> Generator[bytes, None, None]:
+    """
+    Encodes every record as a MessagePack map prefixed with its length as a
+    4 byte big-endian unsigned integer
+    """
+    for record in records:
+        data = _pack(record)
+        yield struct.pack(">I", len(data)) + data
+
+
+def chunked(
+    parts: Iterable[bytes], size: int = CHUNK_SIZE
+) -> Generator[bytes, None, None]:
+    buffer = bytearray()
+    for part in parts:
+        buffer += part
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def gzipped(parts: Iterable[bytes], level: int = 6) -> Generator[bytes, None, None]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_export(
+    fmt: str = "ndjson", gzip: bool = False, session: Optional[Session] = None
+) -> Generator[bytes, None, None]:
+    """
+    Streams the whole catalog
+
+    Args:
+        fmt (str): "ndjson" or "binary" (length-prefixed MessagePack)
+        gzip (bool): Compress the stream with gzip
+        session (Session, optional): Session to read from, a new one is opened
+            (and closed) when omitted
+    """
+    owns_session = session is None
+    session = session or db.ReadSession()
+    try:
+        encoder = encode_binary if fmt == "binary" else encode_ndjson
+        stream = chunked(encoder(iter_catalog(session)))
+        if gzip:
+            stream = gzipped(stream)
+        yield from stream
+    finally:
+        if owns_session:
+            session.close()
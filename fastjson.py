@@ -0,0 +1,228 @@
+"""
+Fast JSON responses for large catalog listings.
+
+Rows are read straight off the cursor as column tuples and encoded one at a
+time (orjson when installed, the json module otherwise), without building
+ORM objects, dicts for response_model validation or Pydantic models.
+
+Listings only change when the library does, so they are cached per URL
+together with the library generation (changelog.current_seq). The cache
+keeps the encoded body and every compressed variant built so far, gzip or
+brotli are negotiated from Accept-Encoding, and the generation doubles as
+a weak ETag, shared by every encoding of the body, so clients that already
+hold the listing get a 304. Bodies larger than JSON_CACHE_MAX_BODY are
+streamed instead, gzipped when the client accepts gzip.
+
+orjson and brotli are dependencies, but the module still works without them.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import changelog
+import db
+from cache import TTLCache
+from export import chunked, gzipped
+from metrics import register_cache
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import brotli  # type: ignore[import-untyped, import-not-found]
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+JSON_CACHE_SIZE = int(os.getenv("JSON_CACHE_SIZE", "256"))
+JSON_CACHE_MAX_BODY = int(os.getenv("JSON_CACHE_MAX_BODY", str(16 * 1024 * 1024)))
+JSON_CACHE_TTL = 3600  # Entries of an older generation are rebuilt before that
+GZIP_LEVEL = 6
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+MIN_COMPRESS_SIZE = 1024
+
+MEDIA_TYPE = "application/json"
+
+Rows = Callable[[Session], Iterable[Sequence[Any]]]
+
+json_cache = TTLCache(maxsize=JSON_CACHE_SIZE, ttl=JSON_CACHE_TTL)
+register_cache("json", json_cache)
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def encode_rows(rows: Iterable[Sequence[Any]], fields: Sequence[str]) -> Iterator[bytes]:
+    """
+    Encodes column tuples as a JSON array of objects, one row at a time
+    """
+    separator = b"["
+    for row in rows:
+        yield separator
+        yield dumps(dict(zip(fields, row, strict=True)))
+        separator = b","
+    yield b"]" if separator == b"," else b"[]"
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """
+    The content codings an Accept-Encoding header allows
+    """
+    accepted = set()
+    for token in accept_encoding.replace(" ", "").lower().split(","):
+        coding, _, params = token.partition(";")
+        if params not in ("q=0", "q=0.0"):
+            accepted.add(coding)
+    return accepted
+
+
+def negotiate(accepted: Set[str]) -> Optional[str]:
+    """
+    Picks brotli or gzip from the accepted codings, None for identity
+    """
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+
+class _Entry:
+    __slots__ = ("generation", "variants")
+
+    def __init__(self, generation: int, body: bytes):
+        self.generation = generation
+        self.variants: Dict[Optional[str], bytes] = {None: body}
+
+    def get(self, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        body = self.variants[None]
+        if encoding is None or len(body) < MIN_COMPRESS_SIZE:
+            return body, None
+        variant = self.variants.get(encoding)
+        if variant is None:
+            # Racing requests may both compress, the result is the same
+            variant = self.variants[encoding] = compress(body, encoding)
+        return variant, encoding
+
+
+def _etag(key: str, generation: int) -> str:
+    # Weak, the identity, gzip and brotli bodies are equivalent, not equal
+    digest = hashlib.blake2b(key.encode(), digest_size=6).hexdigest()
+    return f'W/"{generation}-{digest}"'
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Weak comparison of If-None-Match with an ETag, proxies may weaken tags
+    """
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def _build(
+    key: str, rows: Rows, fields: Sequence[str], if_none_match: Optional[str]
+) -> Tuple[str, Optional[_Entry], Optional[Iterator[bytes]]]:
+    """
+    Returns the ETag and either the cached entry or, for bodies too large to
+    cache, a stream of the body. Neither when the client's copy is current.
+    """
+    session = db.ReadSession()
+    streaming = False
+    try:
+        generation = changelog.current_seq(session)
+        etag = _etag(key, generation)
+        if _matches(if_none_match, etag):
+            return etag, None, None
+        entry = json_cache.get(key)
+        if entry is not None and entry.generation == generation:
+            return etag, entry, None
+        parts = encode_rows(rows(session), fields)
+        body = bytearray()
+        for part in parts:
+            body += part
+            if len(body) > JSON_CACHE_MAX_BODY:
+                streaming = True  # The stream closes the session
+                return etag, None, _resume(bytes(body), parts, session)
+        entry = _Entry(generation, bytes(body))
+        json_cache.set(key, entry)
+        return etag, entry, None
+    finally:
+        if not streaming:
+            session.close()
+
+
+def _resume(head: bytes, parts: Iterator[bytes], session: Session) -> Iterator[bytes]:
+    try:
+        yield head
+        yield from parts
+    finally:
+        session.close()
+
+
+async def listing_response(request: Request, rows: Rows, fields: Sequence[str]) -> Response:
+    """
+    Serves a catalog listing through the cache, see the module docstring
+
+    Args:
+        request (Request): The request, its URL is the cache key
+        rows (Callable): Called with a read session on a cache miss, returns
+            the rows as column tuples
+        fields (Sequence[str]): The JSON key of every column
+
+    Returns:
+        Response: The listing, or 304 Not Modified when the client's ETag matches
+    """
+    key = f"{request.url.path}?{request.url.query}"
+    etag, entry, stream = await run_in_threadpool(
+        _build, key, rows, fields, request.headers.get("If-None-Match")
+    )
+    accepted = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    encoding = negotiate(accepted)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if stream is not None:
+        stream = chunked(stream)
+        if "gzip" in accepted:
+            # Too large to compress up front, gzip keeps the window small
+            stream = gzipped(stream, GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(stream, media_type=MEDIA_TYPE, headers=headers)
+    if entry is None:
+        return Response(status_code=304, headers=headers)
+    body, used = await run_in_threadpool(entry.get, encoding)
+    if used is not None:
+        headers["Content-Encoding"] = used
+    return Response(body, media_type=MEDIA_TYPE, headers=headers)
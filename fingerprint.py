@@ -0,0 +1,77 @@
+"""
+Staged content fingerprints used to find duplicate audio files.
+
+Comparing full hashes of every file would read the whole library a second
+time, so files are compared in stages and each stage only runs when the
+cheaper one before it collides:
+
+1. size, from the one fstat of the file the builder does while parsing
+2. quick hash of a head, middle and tail block, the head being the one
+   the tag reader already read
+3. full content hash
+
+Files no larger than the three blocks are read whole by the quick hash,
+which then doubles as their full hash.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+BLOCK_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def _digest() -> "hashlib.blake2b":
+    return hashlib.blake2b(digest_size=16)
+
+
+def quick_hash(
+    path: Path,
+    size: Optional[int] = None,
+    read: Optional[Callable[[int, int], bytes]] = None,
+) -> Tuple[int, str, bool]:
+    """
+    Hashes the size and the head, middle and tail blocks of a file
+
+    Args:
+        path (Path): The file to fingerprint
+        size (int, optional): Its size, stat'ed here if omitted
+        read (Callable, optional): Reads (offset, length) from the file when
+            it is already open, with `size` given; it is opened here otherwise
+
+    Returns:
+        Tuple[int, str, bool]: Size, hex digest and whether the whole file
+        was hashed (the digest is then also the full hash)
+    """
+    if read is None or size is None:
+        with open(path, "rb") as f:
+
+            def read_file(offset: int, length: int) -> bytes:
+                f.seek(offset)
+                return f.read(length)
+
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            return quick_hash(path, size, read_file)
+
+    digest = _digest()
+    if size <= 3 * BLOCK_SIZE:
+        digest.update(read(0, size))
+        return size, digest.hexdigest(), True
+    digest.update(size.to_bytes(8, "big"))
+    for offset in (0, (size - BLOCK_SIZE) // 2, size - BLOCK_SIZE):
+        digest.update(read(offset, BLOCK_SIZE))
+    return size, digest.hexdigest(), False
+
+
+def full_hash(path: Path) -> str:
+    """
+    Hashes the whole file, only needed once quick hashes collide
+    """
+    digest = _digest()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
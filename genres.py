@@ -0,0 +1,222 @@
+"""
+Normalized genre taxonomy with facet counts.
+
+Genre tags are free text: "Heavy Metal", "heavy metal" and "Metal; Rock"
+would all be different genres. The builder splits each tag on the usual
+separators and folds every part to a key (case, diacritics, hyphens), so
+the genres table holds one row per key, and track_genres links every track
+that is not a duplicate to its genres.
+
+Track counts per genre and per genre and artist are kept up to date as
+tracks are linked and unlinked: the deltas of a batch are summed in memory
+and written with one statement per table before the batch commits, so
+facets never count rows at request time.
+"""
+
+import re
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, delete, insert, select, update
+
+import db
+from suggest import fold
+
+# ID3 and Vorbis multi-value separators ("\x00" is how tagreader joins values)
+SEPARATORS = re.compile(r"[;,|/\\\x00]")
+# ID3v1 genre references like "(17)Rock", the text after them is kept
+ID3V1_REFERENCE = re.compile(r"^\(\d+\)")
+MAX_GENRES = 8  # Per track, guards against tags that are really lists of moods
+REBUILD_BATCH = 5000
+
+
+def genre_key(name: str) -> str:
+    """
+    Folds a genre name to the key it is deduplicated on, "Hip-Hop" -> "hip hop"
+    """
+    return " ".join(fold(name).replace("-", " ").replace("_", " ").split())
+
+
+def split_genres(raw: Optional[str]) -> List[Tuple[str, str]]:
+    """
+    Splits a genre tag into (key, display name) pairs, without duplicates
+
+    Args:
+        raw (str, optional): The genre tag as read from the file
+
+    Returns:
+        List[Tuple[str, str]]: The genres in tag order
+    """
+    if not raw:
+        return []
+    genres: Dict[str, str] = {}
+    for part in SEPARATORS.split(ID3V1_REFERENCE.sub("", raw.strip()) or raw):
+        name = " ".join(part.split())
+        key = genre_key(name)
+        if key and key not in genres:
+            genres[key] = name
+    return list(genres.items())[:MAX_GENRES]
+
+
+def _add_counts(session, table, keys: List[str], rows: List[Dict]) -> None:
+    # Adds rows[i]["tracks"] to the row with the same keys, inserting it if needed
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        # The dialect modules are imported here, postgresql pulls in asyncio
+        from sqlalchemy.dialects import postgresql, sqlite
+
+        module = sqlite if dialect == "sqlite" else postgresql
+        stmt = module.insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c[key] for key in keys],
+            set_={"tracks": table.c.tracks + stmt.excluded.tracks},
+        )
+        session.execute(stmt, rows)
+        return
+    for row in rows:
+        condition = [table.c[key] == row[key] for key in keys]
+        result = session.execute(
+            update(table).where(*condition).values(tracks=table.c.tracks + row["tracks"])
+        )
+        if result.rowcount == 0:
+            session.execute(insert(table), [row])
+
+
+class GenreLinker:
+    """
+    Links tracks to genres for the builder and keeps the facet counts,
+    call apply() before every commit and reset() after a rollback
+    """
+
+    def __init__(self):
+        self.genres: Dict[str, str] = {}  # key -> genre uuid
+        self._loaded = False
+        self._genre_deltas: Dict[str, int] = defaultdict(int)
+        self._artist_deltas: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def reset(self) -> None:
+        self.genres.clear()
+        self._loaded = False
+        self._genre_deltas.clear()
+        self._artist_deltas.clear()
+
+    def _genre(self, session, key: str, name: str) -> str:
+        if not self._loaded:
+            self.genres.update(session.execute(select(db.Genre.key, db.Genre.uuid)).tuples().all())
+            self._loaded = True
+        genre_uuid = self.genres.get(key)
+        if genre_uuid is None:
+            genre_uuid = str(uuid.uuid4())
+            session.add(db.Genre(uuid=genre_uuid, key=key, name=name, tracks=0))
+            self.genres[key] = genre_uuid
+        return genre_uuid
+
+    def link(
+        self, session, track_uuid: str, artist_uuid: Optional[str], raw: Optional[str]
+    ) -> int:
+        """
+        Links a track to the genres of its tag
+
+        Returns:
+            int: Number of genres linked
+        """
+        genres = split_genres(raw)
+        for key, name in genres:
+            genre_uuid = self._genre(session, key, name)
+            session.add(db.TrackGenre(track=track_uuid, genre=genre_uuid))
+            self._genre_deltas[genre_uuid] += 1
+            if artist_uuid is not None:
+                self._artist_deltas[(genre_uuid, artist_uuid)] += 1
+        return len(genres)
+
+    def unlink(self, session, tracks: Dict[str, Optional[str]]) -> None:
+        """
+        Removes the genre links of tracks
+
+        Args:
+            session: SQLAlchemy database session
+            tracks (dict): Track uuids mapped to the artist they were
+                counted under
+        """
+        if not tracks:
+            return
+        session.flush()  # Links added earlier in this batch
+        links = session.execute(
+            select(db.TrackGenre.track, db.TrackGenre.genre).where(
+                db.TrackGenre.track.in_(list(tracks))
+            )
+        ).all()
+        for track_uuid, genre_uuid in links:
+            self._genre_deltas[genre_uuid] -= 1
+            artist_uuid = tracks[track_uuid]
+            if artist_uuid is not None:
+                self._artist_deltas[(genre_uuid, artist_uuid)] -= 1
+        session.execute(delete(db.TrackGenre).where(db.TrackGenre.track.in_(list(tracks))))
+
+    def apply(self, session) -> None:
+        """
+        Writes the summed count changes of the current batch
+        """
+        # New genres and links have to exist before their counts change
+        session.flush()
+        genre_rows = [
+            {"genre": genre_uuid, "delta": delta}
+            for genre_uuid, delta in self._genre_deltas.items()
+            if delta
+        ]
+        if genre_rows:
+            table = db.Genre.__table__
+            session.execute(
+                update(table)
+                .where(table.c.uuid == bindparam("genre"))
+                .values(tracks=table.c.tracks + bindparam("delta")),
+                genre_rows,
+            )
+        artist_rows = [
+            {"genre": genre_uuid, "artist": artist_uuid, "tracks": delta}
+            for (genre_uuid, artist_uuid), delta in self._artist_deltas.items()
+            if delta
+        ]
+        if artist_rows:
+            _add_counts(session, db.GenreArtist.__table__, ["genre", "artist"], artist_rows)
+        if any(delta < 0 for delta in self._artist_deltas.values()):
+            session.execute(delete(db.GenreArtist).where(db.GenreArtist.tracks <= 0))
+        self._genre_deltas.clear()
+        self._artist_deltas.clear()
+
+    def rebuild(self, session) -> int:
+        """
+        Relinks every track that is not a duplicate from scratch, used once
+        for libraries built before genres were normalized
+
+        Returns:
+            int: Number of tracks linked to at least one genre
+        """
+        session.execute(delete(db.TrackGenre))
+        session.execute(delete(db.GenreArtist))
+        session.execute(update(db.Genre).values(tracks=0))
+        self.reset()
+        linked = 0
+        last = ""
+        while True:
+            tracks = session.execute(
+                select(db.Track.uuid, db.Track.artist, db.Track.genre)
+                .outerjoin(db.Audio, db.Audio.uuid == db.Track.audio)
+                .where(
+                    db.Audio.canonical.is_(None),
+                    db.Track.genre.is_not(None),
+                    db.Track.uuid > last,
+                )
+                .order_by(db.Track.uuid)
+                .limit(REBUILD_BATCH)
+            ).all()
+            if not tracks:
+                break
+            for track_uuid, artist_uuid, raw in tracks:
+                linked += bool(self.link(session, track_uuid, artist_uuid, raw))
+            last = tracks[-1][0]
+            self.apply(session)
+            session.commit()
+        session.commit()
+        return linked
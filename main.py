@@ -1,14 +1,59 @@
+import asyncio
+import mimetypes
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
 
+import db
+import metrics
+import querylog
+from plays import plays
 from routes import router
+from scan_jobs import scan_jobs
+from security import require_metrics_access
+from similar import similar_tracks
+from suggest import suggestions
+from utils import get_hasher
+
+
+def warmup() -> None:
+    """
+    Primes per-process state so the first requests don't pay for it: the
+    engines, the lazily imported password hasher and the in-memory indexes
+    """
+    for engine in dict.fromkeys(db.get_engines()):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    mimetypes.init()
+    get_hasher()
+    suggestions.refresh()
+    similar_tracks.get()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Never reuse pooled connections inherited from a parent process
+    db.dispose_engines(close=False)
+    await run_in_threadpool(warmup)
+    play_flusher = asyncio.create_task(plays.run())
+    yield
+    play_flusher.cancel()
+    with suppress(asyncio.CancelledError):
+        await play_flusher
+    await run_in_threadpool(scan_jobs.shutdown)
+    db.dispose_engines()
+
 
 app = FastAPI(
     title="HeavyMetal Backend",
     description="Backend for HeavyMetal Music Streaming Service",
     port=8080,
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -19,9 +64,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+if querylog.enabled():
+    app.add_middleware(querylog.QueryLogMiddleware)
+db.on_engine(metrics.instrument_engine)
+db.on_engine(querylog.instrument_engine)
+
 app.include_router(router)
 
 
+@app.get(
+    "/metrics", include_in_schema=False, dependencies=[Depends(require_metrics_access)]
+)
+async def get_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/ping")
 async def ping():
     return {"message": "pong", "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
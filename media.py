@@ -0,0 +1,61 @@
+"""
+Media roots the library is scanned from.
+
+Audio rows store their file path relative to a named root, so a disk or
+NFS mount can move by updating MEDIA_ROOTS without rescanning:
+
+    MEDIA_ROOTS="disk1=/mnt/disk1/music,nfs=/mnt/nas/music"
+
+MEDIA_FOLDER is still honoured as a root named "default". Rows written
+before roots existed have no root and keep their absolute path.
+"""
+
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional
+
+
+def parse_roots(value: str) -> Dict[str, Path]:
+    """
+    Parses "name=/path,name2=/other/path", a bare path is named after its
+    last component
+    """
+    roots: Dict[str, Path] = {}
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, separator, path = entry.partition("=")
+        if not separator:
+            path = name
+            name = Path(name).name or name
+        roots[name.strip()] = Path(path.strip()).expanduser()
+    return roots
+
+
+@lru_cache(maxsize=1)
+def get_roots() -> Dict[str, Path]:
+    """
+    Returns the configured roots, read from the environment on first use
+    """
+    roots = parse_roots(os.getenv("MEDIA_ROOTS", ""))
+    legacy = os.getenv("MEDIA_FOLDER")
+    if legacy and "default" not in roots:
+        roots["default"] = Path(legacy).expanduser()
+    return roots
+
+
+def resolve_path(root: Optional[str], path: str) -> Optional[str]:
+    """
+    Turns a stored (root, path) pair into an absolute file path
+
+    Returns:
+        Optional[str]: The absolute path, None if the root is not configured
+    """
+    if not root:
+        return path
+    base = get_roots().get(root)
+    if base is None:
+        return None
+    return str(base / path)
@@ -0,0 +1,327 @@
+"""
+Minimal Prometheus-style metrics, rendered in the text exposition format.
+
+Metrics are plain in-process counters guarded by a lock, so recording one
+costs a dictionary lookup and an addition. Each worker process exposes its
+own values, scrape every worker (or aggregate by instance) when running
+with several workers.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: List[Any] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values, strict=True):
+        value = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _new_child(self) -> Any:
+        return _Value()
+
+    def labels(self, *values: str) -> Any:
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        for values, child in list(self._children.items()):
+            yield self.name, self.labelnames, values, child.value
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labelnames, values, value in self._samples():
+            lines.append(
+                f"{name}{_format_labels(labelnames, values)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> Any:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self):
+        bucket_labels = self.labelnames + ("le",)
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(
+                self.buckets + (float("inf"),), child.counts, strict=True
+            ):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    bucket_labels,
+                    values + (_format_value(bound),),
+                    cumulative,
+                )
+            yield f"{self.name}_sum", self.labelnames, values, child.sum
+            yield f"{self.name}_count", self.labelnames, values, cumulative
+
+
+class CallbackMetric(_Metric):
+    """
+    A metric whose samples are read from a callback at scrape time, for state
+    that is already tracked elsewhere (queue depths, cache statistics).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Iterable[Tuple[Sequence[str], float]]],
+        labelnames: Sequence[str] = (),
+        type: str = "gauge",  # noqa: A002
+    ):
+        self.callback = callback
+        self.type = type
+        super().__init__(name, documentation, labelnames)
+
+    def _samples(self):
+        for values, value in self.callback():
+            yield self.name, self.labelnames, tuple(values), value
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# HTTP
+
+REQUEST_LATENCY = Histogram(
+    "heavymetal_request_duration_seconds",
+    "Time spent handling a request, until the response body is sent",
+    ("method", "route", "status"),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "heavymetal_requests_in_flight", "Requests currently being handled"
+)
+
+# SQL
+
+SQL_STATEMENTS = Counter(
+    "heavymetal_sql_statements_total", "SQL statements executed"
+)
+SQL_DURATION = Counter(
+    "heavymetal_sql_duration_seconds_total", "Time spent executing SQL statements"
+)
+SQL_STATEMENTS_PER_REQUEST = Histogram(
+    "heavymetal_sql_statements_per_request",
+    "SQL statements executed while handling a request",
+    ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+SQL_TIME_PER_REQUEST = Histogram(
+    "heavymetal_sql_time_per_request_seconds",
+    "Time spent in SQL while handling a request",
+    ("route",),
+)
+
+# Streaming
+
+STREAM_BYTES = Counter("heavymetal_stream_bytes_total", "Audio bytes streamed")
+ACTIVE_STREAMS = Gauge("heavymetal_active_streams", "Audio streams in progress")
+
+# [statements, seconds] of the request being handled, shared with the
+# threadpool through the copied context.
+_request_sql: ContextVar[Optional[list]] = ContextVar("request_sql", default=None)
+
+
+def register_cache(name: str, cache: Any) -> None:
+    """
+    Exposes the hits, misses and size of a cache with hits/misses attributes
+    """
+    CallbackMetric(
+        f"heavymetal_cache_{name}_hits_total",
+        f"Lookups served from the {name} cache",
+        lambda: [((), cache.hits)],
+        type="counter",
+    )
+    CallbackMetric(
+        f"heavymetal_cache_{name}_misses_total",
+        f"Lookups that missed the {name} cache",
+        lambda: [((), cache.misses)],
+        type="counter",
+    )
+    CallbackMetric(
+        f"heavymetal_cache_{name}_entries",
+        f"Entries currently held by the {name} cache",
+        lambda: [((), len(cache))],
+    )
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Counts statements and time spent in SQL, globally and per request
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        SQL_STATEMENTS.inc()
+        SQL_DURATION.inc(elapsed)
+        stats = _request_sql.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, in-flight requests and SQL usage per
+    route. Routes are labelled by their path template to bound cardinality.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        stats = [0, 0.0]
+        token = _request_sql.set(stats)
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            _request_sql.reset(token)
+            route = scope.get("route")
+            route_name = getattr(route, "path", None) or "unmatched"
+            REQUEST_LATENCY.labels(scope["method"], route_name, status).observe(
+                elapsed
+            )
+            SQL_STATEMENTS_PER_REQUEST.labels(route_name).observe(stats[0])
+            SQL_TIME_PER_REQUEST.labels(route_name).observe(stats[1])
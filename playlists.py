@@ -0,0 +1,471 @@
+"""
+Static and smart playlists.
+
+Both kinds keep their tracks in playlist_entries as an ordered array,
+(playlist, position) is the primary key, so a page is one index range read
+after the last position the client has seen.
+
+Smart playlists store their rules (schemas.SmartRules) and are compiled
+into a query over tracks, albums, artists and genres whose conditions all
+have an index to go through. The result is materialized with one INSERT ...
+SELECT together with the library generation it reflects. When the
+generation moves on, only the tracks the change log names are checked
+against the rules: a change that does not touch the playlist just bumps
+its generation, tracks that stopped matching are dropped in place, and
+only a track that newly matches (or a changed sort key) re-runs the query.
+
+Play counts are not part of the library generation, playlists that filter
+or sort on them are rematerialized once they are PLAYLIST_PLAYS_MAX_AGE
+seconds old.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Set, cast
+
+from sqlalchemy import (
+    CursorResult,
+    and_,
+    delete,
+    func,
+    insert,
+    literal,
+    not_,
+    or_,
+    select,
+)
+from sqlalchemy.orm import Session
+
+import changelog
+import db
+from genres import genre_key
+from schemas import PlaylistRule, SmartRules
+
+PLAYLIST_MAX_TRACKS = int(os.getenv("PLAYLIST_MAX_TRACKS", "10000"))
+PLAYLIST_PLAYS_MAX_AGE = float(os.getenv("PLAYLIST_PLAYS_MAX_AGE", "900"))
+# Change log entries checked one by one, a longer backlog rematerializes
+PLAYLIST_INCREMENTAL_LIMIT = int(os.getenv("PLAYLIST_INCREMENTAL_LIMIT", "5000"))
+IN_CHUNK = 500  # Bound parameters per IN (...)
+
+TEXT_FIELDS = {"name", "artist", "album", "genre"}
+TEXT_OPS = {"is", "is_not", "contains", "starts_with"}
+NUMBER_OPS = {"is", "is_not", "gt", "gte", "lt", "lte", "between"}
+PLAY_FIELDS = {"plays", "last_played"}
+
+logger = logging.getLogger(__name__)
+
+
+class PlaylistError(ValueError):
+    """Raised for rules that do not compile and unknown tracks."""
+
+
+def _plays():
+    return func.coalesce(db.PlayCount.plays, 0)
+
+
+ORDERS = {
+    "album": lambda: (
+        db.Track.artist,
+        db.Track.year,
+        db.Track.album,
+        db.Track.disc,
+        db.Track.track_number,
+    ),
+    "name": lambda: (db.Track.name,),
+    "year": lambda: (db.Track.year,),
+    "plays": lambda: (_plays(),),
+    "last_played": lambda: (db.PlayCount.last_played,),
+}
+
+
+def _compare(column, op: str, value):
+    if op == "is":
+        return column == value
+    if op == "is_not":
+        return column != value
+    if op == "contains":
+        return column.contains(value, autoescape=True)
+    if op == "starts_with":
+        return column.startswith(value, autoescape=True)
+    if op == "gt":
+        return column > value
+    if op == "gte":
+        return column >= value
+    if op == "lt":
+        return column < value
+    if op == "lte":
+        return column <= value
+    return column.between(value[0], value[1])
+
+
+def _check(rule: PlaylistRule) -> None:
+    if rule.field in TEXT_FIELDS:
+        if rule.op not in TEXT_OPS or not isinstance(rule.value, str):
+            raise PlaylistError(f"{rule.field} takes a text value and {sorted(TEXT_OPS)}")
+    elif rule.op not in NUMBER_OPS:
+        raise PlaylistError(f"{rule.field} takes a number and {sorted(NUMBER_OPS)}")
+    elif rule.op == "between":
+        if not isinstance(rule.value, list) or len(rule.value) != 2:
+            raise PlaylistError(f"between on {rule.field} takes [low, high]")
+    elif not isinstance(rule.value, (int, float)):
+        raise PlaylistError(f"{rule.field} takes a number")
+
+
+def _criterion(rule: PlaylistRule):
+    """
+    One rule as a condition on tracks. Names are matched through the name
+    indexes of artists and albums, genres through the genre key and the
+    (genre, track) index, so "is" never scans tracks.
+    """
+    _check(rule)
+    # "is not" is the negation of "is", so tracks without an artist, album
+    # or genre match it too
+    op = "is" if rule.op == "is_not" else rule.op
+    negate = rule.op == "is_not"
+    if rule.field == "name":
+        return _compare(db.Track.name, rule.op, rule.value)
+    if rule.field in ("artist", "album"):
+        model = db.Artist if rule.field == "artist" else db.Album
+        column = db.Track.artist if rule.field == "artist" else db.Track.album
+        condition = column.in_(select(model.uuid).where(_compare(model.name, op, rule.value)))
+        if negate:
+            # NOT IN is NULL, not true, for tracks without one
+            return or_(column.is_(None), not_(condition))
+    elif rule.field == "genre":
+        condition = db.Track.uuid.in_(
+            select(db.TrackGenre.track)
+            .join(db.Genre, db.Genre.uuid == db.TrackGenre.genre)
+            # _check only lets text values through for genres
+            .where(_compare(db.Genre.key, op, genre_key(cast(str, rule.value))))
+        )
+    else:
+        column = {
+            "year": db.Track.year,
+            "duration": db.Audio.duration,
+            "plays": _plays(),
+            "last_played": db.PlayCount.last_played,
+        }[rule.field]
+        return _compare(column, rule.op, rule.value)
+    return not_(condition) if negate else condition
+
+
+def uses_plays(rules: SmartRules) -> bool:
+    return rules.order in PLAY_FIELDS or any(rule.field in PLAY_FIELDS for rule in rules.rules)
+
+
+def compile_rules(rules: SmartRules, *criteria):
+    """
+    Compiles smart playlist rules to a select of matching track uuids, in
+    playlist order, duplicates excluded
+
+    Args:
+        rules (SmartRules): The playlist rules
+        *criteria: Extra conditions, like a set of tracks to check
+
+    Raises:
+        PlaylistError: If there are no rules or a rule uses an op its field
+            does not support
+    """
+    if not rules.rules:
+        # and_() and or_() without arguments are deprecated and ambiguous
+        raise PlaylistError("A smart playlist needs at least one rule")
+    conditions = [_criterion(rule) for rule in rules.rules]
+    matched = and_(*conditions) if rules.match == "all" else or_(*conditions)
+    stmt = (
+        select(db.Track.uuid)
+        .outerjoin(db.Audio, db.Audio.uuid == db.Track.audio)
+        .where(db.Audio.canonical.is_(None), matched, *criteria)
+    )
+    if uses_plays(rules):
+        stmt = stmt.outerjoin(db.PlayCount, db.PlayCount.track == db.Track.uuid)
+    return stmt.order_by(*ordering(rules))
+
+
+def ordering(rules: SmartRules) -> list:
+    columns = [
+        column.desc() if rules.descending else column for column in ORDERS[rules.order]()
+    ]
+    return [*columns, db.Track.uuid]
+
+
+def load_rules(playlist: db.Playlist) -> Optional[SmartRules]:
+    if playlist.rules is None:
+        return None
+    return SmartRules.model_validate_json(playlist.rules)
+
+
+def dump_rules(rules: SmartRules) -> str:
+    return rules.model_dump_json()
+
+
+def _chunks(values: Iterable[str]) -> Iterable[List[str]]:
+    values = list(values)
+    for start in range(0, len(values), IN_CHUNK):
+        yield values[start : start + IN_CHUNK]
+
+
+def _limit(rules: SmartRules) -> int:
+    return min(rules.limit or PLAYLIST_MAX_TRACKS, PLAYLIST_MAX_TRACKS)
+
+
+def set_tracks(session: Session, playlist: db.Playlist, tracks: List[str]) -> None:
+    """
+    Replaces the entries of a static playlist, tracks may repeat
+
+    Raises:
+        PlaylistError: If there are too many tracks or some do not exist
+    """
+    if len(tracks) > PLAYLIST_MAX_TRACKS:
+        raise PlaylistError(f"Playlists hold at most {PLAYLIST_MAX_TRACKS} tracks")
+    known: Set[str] = set()
+    for chunk in _chunks(set(tracks)):
+        known.update(session.scalars(select(db.Track.uuid).where(db.Track.uuid.in_(chunk))))
+    unknown = [track for track in tracks if track not in known]
+    if unknown:
+        raise PlaylistError(f"Unknown tracks: {', '.join(unknown[:10])}")
+    session.execute(delete(db.PlaylistEntry).where(db.PlaylistEntry.playlist == playlist.uuid))
+    if tracks:
+        session.execute(
+            insert(db.PlaylistEntry),
+            [
+                {"playlist": playlist.uuid, "position": position, "track": track}
+                for position, track in enumerate(tracks, 1)
+            ],
+        )
+    playlist.tracks = len(tracks)
+    playlist.generation = changelog.current_seq(session)
+
+
+def materialize(session: Session, playlist: db.Playlist, rules: SmartRules) -> None:
+    """
+    Rewrites the entries of a smart playlist from its rules, in one
+    INSERT ... SELECT
+    """
+    positions = func.row_number().over(order_by=ordering(rules))
+    rows = (
+        compile_rules(rules)
+        .with_only_columns(literal(playlist.uuid), positions, db.Track.uuid)
+        .limit(_limit(rules))
+    )
+    session.execute(delete(db.PlaylistEntry).where(db.PlaylistEntry.playlist == playlist.uuid))
+    result = cast(
+        CursorResult,
+        session.execute(
+            insert(db.PlaylistEntry).from_select(["playlist", "position", "track"], rows)
+        ),
+    )
+    playlist.tracks = max(result.rowcount, 0)
+    playlist.generation = changelog.current_seq(session)
+    playlist.refreshed = time.time()
+
+
+def _changed_tracks(
+    session: Session, since: int, rules: Optional[SmartRules]
+) -> Optional[Set[str]]:
+    """
+    The tracks that may have changed after generation `since`, None when
+    that is not known or too many to check one by one
+    """
+    oldest = session.query(func.min(db.ChangeLog.seq)).scalar() or 0
+    if since <= 0 or oldest > since + 1:
+        return None  # Compacted away
+    entries = session.execute(
+        select(db.ChangeLog.entity, db.ChangeLog.entity_uuid)
+        .where(db.ChangeLog.seq > since)
+        .order_by(db.ChangeLog.seq)
+        .limit(PLAYLIST_INCREMENTAL_LIMIT + 1)
+    ).all()
+    if len(entries) > PLAYLIST_INCREMENTAL_LIMIT:
+        return None
+    changed: Dict[str, Set[str]] = {}
+    for entity, entity_uuid in entries:
+        changed.setdefault(entity, set()).add(entity_uuid)
+    tracks = changed.get("track", set())
+    # Audio changes move duplicates and durations, artist and album changes
+    # only matter to rules on their names
+    related = [(db.Track.audio, changed.get("audio"))]
+    fields = {rule.field for rule in rules.rules} if rules is not None else set()
+    if "artist" in fields:
+        related.append((db.Track.artist, changed.get("artist")))
+    if "album" in fields:
+        related.append((db.Track.album, changed.get("album")))
+    for column, uuids in related:
+        for chunk in _chunks(uuids or ()):
+            tracks.update(session.scalars(select(db.Track.uuid).where(column.in_(chunk))))
+            if len(tracks) > PLAYLIST_INCREMENTAL_LIMIT:
+                return None
+    return tracks
+
+
+def _drop(session: Session, playlist: db.Playlist, tracks: Iterable[str]) -> None:
+    for chunk in _chunks(tracks):
+        result = cast(
+            CursorResult,
+            session.execute(
+                delete(db.PlaylistEntry).where(
+                    db.PlaylistEntry.playlist == playlist.uuid, db.PlaylistEntry.track.in_(chunk)
+                )
+            ),
+        )
+        playlist.tracks = (playlist.tracks or 0) - result.rowcount
+
+
+def _entries_of(session: Session, playlist: db.Playlist, tracks: Set[str]) -> Set[str]:
+    present: Set[str] = set()
+    for chunk in _chunks(tracks):
+        present.update(
+            session.scalars(
+                select(db.PlaylistEntry.track).where(
+                    db.PlaylistEntry.playlist == playlist.uuid, db.PlaylistEntry.track.in_(chunk)
+                )
+            )
+        )
+    return present
+
+
+def _existing(session: Session, tracks: Set[str]) -> Set[str]:
+    existing: Set[str] = set()
+    for chunk in _chunks(tracks):
+        existing.update(session.scalars(select(db.Track.uuid).where(db.Track.uuid.in_(chunk))))
+    return existing
+
+
+def is_stale(playlist: db.Playlist, generation: int, now: Optional[float] = None) -> bool:
+    if playlist.generation != generation:
+        return True
+    if playlist.rules is None:
+        return False
+    age = (now or time.time()) - (playlist.refreshed or 0)
+    if age <= PLAYLIST_PLAYS_MAX_AGE:
+        return False
+    rules = load_rules(playlist)
+    return rules is not None and uses_plays(rules)
+
+
+def refresh(session: Session, playlist: db.Playlist) -> Optional[str]:
+    """
+    Brings the entries of a playlist up to the current library generation,
+    see the module docstring. Does not commit.
+
+    Returns:
+        Optional[str]: "incremental" or "full", None if it was current
+    """
+    generation = changelog.current_seq(session)
+    now = time.time()
+    if not is_stale(playlist, generation, now):
+        return None
+    rules = load_rules(playlist)
+    plays_expired = (
+        rules is not None
+        and uses_plays(rules)
+        and now - (playlist.refreshed or 0) > PLAYLIST_PLAYS_MAX_AGE
+    )
+    changed = None if plays_expired else _changed_tracks(session, playlist.generation or 0, rules)
+
+    if rules is None:
+        # Static playlists only lose the tracks removed from the library
+        if changed is None:
+            result = cast(
+                CursorResult,
+                session.execute(
+                    delete(db.PlaylistEntry).where(
+                        db.PlaylistEntry.playlist == playlist.uuid,
+                        db.PlaylistEntry.track.not_in(select(db.Track.uuid)),
+                    )
+                ),
+            )
+            playlist.tracks = (playlist.tracks or 0) - result.rowcount
+        else:
+            present = _entries_of(session, playlist, changed)
+            _drop(session, playlist, present - _existing(session, present))
+        playlist.generation = generation
+        return "incremental"
+
+    if changed is None:
+        materialize(session, playlist, rules)
+        return "full"
+    matching: Set[str] = set()
+    for chunk in _chunks(changed):
+        matching.update(session.scalars(compile_rules(rules, db.Track.uuid.in_(chunk))))
+    present = _entries_of(session, playlist, changed)
+    gone = present - matching
+    # A new match needs its position, a changed track may have a new sort
+    # key, and a limited playlist has room for the next track once one goes
+    resort = rules.order not in PLAY_FIELDS and (present & matching)
+    if matching - present or resort or (gone and rules.limit):
+        materialize(session, playlist, rules)
+        return "full"
+    _drop(session, playlist, gone)
+    playlist.generation = generation
+    return "incremental"
+
+
+def refresh_all(session: Session) -> int:
+    """
+    Refreshes every playlist, committing after each one. Called by the
+    builder before it compacts the change log.
+
+    Returns:
+        int: Number of playlists that were not current
+    """
+    refreshed = 0
+    playlist_uuids = session.scalars(select(db.Playlist.uuid)).all()
+    for playlist_uuid in playlist_uuids:
+        playlist = session.get(db.Playlist, playlist_uuid)
+        if playlist is None:
+            continue
+        try:
+            refreshed += refresh(session, playlist) is not None
+            session.commit()
+        except Exception:
+            logger.exception("Could not refresh playlist %s", playlist_uuid)
+            session.rollback()
+    return refreshed
+
+
+def refresh_playlist(playlist_uuid: str) -> None:
+    """
+    Refreshes one playlist on the writer, for request handlers that found
+    it stale
+    """
+    with db.SessionLocal() as session:
+        playlist = session.get(db.Playlist, playlist_uuid)
+        if playlist is not None and refresh(session, playlist) is not None:
+            session.commit()
+
+
+def page(session: Session, playlist_uuid: str, after: int, limit: int) -> List[dict]:
+    """
+    The entries after position `after`, read off the primary key
+    """
+    rows = session.execute(
+        select(
+            db.PlaylistEntry.position,
+            db.Track.uuid,
+            db.Track.name,
+            db.Track.album,
+            db.Track.disc,
+            db.Track.track_number,
+            db.Track.year,
+        )
+        .join(db.Track, db.Track.uuid == db.PlaylistEntry.track)
+        .where(db.PlaylistEntry.playlist == playlist_uuid, db.PlaylistEntry.position > after)
+        .order_by(db.PlaylistEntry.position)
+        .limit(limit)
+    )
+    fields = ("position", "uuid", "name", "album", "disc", "track_number", "year")
+    return [dict(zip(fields, row, strict=True)) for row in rows]
+
+
+def describe(playlist: db.Playlist) -> dict:
+    rules = playlist.rules
+    return {
+        "uuid": playlist.uuid,
+        "name": playlist.name,
+        "smart": rules is not None,
+        "tracks": playlist.tracks or 0,
+        "rules": json.loads(rules) if rules is not None else None,
+        "updated": playlist.updated,
+    }
@@ -0,0 +1,188 @@
+"""
+Write-behind play history and play counts.
+
+Streaming endpoints only append events to a bounded in-memory buffer, they
+never touch the database. A background task flushes the buffer every
+PLAY_FLUSH_SECONDS (or as soon as PLAY_BATCH_SIZE events are waiting): the
+events are inserted in one statement and rolled up per track into
+play_counts, so a hot track costs one counter update per flush instead of
+one write per stream. When the buffer is full new events are dropped and
+counted rather than slowing down playback.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, update
+from starlette.concurrency import run_in_threadpool
+
+import db
+from metrics import CallbackMetric, Counter
+
+PLAY_QUEUE_LIMIT = int(os.getenv("PLAY_QUEUE_LIMIT", "10000"))
+PLAY_BATCH_SIZE = int(os.getenv("PLAY_BATCH_SIZE", "500"))
+PLAY_FLUSH_SECONDS = float(os.getenv("PLAY_FLUSH_SECONDS", "5"))
+PLAY_HISTORY_DAYS = int(os.getenv("PLAY_HISTORY_DAYS", "90"))
+PRUNE_INTERVAL = 3600
+
+START = "start"
+COMPLETE = "complete"
+
+logger = logging.getLogger(__name__)
+
+PLAY_EVENTS = Counter(
+    "heavymetal_play_events_total", "Play events recorded", ("event",)
+)
+PLAY_EVENTS_DROPPED = Counter(
+    "heavymetal_play_events_dropped_total", "Play events dropped on a full queue"
+)
+PLAY_FLUSH_FAILURES = Counter(
+    "heavymetal_play_flush_failures_total", "Play event batches that failed to flush"
+)
+
+# (user, track, event, unix time)
+Event = Tuple[Optional[str], str, str, float]
+
+
+def _upsert_counts(session, counts: Dict[str, List[float]]) -> None:
+    rows = [
+        {"track": track, "plays": plays, "completions": completions, "last_played": last}
+        for track, (plays, completions, last) in counts.items()
+    ]
+    table = db.PlayCount.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        # The dialect modules are imported here, postgresql pulls in asyncio
+        from sqlalchemy.dialects import postgresql, sqlite
+
+        module = sqlite if dialect == "sqlite" else postgresql
+        stmt = module.insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.track],
+            set_={
+                "plays": table.c.plays + stmt.excluded.plays,
+                "completions": table.c.completions + stmt.excluded.completions,
+                "last_played": stmt.excluded.last_played,
+            },
+        )
+        session.execute(stmt, rows)
+        return
+    for row in rows:
+        result = session.execute(
+            update(table)
+            .where(table.c.track == row["track"])
+            .values(
+                plays=table.c.plays + row["plays"],
+                completions=table.c.completions + row["completions"],
+                last_played=row["last_played"],
+            )
+        )
+        if result.rowcount == 0:
+            session.execute(insert(table), [row])
+
+
+class PlayRecorder:
+    def __init__(self, limit: int = PLAY_QUEUE_LIMIT):
+        self.limit = limit
+        self._events: List[Event] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def record(self, user: Optional[str], track: str, event: str) -> bool:
+        """
+        Buffers one event without blocking, returns False if it was dropped
+        """
+        with self._lock:
+            if len(self._events) >= self.limit:
+                PLAY_EVENTS_DROPPED.inc()
+                return False
+            self._events.append((user, track, event, time.time()))
+        PLAY_EVENTS.labels(event).inc()
+        return True
+
+    def flush(self) -> int:
+        """
+        Writes the buffered events and rolls them up into play_counts
+
+        Returns:
+            int: Number of events written
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            if not events:
+                return 0
+
+            counts: Dict[str, List[float]] = defaultdict(lambda: [0, 0, 0.0])
+            for _, track, event, at in events:
+                count = counts[track]
+                if event == START:
+                    count[0] += 1
+                else:
+                    count[1] += 1
+                count[2] = max(count[2], at)
+
+            try:
+                with db.SessionLocal() as session:
+                    session.execute(
+                        insert(db.PlayEvent),
+                        [
+                            {"user": user, "track": track, "event": event, "at": at}
+                            for user, track, event, at in events
+                        ],
+                    )
+                    _upsert_counts(session, counts)
+                    self._prune(session)
+                    session.commit()
+            except Exception:
+                PLAY_FLUSH_FAILURES.inc()
+                logger.exception("Could not flush %d play events", len(events))
+                with self._lock:
+                    # Keep them for the next attempt, as far as the limit allows
+                    room = max(self.limit - len(self._events), 0)
+                    self._events[:0] = events[-room:] if room else []
+                return 0
+            return len(events)
+
+    def _prune(self, session) -> None:
+        now = time.time()
+        if now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        cutoff = now - PLAY_HISTORY_DAYS * 86400
+        session.query(db.PlayEvent).filter(db.PlayEvent.at < cutoff).delete(
+            synchronize_session=False
+        )
+
+    async def run(self) -> None:
+        """
+        Flushes in the background until cancelled, then flushes what is left
+        """
+        last_flush = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(min(PLAY_FLUSH_SECONDS, 0.5))
+                due = time.monotonic() - last_flush >= PLAY_FLUSH_SECONDS
+                if due or len(self._events) >= PLAY_BATCH_SIZE:
+                    await run_in_threadpool(self.flush)
+                    last_flush = time.monotonic()
+        finally:
+            await run_in_threadpool(self.flush)
+
+
+plays = PlayRecorder()
+
+CallbackMetric(
+    "heavymetal_play_queue_depth",
+    "Play events waiting to be flushed",
+    lambda: [((), len(plays))],
+)
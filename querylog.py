@@ -0,0 +1,227 @@
+"""
+Opt-in SQL instrumentation for catching slow queries and N+1 patterns.
+
+- SLOW_QUERY_MS: statements slower than this are logged with the route
+  that ran them and their query plan (EXPLAIN QUERY PLAN on SQLite,
+  EXPLAIN elsewhere).
+- SQL_EXPLAIN_ALL: every distinct SELECT is explained once, and plans that
+  read a whole table are logged, so a schema or query change that loses
+  an index shows up on the first request that hits it.
+- SQL_STATEMENT_BUDGET: a request running more statements than this fails
+  with QueryBudgetError. Meant for tests and benchmarks, not production.
+
+Everything is off by default, statement_budget() applies a budget to a
+block of code in tests without the middleware. Plans are read through a
+raw cursor on the same connection, so they never count against a budget.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, List, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Counter
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+SQL_EXPLAIN_ALL = os.getenv("SQL_EXPLAIN_ALL", "").lower() in ("1", "true", "yes")
+SQL_STATEMENT_BUDGET = int(os.getenv("SQL_STATEMENT_BUDGET", "0"))
+EXPLAINED_LIMIT = 4096  # Distinct statements remembered by SQL_EXPLAIN_ALL
+
+# "SCAN tracks", "SCAN TABLE tracks AS t" on older SQLite, but not index
+# scans ("SCAN tracks USING INDEX ...") or constant rows and subqueries
+SQLITE_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+POSTGRES_FULL_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERIES = Counter(
+    "heavymetal_sql_slow_queries_total", "Statements over SLOW_QUERY_MS", ("route",)
+)
+FULL_SCANS = Counter(
+    "heavymetal_sql_full_scans_total", "Explained statements reading a whole table", ("route",)
+)
+
+
+class QueryBudgetError(Exception):
+    """Raised when a request runs more SQL statements than its budget."""
+
+
+class _Budget:
+    __slots__ = ("limit", "count", "name", "scope")
+
+    def __init__(self, limit: int, name: str = "-", scope: Optional[dict] = None):
+        self.limit = limit
+        self.count = 0
+        self.name = name
+        self.scope = scope
+
+    @property
+    def route(self) -> str:
+        if self.scope is None:
+            return self.name
+        # Routing sets the route on the scope after the middleware started
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or "unmatched"
+
+
+_current: ContextVar[Optional[_Budget]] = ContextVar("querylog_request", default=None)
+_explained: Set[str] = set()
+_explained_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """
+    Whether requests should go through QueryLogMiddleware
+    """
+    return SLOW_QUERY_MS > 0 or SQL_EXPLAIN_ALL or SQL_STATEMENT_BUDGET > 0
+
+
+def explain(connection, statement: str, parameters: Any) -> List[str]:
+    """
+    Returns the query plan of a statement, one line per plan row
+    """
+    dialect = connection.dialect.name
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    if dialect == "sqlite":
+        # (id, parent, notused, detail)
+        return [row[-1] for row in rows]
+    return [str(row[0]) for row in rows]
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    """
+    Returns the tables a plan reads in full
+    """
+    tables = []
+    for line in plan:
+        match = SQLITE_FULL_SCAN.match(line.strip()) or POSTGRES_FULL_SCAN.search(line)
+        if match and match.group(1) != "CONSTANT":
+            tables.append(match.group(1))
+    return tables
+
+
+def _first_time(statement: str) -> bool:
+    with _explained_lock:
+        if statement in _explained or len(_explained) >= EXPLAINED_LIMIT:
+            return False
+        _explained.add(statement)
+        return True
+
+
+def _inspect(conn, statement: str, parameters: Any, elapsed: float, many: bool) -> None:
+    budget = _current.get()
+    route = budget.route if budget is not None else "-"
+    slow = SLOW_QUERY_MS > 0 and elapsed * 1000 >= SLOW_QUERY_MS
+    is_select = statement.lstrip()[:6].upper() in ("SELECT", "WITH")
+    wanted = is_select and not many and (slow or (SQL_EXPLAIN_ALL and _first_time(statement)))
+    plan: List[str] = []
+    if wanted:
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as e:
+            plan = [f"EXPLAIN failed: {e}"]
+    scanned = full_scans(plan)
+    if slow:
+        SLOW_QUERIES.labels(route).inc()
+        logger.warning(
+            "Slow query (%.1f ms) on %s: %s\n%s",
+            elapsed * 1000,
+            route,
+            statement,
+            "\n".join(plan),
+        )
+    if scanned:
+        FULL_SCANS.labels(route).inc()
+        if not slow:
+            logger.warning(
+                "Full scan of %s on %s: %s\n%s",
+                ", ".join(scanned),
+                route,
+                statement,
+                "\n".join(plan),
+            )
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Adds the statement budget to an engine, and the slow query log and plan
+    checks when they are enabled
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _check_budget(conn, cursor, statement, parameters, context, many):
+        budget = _current.get()
+        if budget is not None and budget.limit > 0:
+            budget.count += 1
+            if budget.count > budget.limit:
+                raise QueryBudgetError(
+                    f"{budget.route} ran more than {budget.limit} SQL statements, "
+                    f"the last one was: {statement}"
+                )
+
+    if SLOW_QUERY_MS <= 0 and not SQL_EXPLAIN_ALL:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("querylog_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["querylog_start"].pop()
+        _inspect(conn, statement, parameters, elapsed, many)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(context):
+        # The statement failed, after_cursor_execute will not pop its start time
+        connection = context.connection
+        if connection is not None and connection.info.get("querylog_start"):
+            connection.info["querylog_start"].pop()
+
+
+@contextmanager
+def statement_budget(limit: int, name: str = "-") -> Iterator[_Budget]:
+    """
+    Fails any statement past the first `limit` run inside the block, on the
+    instrumented engines. For tests and benchmarks.
+    """
+    budget = _Budget(limit, name)
+    token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(token)
+
+
+class QueryLogMiddleware:
+    """
+    ASGI middleware naming the route of the statements a request runs and
+    applying SQL_STATEMENT_BUDGET to it
+    """
+
+    def __init__(self, app, budget: int = SQL_STATEMENT_BUDGET):
+        self.app = app
+        self.budget = budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _current.set(_Budget(self.budget, scope=scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
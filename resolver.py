@@ -0,0 +1,246 @@
+"""
+Compact artist and album name resolution for the builder.
+
+The builder turns every parsed artist and album name into a row uuid. Keeping
+a dict of every name in the library costs well over 100 bytes per entry,
+which adds up on multi-million track libraries and again in every builder
+process. A NameResolver instead keeps a snapshot of the table as flat
+arrays sorted by a 64-bit hash of the name, 32 bytes per row plus the
+encoded name, in front of which a bounded LRU holds the names resolved
+recently. A hash hit is checked against the stored name, so a new name
+sharing the hash of a known one is not mistaken for it. Names the snapshot
+does not know are looked up in the database, and names created by the
+current batch are kept until it commits or rolls back.
+
+The snapshot is read-only once loaded, so parsing threads can share it.
+Names whose hash collides with another row are left out of it and always
+resolved through the database.
+"""
+
+import hashlib
+import os
+import uuid
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from sqlalchemy import select
+
+RESOLVER_CACHE_SIZE = int(os.getenv("RESOLVER_CACHE_SIZE", "20000"))  # Names per table
+LOAD_BATCH = 10000
+
+
+def name_hash(name: str) -> int:
+    """
+    Stable 64-bit hash of a name, the same in every process
+    """
+    digest = hashlib.blake2b(name.encode("utf-8", "surrogatepass"), digest_size=8)
+    return int.from_bytes(digest.digest(), "little")
+
+
+class NameIndex:
+    """
+    Sorted name hashes with the uuids of their rows, as 16 raw bytes each,
+    and their names, UTF-8 encoded back to back in one buffer
+    """
+
+    def __init__(
+        self,
+        hashes: Optional[array] = None,
+        ids: bytes = b"",
+        offsets: Optional[array] = None,
+        names: bytes = b"",
+    ):
+        self.hashes = hashes if hashes is not None else array("Q")
+        self.ids = ids
+        self.offsets = offsets if offsets is not None else array("Q", [0])
+        self.names = names
+
+    @staticmethod
+    def _unique_order(hashes: array) -> array:
+        """
+        Positions of the hashes held by a single row, in hash order
+
+        The (hash, position) pairs are sorted packed in one array, so the sort
+        costs 12 bytes per row instead of a Python int per row.
+        """
+        try:
+            import numpy as np
+        except ImportError:  # pragma: no cover - depends on the environment
+            order = sorted(range(len(hashes)), key=hashes.__getitem__)
+            return array(
+                "I",
+                (
+                    i
+                    for position, i in enumerate(order)
+                    if not (position > 0 and hashes[order[position - 1]] == hashes[i])
+                    and not (
+                        position + 1 < len(order)
+                        and hashes[order[position + 1]] == hashes[i]
+                    )
+                ),
+            )
+        pairs = np.empty(len(hashes), dtype=[("hash", np.uint64), ("row", np.uint32)])
+        pairs["hash"] = np.frombuffer(hashes, dtype=np.uint64)
+        pairs["row"] = np.arange(len(hashes), dtype=np.uint32)
+        pairs.sort(order="hash")
+        shared = pairs["hash"][1:] == pairs["hash"][:-1]
+        unique = np.ones(len(pairs), dtype=bool)
+        unique[1:] &= ~shared
+        unique[:-1] &= ~shared
+        return array("I", pairs["row"][unique].tobytes())
+
+    @classmethod
+    def build(cls, rows) -> "NameIndex":
+        """
+        Builds the index from (name, uuid) rows, in any order
+
+        Rows without a name or with an id that is not a uuid are skipped,
+        like hashes shared by several rows.
+        """
+        hashes = array("Q")
+        ids = bytearray()
+        offsets = array("Q", [0])
+        names = bytearray()
+        for name, row_id in rows:
+            if not name:
+                continue
+            try:
+                raw = uuid.UUID(row_id).bytes
+            except (TypeError, ValueError):
+                continue
+            hashes.append(name_hash(name))
+            ids += raw
+            names += name.encode("utf-8", "surrogatepass")
+            offsets.append(len(names))
+
+        # A collision (or the same name twice) cannot be told apart here
+        sorted_hashes = array("Q")
+        sorted_ids = bytearray()
+        sorted_offsets = array("Q", [0])
+        sorted_names = bytearray()
+        for i in cls._unique_order(hashes):
+            sorted_hashes.append(hashes[i])
+            sorted_ids += ids[i * 16 : i * 16 + 16]
+            sorted_names += names[offsets[i] : offsets[i + 1]]
+            sorted_offsets.append(len(sorted_names))
+        return cls(sorted_hashes, bytes(sorted_ids), sorted_offsets, bytes(sorted_names))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def get(self, name: str) -> Optional[str]:
+        value = name_hash(name)
+        i = bisect_left(self.hashes, value)
+        if i == len(self.hashes) or self.hashes[i] != value:
+            return None
+        # A new name can share the hash of an indexed one
+        if self.names[self.offsets[i] : self.offsets[i + 1]] != name.encode(
+            "utf-8", "surrogatepass"
+        ):
+            return None
+        return str(uuid.UUID(bytes=self.ids[i * 16 : i * 16 + 16]))
+
+    def memory(self) -> int:
+        """
+        Bytes held by the arrays and buffers
+        """
+        return (
+            self.hashes.itemsize * len(self.hashes)
+            + len(self.ids)
+            + self.offsets.itemsize * len(self.offsets)
+            + len(self.names)
+        )
+
+
+class NameResolver:
+    """
+    Resolves names of one table (artists or albums) to row uuids
+
+    Args:
+        model: The mapped class, with `name` and `uuid` columns
+        cache_size (int): Recently resolved names kept in the LRU
+    """
+
+    def __init__(self, model, cache_size: int = RESOLVER_CACHE_SIZE):
+        self.model = model
+        self.cache_size = cache_size
+        self.index = NameIndex()
+        self.recent: "OrderedDict[str, str]" = OrderedDict()
+        self.pending: Dict[str, str] = {}  # Created, not committed yet
+        self.queries = 0
+
+    def reset(self) -> None:
+        self.index = NameIndex()
+        self.recent.clear()
+        self.pending.clear()
+        self.queries = 0
+
+    def load(self, session) -> int:
+        """
+        Snapshots the table into the index, returns the rows indexed
+        """
+        rows = session.execute(
+            select(self.model.name, self.model.uuid).execution_options(
+                yield_per=LOAD_BATCH
+            )
+        )
+        self.index = NameIndex.build(rows)
+        self.recent.clear()
+        self.pending.clear()
+        return len(self.index)
+
+    def _remember(self, name: str, row_id: str) -> None:
+        if self.cache_size <= 0:
+            return
+        self.recent[name] = row_id
+        self.recent.move_to_end(name)
+        if len(self.recent) > self.cache_size:
+            self.recent.popitem(last=False)
+
+    def get(self, session, name: str) -> Optional[str]:
+        """
+        The uuid of the row named `name`, None if there is none yet
+        """
+        row_id = self.recent.get(name)
+        if row_id is not None:
+            self.recent.move_to_end(name)
+            return row_id
+        row_id = self.pending.get(name) or self.index.get(name)
+        if row_id is None:
+            self.queries += 1
+            row_id = session.execute(
+                select(self.model.uuid).where(self.model.name == name).limit(1)
+            ).scalar()
+        if row_id is not None:
+            self._remember(name, row_id)
+        return row_id
+
+    def add(self, name: str, row_id: str) -> None:
+        """
+        Records a row created in the current transaction
+        """
+        self.pending[name] = row_id
+
+    def commit(self) -> None:
+        """
+        The current transaction was committed, its rows are in the database
+        """
+        for name, row_id in self.pending.items():
+            self._remember(name, row_id)
+        self.pending.clear()
+
+    def rollback(self) -> None:
+        """
+        The current transaction was rolled back, its rows never existed
+        """
+        for name in self.pending:
+            self.recent.pop(name, None)
+        self.pending.clear()
+
+    def memory(self) -> int:
+        """
+        Approximate bytes held: the index plus about 200 bytes per cached name
+        """
+        return self.index.memory() + 200 * (len(self.recent) + len(self.pending))
@@ -1,6 +1,8 @@
 from fastapi import APIRouter
 
 from .auth import router as auth_router
+from .playlists import router as playlists_router
+from .scans import router as scans_router
 from .songs import router as songs_router
 
 router = APIRouter(
@@ -14,3 +16,5 @@ router = APIRouter(
 
 router.include_router(auth_router)
 router.include_router(songs_router)
+router.include_router(scans_router)
+router.include_router(playlists_router)
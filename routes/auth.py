@@ -2,15 +2,17 @@ from datetime import timedelta
 
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
-from db import SessionLocal, User
+from schemas import UserPrincipal
 from security import (
     authenticate_user,
     create_access_token,
     get_current_active_superuser,
     get_current_active_user,
+    hash_password,
 )
-from utils import get_password_hash, get_user
+from utils import create_user, get_user
 
 router = APIRouter(
     prefix="/auth",
@@ -30,7 +32,7 @@ class LoginRequest(BaseModel):
 
 @router.post("/login")
 async def login(request: LoginRequest):
-    user = authenticate_user(request.username, request.password)
+    user = await authenticate_user(request.username, request.password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
     access_token_expires = timedelta(minutes=30)
@@ -47,22 +49,19 @@ class RegistrationRequest(BaseModel):
 
 @router.post("/register")
 async def register(request: RegistrationRequest):
-    user = get_user(request.username)
+    user = await run_in_threadpool(get_user, request.username)
     if user:
         raise HTTPException(status_code=400, detail="Username already exists")
-    hashed_password = get_password_hash(request.password)
-    new_user = User(name=request.username, hashed_password=hashed_password)
-    db = SessionLocal()
-    db.add(new_user)
-    db.commit()
+    hashed_password = await hash_password(request.password)
+    await run_in_threadpool(create_user, request.username, hashed_password)
     return {"message": "User created successfully"}
 
 
 @router.get("/profile")
-async def read_users_me(current_user: User = Depends(get_current_active_user)):
+async def read_users_me(current_user: UserPrincipal = Depends(get_current_active_user)):
     return {"username": current_user.name}
 
 
 @router.get("/superuser")
-async def read_superuser(current_user: User = Depends(get_current_active_superuser)):
+async def read_superuser(current_user: UserPrincipal = Depends(get_current_active_superuser)):
     return {"username": current_user.name}
@@ -0,0 +1,150 @@
+import time
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import changelog
+import playlists
+from db import Playlist, PlaylistEntry, get_db, get_read_db
+from schemas import Playlist as PlaylistSchema
+from schemas import PlaylistCreate, PlaylistPage, PlaylistUpdate, UserPrincipal
+from security import get_current_user
+
+router = APIRouter(
+    prefix="/playlists",
+    tags=["Playlists"],
+    responses={
+        404: {"description": "Not found"},
+        500: {"description": "Internal Server Error"},
+        400: {"description": "Bad Request"},
+    },
+)
+
+
+def owned_playlist(db: Session, playlist_id: str, user: UserPrincipal) -> Playlist:
+    playlist = db.get(Playlist, playlist_id)
+    if playlist is None or playlist.owner != user.uuid:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return playlist
+
+
+@router.get("", response_model=List[PlaylistSchema])
+async def get_playlists(
+    db: Session = Depends(get_read_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    rows = (
+        db.query(Playlist)
+        .filter(Playlist.owner == current_user.uuid)
+        .order_by(Playlist.name, Playlist.uuid)
+    )
+    return [playlists.describe(playlist) for playlist in rows]
+
+
+@router.post("", response_model=PlaylistSchema, status_code=201)
+async def create_playlist(
+    request: PlaylistCreate,
+    db: Session = Depends(get_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    """
+    Creates a static playlist from `tracks`, in that order, or a smart one
+    from `rules`, whose tracks are materialized right away
+    """
+    if request.tracks is not None and request.rules is not None:
+        raise HTTPException(status_code=400, detail="A playlist has tracks or rules, not both")
+    playlist = Playlist(owner=current_user.uuid, name=request.name, updated=time.time())
+    db.add(playlist)
+    db.flush()
+    try:
+        if request.rules is not None:
+            playlist.rules = playlists.dump_rules(request.rules)
+            playlists.materialize(db, playlist, request.rules)
+        else:
+            playlists.set_tracks(db, playlist, request.tracks or [])
+    except playlists.PlaylistError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    db.commit()
+    return playlists.describe(playlist)
+
+
+@router.get("/{playlist_id}", response_model=PlaylistSchema)
+async def get_playlist(
+    playlist_id: str,
+    db: Session = Depends(get_read_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    return playlists.describe(owned_playlist(db, playlist_id, current_user))
+
+
+@router.put("/{playlist_id}", response_model=PlaylistSchema)
+async def update_playlist(
+    playlist_id: str,
+    request: PlaylistUpdate,
+    db: Session = Depends(get_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    """
+    Renames a playlist, replaces the tracks of a static one or the rules of
+    a smart one
+    """
+    playlist = owned_playlist(db, playlist_id, current_user)
+    smart = playlist.rules is not None
+    if request.tracks is not None and smart:
+        raise HTTPException(status_code=400, detail="Smart playlists are edited through rules")
+    if request.rules is not None and not smart:
+        raise HTTPException(status_code=400, detail="Static playlists are edited through tracks")
+    try:
+        if request.rules is not None:
+            playlist.rules = playlists.dump_rules(request.rules)
+            playlists.materialize(db, playlist, request.rules)
+        if request.tracks is not None:
+            playlists.set_tracks(db, playlist, request.tracks)
+    except playlists.PlaylistError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    if request.name is not None:
+        playlist.name = request.name
+    playlist.updated = time.time()
+    db.commit()
+    return playlists.describe(playlist)
+
+
+@router.delete("/{playlist_id}", status_code=204)
+async def delete_playlist(
+    playlist_id: str,
+    db: Session = Depends(get_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    playlist = owned_playlist(db, playlist_id, current_user)
+    db.query(PlaylistEntry).filter(PlaylistEntry.playlist == playlist.uuid).delete(
+        synchronize_session=False
+    )
+    db.delete(playlist)
+    db.commit()
+
+
+@router.get("/{playlist_id}/tracks", response_model=PlaylistPage)
+async def get_playlist_tracks(
+    playlist_id: str,
+    after: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, ge=1, le=1000),
+    db: Session = Depends(get_read_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    """
+    A page of the playlist in order. Pass the returned `next` as `after` for
+    the following page, it is null on the last one. Smart playlists are
+    brought up to the current library first, see playlists.refresh.
+    """
+    playlist = owned_playlist(db, playlist_id, current_user)
+    if playlists.is_stale(playlist, changelog.current_seq(db)):
+        await run_in_threadpool(playlists.refresh_playlist, playlist_id)
+    entries = playlists.page(db, playlist_id, after, limit)
+    return {
+        "entries": entries,
+        "next": entries[-1]["position"] if len(entries) == limit else None,
+    }
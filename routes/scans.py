@@ -0,0 +1,69 @@
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from scan_jobs import ScanJobError, list_jobs, read_status, scan_jobs
+from schemas import ScanJob, UserPrincipal
+from security import get_current_active_superuser
+
+router = APIRouter(
+    prefix="/scans",
+    tags=["Scans"],
+    responses={
+        404: {"description": "Not found"},
+        500: {"description": "Internal Server Error"},
+        400: {"description": "Bad Request"},
+    },
+)
+
+
+@router.post("", response_model=ScanJob, status_code=202)
+async def start_scan(
+    full: bool = False,
+    current_user: UserPrincipal = Depends(get_current_active_superuser),
+):
+    """
+    Starts a library scan in a background process. Incremental scans only
+    add new files, full scans also re-read known files and drop missing ones.
+    """
+    try:
+        return await run_in_threadpool(scan_jobs.start, full)
+    except ScanJobError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+
+@router.get("", response_model=List[ScanJob])
+async def get_scans(
+    current_user: UserPrincipal = Depends(get_current_active_superuser),
+):
+    return await run_in_threadpool(list_jobs)
+
+
+@router.get("/{job_id}", response_model=ScanJob)
+async def get_scan(
+    job_id: str,
+    current_user: UserPrincipal = Depends(get_current_active_superuser),
+):
+    """
+    Progress of a scan: stage, files processed and added, files per second
+    and errors, updated about once a second
+    """
+    status = read_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    return status
+
+
+@router.post("/{job_id}/cancel", response_model=ScanJob)
+async def cancel_scan(
+    job_id: str,
+    current_user: UserPrincipal = Depends(get_current_active_superuser),
+):
+    """
+    Stops a scan after its current batch, files committed so far are kept
+    """
+    status = scan_jobs.cancel(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    return status
@@ -1,20 +1,51 @@
+import mimetypes
 import os
 import re
-from typing import List
+from typing import Callable, Dict, List, Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi.requests import Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
-
-from db import Album, Artist, Audio, Track, get_db
+from starlette.concurrency import run_in_threadpool
+
+import changelog
+import export
+import fastjson
+from db import (
+    Album,
+    Artist,
+    Audio,
+    Genre,
+    GenreArtist,
+    PlayCount,
+    PlayEvent,
+    Track,
+    TrackGenre,
+    get_read_db,
+)
+from media import resolve_path
+from metrics import ACTIVE_STREAMS, STREAM_BYTES
+from plays import COMPLETE, START, plays
 from schemas import Album as AlbumSchema
 from schemas import Artist as ArtistSchema
 from schemas import Audio as AudioSchema
-from schemas import SearchResult, User
+from schemas import GenreFacet, SearchResult, TrackListing, User, UserPrincipal
 from schemas import Track as TrackSchema
-from security import get_current_user
+from security import (
+    StreamUrlError,
+    get_current_user,
+    sign_stream_url,
+    verify_stream_url,
+)
+from similar import MAX_LIMIT as SIMILAR_MAX_LIMIT
+from similar import similar_tracks
+from suggest import MAX_LIMIT, suggestions
+
+LISTING_YIELD_PER = 1000
+PLAY_START_BYTES = 64 * 1024  # Sent from byte 0 by a bounded range to count a play
 
 router = APIRouter(
     prefix="/songs",
@@ -32,39 +63,90 @@ class SongRequest(BaseModel):
     offset: int = 0
 
 
+def distinct_tracks(db: Session):
+    """
+    Tracks query that skips tracks whose audio duplicates another file
+    """
+    return (
+        db.query(Track)
+        .outerjoin(Audio, Audio.uuid == Track.audio)
+        .filter(Audio.canonical.is_(None))
+    )
+
+
+def by_popularity(query):
+    """
+    Orders a tracks query by play count, most played first
+    """
+    return query.outerjoin(PlayCount, PlayCount.track == Track.uuid).order_by(
+        func.coalesce(PlayCount.plays, 0).desc()
+    )
+
+
 @router.get("/list")
 async def get_songs(
     limit: int = 10,
     offset: int = 0,
-    db: Session = Depends(get_db),
+    sort: Literal["default", "popular"] = "default",
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
     request = SongRequest(limit=limit, offset=offset)
+    query = distinct_tracks(db)
+    if sort == "popular":
+        query = by_popularity(query)
     tracks = [
         {"uuid": track.uuid, "name": track.name}
-        for track in db.query(Track).limit(request.limit).all()
+        for track in query.limit(request.limit).all()
     ]
     return tracks
 
+
+@router.get("/recent", response_model=List[SearchResult])
+async def get_recently_played(
+    limit: int = Query(default=20, ge=1, le=100),
+    db: Session = Depends(get_read_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    """
+    The current user's most recently started tracks, newest first. Plays are
+    written behind, so the last few seconds may be missing.
+    """
+    last_played = func.max(PlayEvent.at)
+    rows = (
+        db.query(Track.uuid, Track.name)
+        .join(PlayEvent, PlayEvent.track == Track.uuid)
+        .filter(PlayEvent.user == current_user.uuid, PlayEvent.event == START)
+        .group_by(Track.uuid, Track.name)
+        .order_by(last_played.desc())
+        .limit(limit)
+    )
+    return [{"uuid": track_uuid, "name": name} for track_uuid, name in rows]
+
+
 @router.get("/info/{song_id}")
 async def get_song_info(
     song_id: str,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
-    track = db.query(Track).filter(Track.uuid == song_id).first()
-    if track is None:
+    row = (
+        db.query(Track, Audio, Album, Artist)
+        .outerjoin(Audio, Audio.uuid == Track.audio)
+        .outerjoin(Album, Album.uuid == Track.album)
+        .outerjoin(Artist, Artist.uuid == Track.artist)
+        .filter(Track.uuid == song_id)
+        .first()
+    )
+    if row is None:
         raise HTTPException(status_code=404, detail="Song not found")
-
-    audio = db.query(Audio).filter(Audio.uuid == track.audio).first()
-    album = db.query(Album).filter(Album.uuid == track.album).first()
-    artist = db.query(Artist).filter(Artist.uuid == track.artist).first()
+    track, audio, album, artist = row
 
     # Handle cases where related entities are None
     album_name = album.name if album else "Unknown Album"
     artist_name = artist.name if artist else "Unknown Artist"
     audio_name = audio.name if audio else "Unknown Audio"
-    audio_path = audio.path if audio else ""
+    audio_path = resolve_path(audio.root, audio.path) if audio and audio.path else ""
 
     return_val:TrackSchema = TrackSchema(
         name=track.name or "",
@@ -78,26 +160,163 @@ async def get_song_info(
 
 
 @router.get("/list/albums", response_model=List[SearchResult])
-async def get_albums(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
-):
-    albums = [
-        {"uuid": album.uuid, "name": album.name} for album in db.query(Album).all()
-    ]
-    return albums
+async def get_albums(request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Every album, served from the listing cache, see fastjson
+    """
+    return await fastjson.listing_response(
+        request,
+        lambda db: db.execute(
+            select(Album.uuid, Album.name).execution_options(yield_per=LISTING_YIELD_PER)
+        ),
+        ("uuid", "name"),
+    )
 
 
-@router.get("/list/album/{album_id}", response_model=List[SearchResult])
+TRACK_LISTING_FIELDS = ("uuid", "name", "album", "disc", "track_number", "year")
+
+
+def track_listing_rows(db: Session, *criteria, order_by, offset: int, limit: int):
+    """
+    Column rows of the non-duplicate tracks matching `criteria`
+    """
+    return db.execute(
+        select(
+            Track.uuid, Track.name, Track.album, Track.disc, Track.track_number, Track.year
+        )
+        .outerjoin(Audio, Audio.uuid == Track.audio)
+        .where(Audio.canonical.is_(None), *criteria)
+        .order_by(*order_by)
+        .offset(offset)
+        .limit(limit)
+    )
+
+
+@router.get("/list/album/{album_id}", response_model=List[TrackListing])
 async def get_album_songs(
     album_id: str,
-    db: Session = Depends(get_db),
+    request: Request,
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
     current_user: User = Depends(get_current_user),
 ):
-    tracks = [
-        {"uuid": track.uuid, "name": track.name}
-        for track in db.query(Track).filter(Track.album == album_id).all()
-    ]
-    return tracks
+    """
+    Tracks of an album in play order, read off the (album, disc, track_number)
+    index
+    """
+    return await fastjson.listing_response(
+        request,
+        lambda db: track_listing_rows(
+            db,
+            Track.album == album_id,
+            order_by=(Track.disc, Track.track_number, Track.uuid),
+            offset=offset,
+            limit=limit,
+        ),
+        TRACK_LISTING_FIELDS,
+    )
+
+
+@router.get("/list/artist/{artist_id}", response_model=List[TrackListing])
+async def get_artist_songs(
+    artist_id: str,
+    request: Request,
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Tracks of an artist oldest release first, then in play order within each
+    album, read off the (artist, year) index
+    """
+    return await fastjson.listing_response(
+        request,
+        lambda db: track_listing_rows(
+            db,
+            Track.artist == artist_id,
+            order_by=(Track.year, Track.album, Track.disc, Track.track_number, Track.uuid),
+            offset=offset,
+            limit=limit,
+        ),
+        TRACK_LISTING_FIELDS,
+    )
+
+
+@router.get("/genres", response_model=List[GenreFacet])
+async def get_genres(
+    request: Request,
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Genres with their track counts, most tracks first
+    """
+    return await fastjson.listing_response(
+        request,
+        lambda db: db.execute(
+            select(Genre.uuid, Genre.name, Genre.tracks)
+            .where(Genre.tracks > 0)
+            .order_by(Genre.tracks.desc(), Genre.uuid)
+            .offset(offset)
+            .limit(limit)
+        ),
+        ("uuid", "name", "tracks"),
+    )
+
+
+@router.get("/genres/{genre_id}/artists", response_model=List[GenreFacet])
+async def get_genre_artists(
+    genre_id: str,
+    request: Request,
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Artists of a genre with their track counts in it, most tracks first
+    """
+    return await fastjson.listing_response(
+        request,
+        lambda db: db.execute(
+            select(GenreArtist.artist, Artist.name, GenreArtist.tracks)
+            .join(Artist, Artist.uuid == GenreArtist.artist)
+            .where(GenreArtist.genre == genre_id, GenreArtist.tracks > 0)
+            .order_by(GenreArtist.tracks.desc(), GenreArtist.artist)
+            .offset(offset)
+            .limit(limit)
+        ),
+        ("uuid", "name", "tracks"),
+    )
+
+
+@router.get("/list/genre/{genre_id}", response_model=List[TrackListing])
+async def get_genre_songs(
+    genre_id: str,
+    request: Request,
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Tracks of a genre, read off the (genre, track) index of track_genres,
+    which only links tracks that are not duplicates
+    """
+    return await fastjson.listing_response(
+        request,
+        lambda db: db.execute(
+            select(
+                Track.uuid, Track.name, Track.album, Track.disc, Track.track_number, Track.year
+            )
+            .select_from(TrackGenre)
+            .join(Track, Track.uuid == TrackGenre.track)
+            .where(TrackGenre.genre == genre_id)
+            .order_by(TrackGenre.track)
+            .offset(offset)
+            .limit(limit)
+        ),
+        TRACK_LISTING_FIELDS,
+    )
 
 
 @router.get("/search/{song}", response_model=List[SearchResult])
@@ -105,12 +324,12 @@ async def search_songs(
     song: str,
     limit: int = 10,
     offset: int = 0,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
     tracks = [
         {"uuid": track.uuid, "name": track.name}
-        for track in db.query(Track)
+        for track in by_popularity(distinct_tracks(db))
         .filter(Track.name.contains(song))
         .limit(limit)
         .all()
@@ -123,7 +342,7 @@ async def search_songs_by_artist(
     artist: str,
     limit: int = 10,
     offset: int = 0,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
     artists = db.query(Artist).filter(Artist.name.contains(artist)).limit(limit).all()
@@ -135,7 +354,7 @@ async def search_songs_by_album(
     album: str,
     limit: int = 10,
     offset: int = 0,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
     albums = db.query(Album).filter(Album.name.contains(album)).limit(limit).all()
@@ -147,12 +366,12 @@ async def search_songs_by_genre(
     genre: str,
     limit: int = 10,
     offset: int = 0,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
     tracks = [
         {"uuid": track.uuid, "name": track.name}
-        for track in db.query(Track)
+        for track in distinct_tracks(db)
         .filter(Track.genre.contains(genre))
         .limit(limit)
         .all()
@@ -160,36 +379,137 @@ async def search_songs_by_genre(
     return tracks
 
 
-def iter_file(file_path: str, start: int, end: int):
-    with open(file_path, "rb") as f:
-        f.seek(start)
-        bytes_to_read = end - start + 1
-        while bytes_to_read > 0:
-            chunk_size = min(1024 * 1024, bytes_to_read)
-            data = f.read(chunk_size)
-            if not data:
-                break
-            bytes_to_read -= len(data)
-            yield data
+@router.get("/changes")
+async def get_changes(
+    since: int = 0,
+    limit: int = Query(default=1000, ge=1, le=10000),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Streams library changes after `since` as NDJSON, see changelog.iter_changes
+    """
+    return StreamingResponse(
+        changelog.iter_changes(since, limit), media_type="application/x-ndjson"
+    )
 
 
-@router.get("/stream/{song_id}")
-async def stream_song(
-    song_id: str,
+@router.get("/export")
+async def export_catalog(
     request: Request,
-    db: Session = Depends(get_db),
+    format: Literal["ndjson", "binary"] = "ndjson",  # noqa: A002
     current_user: User = Depends(get_current_user),
 ):
-    track = db.query(Track).filter(Track.uuid == song_id).first()
-    if not track:
-        raise HTTPException(status_code=404, detail="Track not found")
+    """
+    Streams every track with its album, artist and audio fields, gzipped when
+    the client accepts it
+    """
+    use_gzip = "gzip" in fastjson.accepted_encodings(
+        request.headers.get("Accept-Encoding", "")
+    )
+    headers = {"Vary": "Accept-Encoding"}
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    media_type = (
+        "application/x-ndjson" if format == "ndjson" else "application/octet-stream"
+    )
+    return StreamingResponse(
+        export.iter_export(format, gzip=use_gzip),
+        media_type=media_type,
+        headers=headers,
+    )
 
-    audio = db.query(Audio).filter(Audio.uuid == track.audio).first()
-    if not audio or not audio.path:
-        raise HTTPException(status_code=404, detail="Audio not found")
 
-    file_path = audio.path
+@router.get("/suggest")
+async def suggest(
+    q: str,
+    limit: int = Query(default=10, ge=1, le=MAX_LIMIT),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Typeahead over track, artist and album names, served from memory
+    """
+    index = suggestions.index
+    if index is None:
+        index = await run_in_threadpool(suggestions.refresh)
+    suggestions.refresh_if_stale()
+    return index.search(q, limit)
+
+
+@router.get("/similar/{song_id}")
+async def get_similar_songs(
+    song_id: str,
+    limit: int = Query(default=10, ge=1, le=SIMILAR_MAX_LIMIT),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Tracks most similar to the given one, by cosine similarity of their
+    genre, artist, album, year, duration and loudness features
+    """
+    index = await run_in_threadpool(similar_tracks.get)
+    if index is None:
+        raise HTTPException(status_code=503, detail="Similarity index not available")
+    matches = await run_in_threadpool(index.search, song_id, limit)
+    if matches is None:
+        raise HTTPException(status_code=404, detail="Song not found")
 
+    names: Dict[Optional[str], Optional[str]] = {
+        track_uuid: name
+        for track_uuid, name in db.query(Track.uuid, Track.name).filter(
+            Track.uuid.in_([track_uuid for track_uuid, _ in matches])
+        )
+    }
+    return [
+        {"uuid": track_uuid, "name": names[track_uuid], "score": round(score, 4)}
+        for track_uuid, score in matches
+        if track_uuid in names
+    ]
+
+
+def iter_file(
+    file_path: str,
+    start: int,
+    end: int,
+    on_complete: Optional[Callable[[], None]] = None,
+    on_start: Optional[Callable[[], None]] = None,
+    start_after: int = 0,
+):
+    ACTIVE_STREAMS.inc()
+    try:
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            bytes_to_read = end - start + 1
+            sent = 0
+            while bytes_to_read > 0:
+                chunk_size = min(1024 * 1024, bytes_to_read)
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                bytes_to_read -= len(data)
+                STREAM_BYTES.inc(len(data))
+                yield data
+                sent += len(data)
+                if on_start is not None and sent >= start_after:
+                    on_start()
+                    on_start = None
+        if on_complete is not None and bytes_to_read == 0:
+            on_complete()
+    finally:
+        ACTIVE_STREAMS.dec()
+
+
+def stream_file(
+    file_path: str,
+    request: Request,
+    track: Optional[str] = None,
+    user: Optional[str] = None,
+) -> StreamingResponse:
+    """
+    Serves a byte range of an audio file. With a track, an open-ended
+    request from byte 0 counts as a play, a bounded one from byte 0 only
+    once PLAY_START_BYTES (or the whole file) have been sent, so probes
+    such as bytes=0-1 do not. Sending the last byte counts as a completion.
+    """
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
 
@@ -198,6 +518,7 @@ async def stream_song(
     range_header = request.headers.get("Range")
     start = 0
     end = file_size - 1
+    open_ended = True
 
     if range_header:
         range_match = re.match(r"bytes=(\d+)-(\d*)", range_header)
@@ -205,24 +526,105 @@ async def stream_song(
             start = int(range_match.group(1))
             if range_match.group(2):
                 end = int(range_match.group(2))
+                open_ended = False
 
     if start >= file_size or end >= file_size:
         raise HTTPException(status_code=416, detail="Requested Range Not Satisfiable")
 
+    on_complete = on_start = None
+    if track is not None:
+        if start == 0 and open_ended:
+            plays.record(user, track, START)
+        elif start == 0:
+            def on_start() -> None:
+                plays.record(user, track, START)
+        if end == file_size - 1:
+            def on_complete() -> None:
+                plays.record(user, track, COMPLETE)
+
     content_length = end - start + 1
     headers = {
         "Content-Range": f"bytes {start}-{end}/{file_size}",
         "Accept-Ranges": "bytes",
         "Content-Length": str(content_length),
-        "Content-Type": "audio/mpeg",
+        "Content-Type": mimetypes.guess_type(file_path)[0] or "audio/mpeg",
     }
 
     return StreamingResponse(
         iter_file(
                 file_path,
                 start,
-                end
+                end,
+                on_complete,
+                on_start,
+                min(PLAY_START_BYTES, file_size),
             ),
         status_code=206,
         headers=headers
     )
+
+
+@router.get("/stream/{song_id}")
+async def stream_song(
+    song_id: str,
+    request: Request,
+    db: Session = Depends(get_read_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    track = db.query(Track).filter(Track.uuid == song_id).first()
+    if not track:
+        raise HTTPException(status_code=404, detail="Track not found")
+
+    audio = db.query(Audio).filter(Audio.uuid == track.audio).first()
+    file_path = resolve_path(audio.root, audio.path) if audio and audio.path else None
+    if not file_path:
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    return stream_file(file_path, request, track.uuid, current_user.uuid)
+
+
+@router.get("/stream/{song_id}/url")
+async def get_stream_url(
+    song_id: str,
+    request: Request,
+    db: Session = Depends(get_read_db),
+    current_user: UserPrincipal = Depends(get_current_user),
+):
+    """
+    Mints a short-lived signed URL that can be used directly as an <audio> src
+    """
+    audio = (
+        db.query(Audio.root, Audio.path)
+        .join(Track, Track.audio == Audio.uuid)
+        .filter(Track.uuid == song_id)
+        .first()
+    )
+    if not audio or not audio.path or not resolve_path(audio.root, audio.path):
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    try:
+        params = sign_stream_url(song_id, audio.root, audio.path, current_user.uuid)
+    except StreamUrlError as e:
+        raise HTTPException(status_code=503, detail=str(e)) from e
+    url = request.url_for("stream_signed_song", song_id=song_id)
+    return {"url": str(url.include_query_params(**params)), "expires": params["exp"]}
+
+
+@router.get("/stream/{song_id}/signed")
+async def stream_signed_song(
+    song_id: str,
+    request: Request,
+    key: str,
+    exp: int,
+    user: str,
+    sig: str,
+):
+    location = verify_stream_url(song_id, key, exp, user, sig)
+    if location is None:
+        raise HTTPException(status_code=403, detail="Invalid or expired stream URL")
+
+    file_path = resolve_path(*location)
+    if not file_path:
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    return stream_file(file_path, request, song_id, user)
@@ -0,0 +1,355 @@
+"""
+Library scans started from the API.
+
+A scan runs db_builder.run_scan in a separate process, at a lower CPU and
+I/O priority, so parsing a large library does not compete with request
+handling. Job state lives in small JSON files under SCAN_JOBS_DIR rather
+than in memory, so every API worker sees the same jobs: the scan process
+rewrites its status file about once a second and polls for a cancel
+marker.
+
+One scan runs at a time across workers: the scan process holds an
+exclusive lock on LOCK_FILE for as long as it lives, and the operating
+system drops the lock when the process exits or dies. A scan is never
+declared dead because it went quiet, long stages such as the similar
+track index report no progress. Starting a scan is serialized by a second
+lock, which the scan process also takes while it claims LOCK_FILE.
+"""
+
+import contextlib
+import ctypes
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+logger = logging.getLogger(__name__)
+
+SCAN_JOBS_DIR = Path(
+    os.getenv("SCAN_JOBS_DIR", os.path.join(tempfile.gettempdir(), "heavymetal-scans"))
+)
+SCAN_NICENESS = int(os.getenv("SCAN_NICENESS", "10"))
+PROGRESS_INTERVAL = 1.0  # Seconds between status file updates
+START_TIMEOUT = 300  # A queued job whose process never took the lock is dead
+JOBS_KEPT = 20
+LOCK_FILE = "running.lock"
+START_LOCK_FILE = "start.lock"
+
+ACTIVE_STATES = ("queued", "running")
+
+# ioprio_set syscall numbers, the I/O priority has no wrapper in os
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314}
+_IOPRIO_CLASS_IDLE = 3
+
+
+class ScanJobError(Exception):
+    """Raised when a scan is requested while another one is still running."""
+
+
+def _status_path(job_id: str) -> Path:
+    return SCAN_JOBS_DIR / f"{job_id}.json"
+
+
+def _cancel_path(job_id: str) -> Path:
+    return SCAN_JOBS_DIR / f"{job_id}.cancel"
+
+
+def _write_status(status: Dict[str, Any]) -> None:
+    path = _status_path(status["id"])
+    temporary = path.with_suffix(".tmp")
+    with open(temporary, "w") as f:
+        json.dump(status, f)
+    os.replace(temporary, path)
+
+
+def read_status(job_id: str) -> Optional[Dict[str, Any]]:
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(_status_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_jobs() -> List[Dict[str, Any]]:
+    """
+    Returns the most recent jobs, newest first
+    """
+    jobs = []
+    for path in SCAN_JOBS_DIR.glob("*.json"):
+        status = read_status(path.stem)
+        if status is not None:
+            jobs.append(status)
+    jobs.sort(key=lambda job: job["created"], reverse=True)
+    return jobs[:JOBS_KEPT]
+
+
+def _prune() -> None:
+    jobs = sorted(SCAN_JOBS_DIR.glob("*.json"), key=lambda path: path.stat().st_mtime)
+    for path in jobs[:-JOBS_KEPT]:
+        status = read_status(path.stem)
+        if status is None or status["state"] not in ACTIVE_STATES:
+            path.unlink(missing_ok=True)
+
+
+def _lower_priority() -> None:
+    """
+    Makes the scan process yield CPU and disk to the API
+    """
+    with contextlib.suppress(AttributeError, OSError):
+        os.nice(SCAN_NICENESS)
+    syscall = _IOPRIO_SET.get(platform.machine())
+    if syscall is None or platform.system() != "Linux":
+        return
+    with contextlib.suppress(OSError, AttributeError):
+        libc = ctypes.CDLL(None, use_errno=True)
+        # IOPRIO_WHO_PROCESS, this process, idle class
+        libc.syscall(syscall, 1, 0, _IOPRIO_CLASS_IDLE << 13)
+
+
+class _CancelFlag:
+    """
+    Event-like view of the cancel marker, checked at most once a second
+    """
+
+    def __init__(self, job_id: str):
+        self.path = _cancel_path(job_id)
+        self._set = False
+        self._checked_at = 0.0
+
+    def is_set(self) -> bool:
+        now = time.monotonic()
+        if not self._set and now - self._checked_at >= 1.0:
+            self._checked_at = now
+            self._set = self.path.exists()
+        return self._set
+
+
+def _run_job(job_id: str) -> None:
+    # Runs in the scan process
+    _lower_priority()
+    import db_builder
+
+    db_builder.configure_logging()
+    status = read_status(job_id) or {"id": job_id, "created": time.time()}
+    lock = _claim()
+    if lock is None:
+        status.update(
+            state="failed", error="Another scan is running", finished=time.time()
+        )
+        _write_status(status)
+        return
+    status.update(state="running", started=time.time(), pid=os.getpid())
+    _write_status(status)
+    written_at = 0.0
+    last_stage = None
+
+    def progress(state: Dict[str, Any]) -> None:
+        nonlocal written_at, last_stage
+        status["progress"] = state
+        now = time.monotonic()
+        if state["stage"] != last_stage or now - written_at >= PROGRESS_INTERVAL:
+            last_stage = state["stage"]
+            written_at = now
+            status["updated"] = time.time()
+            _write_status(status)
+
+    try:
+        result = db_builder.run_scan(
+            full=status.get("full", False), cancel=_CancelFlag(job_id), progress=progress
+        )
+        status["progress"] = result
+        status["state"] = "cancelled" if result["stage"] == "cancelled" else "finished"
+    except Exception as e:
+        logger.exception("Scan job %s failed", job_id)
+        status.update(state="failed", error=str(e))
+    finally:
+        status["finished"] = status["updated"] = time.time()
+        _write_status(status)
+        _cancel_path(job_id).unlink(missing_ok=True)
+        os.close(lock)
+
+
+def _try_lock(fd: int, blocking: bool = False) -> bool:
+    """
+    Takes an exclusive lock on an open file, False if another process holds it
+    """
+    try:
+        if sys.platform == "win32":
+            msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EDEADLK):
+            return False
+        raise
+    return True
+
+
+def _open_lock(name: str) -> int:
+    return os.open(SCAN_JOBS_DIR / name, os.O_CREAT | os.O_RDWR, 0o600)
+
+
+@contextlib.contextmanager
+def _start_lock() -> Iterator[None]:
+    fd = _open_lock(START_LOCK_FILE)
+    try:
+        _try_lock(fd, blocking=True)
+        yield
+    finally:
+        os.close(fd)  # Also releases the lock
+
+
+def _lock_held() -> bool:
+    """
+    Whether a scan process holds LOCK_FILE, only called under the start lock
+    """
+    fd = _open_lock(LOCK_FILE)
+    try:
+        return not _try_lock(fd)
+    finally:
+        os.close(fd)
+
+
+def _claim() -> Optional[int]:
+    """
+    Takes LOCK_FILE for this scan process, the lock is held until it exits
+
+    Returns:
+        Optional[int]: The locked file descriptor, None if another scan has it
+    """
+    SCAN_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    with _start_lock():
+        fd = _open_lock(LOCK_FILE)
+        if not _try_lock(fd):
+            os.close(fd)
+            return None
+        return fd
+
+
+def _check_not_running() -> None:
+    """
+    Raises ScanJobError if a scan is running or about to, and marks jobs
+    whose process is gone as failed. Only called under the start lock.
+    """
+    jobs = list_jobs()
+    if _lock_held():
+        running = next((job["id"] for job in jobs if job["state"] in ACTIVE_STATES), None)
+        raise ScanJobError(
+            f"Scan {running} is still running" if running else "A scan is still running"
+        )
+    for status in jobs:
+        if status["state"] == "queued" and time.time() - status["created"] < START_TIMEOUT:
+            raise ScanJobError(f"Scan {status['id']} is starting")
+        if status["state"] in ACTIVE_STATES:
+            # Nobody holds the lock, its process died before cleaning up
+            status.update(
+                state="failed",
+                error="Scan process stopped",
+                finished=time.time(),
+            )
+            _write_status(status)
+
+
+class ScanJobs:
+    """
+    Starts scans on this worker's process pool, the pool is created on the
+    first scan so workers that never start one do not pay for it
+    """
+
+    def __init__(self) -> None:
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def start(self, full: bool = False) -> Dict[str, Any]:
+        SCAN_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock, _start_lock():
+            _check_not_running()
+            now = time.time()
+            status = {
+                "id": job_id,
+                "full": full,
+                "state": "queued",
+                "created": now,
+                "updated": now,
+                "progress": None,
+            }
+            _write_status(status)
+            _prune()
+            try:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+                    )
+                future = self._pool.submit(_run_job, job_id)
+            except Exception:
+                status.update(state="failed", error="Could not start the scan process")
+                _write_status(status)
+                raise
+            self._futures[job_id] = future
+        future.add_done_callback(lambda done: self._finished(job_id, done))
+        return status
+
+    def _finished(self, job_id: str, future: Future) -> None:
+        with self._lock:
+            self._futures.pop(job_id, None)
+            if future.cancelled():
+                state, error = "cancelled", "Cancelled before it started"
+            else:
+                # The scan process died (killed, out of memory) before cleaning up
+                exception = future.exception()
+                if exception is None:
+                    return
+                state, error = "failed", str(exception)
+                self._pool = None
+            status = read_status(job_id)
+            if status is not None and status["state"] in ACTIVE_STATES:
+                status.update(state=state, error=error, finished=time.time())
+                _write_status(status)
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Asks a scan to stop after its current batch
+
+        Returns:
+            Optional[dict]: The job status, None if there is no such job
+        """
+        status = read_status(job_id)
+        if status is None:
+            return None
+        if status["state"] in ACTIVE_STATES:
+            _cancel_path(job_id).touch()
+            status["cancel_requested"] = True
+        return status
+
+    def shutdown(self) -> None:
+        """
+        Cancels the scans of this worker and waits for them to stop
+        """
+        with self._lock:
+            for job_id in self._futures:
+                self.cancel(job_id)
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+scan_jobs = ScanJobs()
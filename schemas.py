@@ -1,6 +1,6 @@
-from typing import Literal, Optional, Union
+from typing import List, Literal, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class User(BaseModel):
@@ -15,6 +15,99 @@ class SearchResult(BaseModel):
     name: str
 
 
+class TrackListing(SearchResult):
+    album: Optional[str] = None
+    disc: Optional[int] = None
+    track_number: Optional[int] = None
+    year: Optional[int] = None
+
+
+class GenreFacet(SearchResult):
+    tracks: int
+
+
+class PlaylistRule(BaseModel):
+    """
+    One condition of a smart playlist, e.g. genre contains "metal" or year
+    between [1980, 1989]. Text fields take the text ops, numeric fields
+    (year, duration in seconds, plays, last_played as Unix time) the others.
+    """
+
+    field: Literal["name", "artist", "album", "genre", "year", "duration", "plays", "last_played"]
+    op: Literal["is", "is_not", "contains", "starts_with", "gt", "gte", "lt", "lte", "between"]
+    value: Union[int, float, str, List[Union[int, float]]]
+
+
+class SmartRules(BaseModel):
+    match: Literal["all", "any"] = "all"
+    rules: List[PlaylistRule] = Field(min_length=1, max_length=20)
+    order: Literal["album", "name", "year", "plays", "last_played"] = "album"
+    descending: bool = False
+    limit: Optional[int] = Field(default=None, ge=1)
+
+
+class PlaylistCreate(BaseModel):
+    name: str
+    tracks: Optional[List[str]] = None  # Static playlist in this order
+    rules: Optional[SmartRules] = None  # Smart playlist
+
+
+class PlaylistUpdate(BaseModel):
+    name: Optional[str] = None
+    tracks: Optional[List[str]] = None
+    rules: Optional[SmartRules] = None
+
+
+class Playlist(SearchResult):
+    smart: bool
+    tracks: int
+    rules: Optional[SmartRules] = None
+    updated: Optional[float] = None
+
+
+class PlaylistEntry(TrackListing):
+    position: int
+
+
+class PlaylistPage(BaseModel):
+    entries: List[PlaylistEntry]
+    next: Optional[int] = None  # Pass as `after` for the next page
+
+
+class ScanProgress(BaseModel):
+    stage: str
+    full: bool
+    total: Optional[int] = None
+    processed: int = 0
+    added: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    files_per_second: float = 0.0
+    removed: Optional[int] = None
+    indexed: Optional[int] = None
+
+
+class ScanJob(BaseModel):
+    id: str
+    full: bool = False
+    state: Literal["queued", "running", "finished", "cancelled", "failed"]
+    created: float
+    updated: Optional[float] = None
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    progress: Optional[ScanProgress] = None
+    error: Optional[str] = None
+    cancel_requested: bool = False
+
+
+class UserPrincipal(User):
+    """Verified identity of the caller, cached between requests."""
+
+    uuid: str
+    is_active: bool
+    is_superuser: bool
+
+
 class UserCreate(User):
     password: str
 
@@ -1,14 +1,59 @@
+import base64
+import binascii
+import hashlib
+import hmac
 import os
+import time
 from datetime import datetime, timedelta
+from typing import Optional, Tuple
 
 from fastapi import Depends, HTTPException
 from jose import JWTError, jwt
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
 
+from cache import TTLCache
 from db import User
+from metrics import register_cache
 from oauth2 import oauth2_scheme
-from utils import get_user, verify_password
+from schemas import UserPrincipal
+from utils import (
+    HasherBusyError,
+    get_password_hash_async,
+    get_user,
+    password_needs_rehash,
+    set_user_password_hash,
+    verify_password_async,
+)
 
-SECRET_KEY, ALGORITHM = os.getenv("SECRET_KEY", "secret_key"), "HS256"
+DEFAULT_SECRET_KEY = "secret_key"  # noqa: S105  # nosec B105
+SECRET_KEY, ALGORITHM = os.getenv("SECRET_KEY", DEFAULT_SECRET_KEY), "HS256"
+
+# Verified token -> UserPrincipal. Entries never outlive the token itself, and
+# the short TTL bounds how long another worker process may serve a stale user.
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "4096"))
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+register_cache("user", user_cache)
+
+# Signed stream URLs are checked with a single HMAC and no database access:
+# they carry the media root and root-relative path of the file, so a revoked
+# user keeps access to already minted URLs until they expire. They
+# are refused altogether while the secret is the built-in default, which
+# would let anyone sign their own.
+STREAM_URL_SECRET = os.getenv("STREAM_URL_SECRET", SECRET_KEY).encode()
+STREAM_URL_TTL = int(os.getenv("STREAM_URL_TTL", "1800"))
+
+# Static bearer token for the Prometheus scraper, without it /metrics is
+# only served to superusers
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+class StreamUrlError(RuntimeError):
+    """
+    Raised when stream URLs cannot be signed, see STREAM_URL_SECRET
+    """
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -22,16 +67,65 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-def authenticate_user(username: str, password: str):
-    user = get_user(username)
+def _hasher_busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Authentication service is busy, try again shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
+async def hash_password(password: str) -> str:
+    try:
+        return await get_password_hash_async(password)
+    except HasherBusyError as e:
+        raise _hasher_busy() from e
+
+
+async def authenticate_user(username: str, password: str):
+    # The database calls block, only the hashing has a pool of its own
+    user = await run_in_threadpool(get_user, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
-        return False
+    try:
+        if not await verify_password_async(password, user.hashed_password):
+            return False
+    except HasherBusyError as e:
+        raise _hasher_busy() from e
+
+    # Upgrade hashes made with older Argon2 parameters while we still have
+    # the plain password. Skipped, not failed, when the pool is saturated.
+    if password_needs_rehash(user.hashed_password):
+        try:
+            new_hash = await get_password_hash_async(password)
+        except HasherBusyError:
+            return user
+        await run_in_threadpool(set_user_password_hash, user.uuid, new_hash)
     return user
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def invalidate_user(uuid: str) -> None:
+    """
+    Drops every cached principal of a user, forcing the next request to reload it
+
+    Args:
+        uuid (str): The UUID of the user that changed
+    """
+    user_cache.discard_where(lambda principal: principal.uuid == uuid)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _user_changed(mapper, connection, target: User) -> None:
+    if target.uuid is not None:
+        invalidate_user(target.uuid)
+
+
+def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPrincipal:
+    cached = user_cache.get(token)
+    if cached is not None:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -39,25 +133,121 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = str(payload.get("sub"))
+        username = payload.get("sub")
         if username is None:
             raise credentials_exception
-        token_data = username
+        token_data = str(username)
     except JWTError as e:
         raise credentials_exception from e
     user = get_user(username=token_data)
     if user is None:
         raise credentials_exception
-    return user
+
+    principal = UserPrincipal(
+        name=user.name,
+        uuid=user.uuid,
+        is_active=bool(user.is_active),
+        is_superuser=bool(user.is_superuser),
+    )
+    expires_at = payload.get("exp")
+    user_cache.set(
+        token, principal, ttl=expires_at - time.time() if expires_at else None
+    )
+    return principal
 
 
-def get_current_active_user(current_user: User = Depends(get_current_user)):
+def get_current_active_user(
+    current_user: UserPrincipal = Depends(get_current_user),
+):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
 
-def get_current_active_superuser(current_user: User = Depends(get_current_active_user)):
+def get_current_active_superuser(
+    current_user: UserPrincipal = Depends(get_current_active_user),
+):
     if not current_user.is_superuser:
         raise HTTPException(status_code=400, detail="Not a superuser")
     return current_user
+
+
+def require_metrics_access(token: str = Depends(oauth2_scheme)) -> None:
+    """
+    Admits METRICS_TOKEN as a bearer token, or an active superuser's token
+    """
+    if METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    get_current_active_superuser(get_current_active_user(get_current_user(token)))
+
+
+def stream_urls_enabled() -> bool:
+    return DEFAULT_SECRET_KEY.encode() != STREAM_URL_SECRET
+
+
+def _stream_signature(song_id: str, key: str, exp: int, user: str) -> str:
+    message = f"{song_id}:{key}:{exp}:{user}".encode()
+    return hmac.new(STREAM_URL_SECRET, message, hashlib.sha256).hexdigest()
+
+
+def _stream_key(root: Optional[str], path: str) -> str:
+    raw = f"{root or ''}\0{path}".encode("utf-8", "surrogateescape")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _stream_location(key: str) -> Optional[Tuple[Optional[str], str]]:
+    try:
+        raw = base64.urlsafe_b64decode(key + "=" * (-len(key) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    root, separator, path = raw.decode("utf-8", "surrogateescape").partition("\0")
+    if not separator:
+        return None
+    return root or None, path
+
+
+def sign_stream_url(song_id: str, root: Optional[str], path: str, user: str) -> dict:
+    """
+    Creates the query parameters of a signed, short-lived stream URL
+
+    Args:
+        song_id (str): The UUID of the track
+        root (str, optional): The media root of its audio file
+        path (str): The path of the audio file relative to that root, only
+            resolved against the root's location when the URL is used
+        user (str): The UUID of the user the URL is minted for
+
+    Returns:
+        dict: The key, exp, user and sig query parameters
+
+    Raises:
+        StreamUrlError: If the secret is still the built-in default
+    """
+    if not stream_urls_enabled():
+        raise StreamUrlError("Set STREAM_URL_SECRET or SECRET_KEY to sign stream URLs")
+    key = _stream_key(root, path)
+    exp = int(time.time()) + STREAM_URL_TTL
+    return {
+        "key": key,
+        "exp": exp,
+        "user": user,
+        "sig": _stream_signature(song_id, key, exp, user),
+    }
+
+
+def verify_stream_url(
+    song_id: str, key: str, exp: int, user: str, sig: str
+) -> Optional[Tuple[Optional[str], str]]:
+    """
+    Checks a signed stream URL
+
+    Returns:
+        Optional[Tuple[Optional[str], str]]: The media root and relative path
+        of the file it grants access to, None if it is expired, the signature
+        does not match or the secret is the built-in default
+    """
+    if exp < time.time() or not stream_urls_enabled():
+        return None
+    if not hmac.compare_digest(_stream_signature(song_id, key, exp, user), sig):
+        return None
+    return _stream_location(key)
@@ -0,0 +1,351 @@
+"""
+"More like this" track recommendations from a precomputed feature matrix.
+
+The builder encodes every track into a fixed-length vector: genre, artist,
+album and year tokens plus duration and loudness buckets, feature-hashed
+into SIMILAR_DIM slots and L2-normalized, so cosine similarity is a dot
+product. The matrix is written as a raw float32 file that the API memory
+maps, a query is one matrix-vector product and a partial sort.
+
+Libraries larger than SIMILAR_CLUSTER_MIN tracks also get a coarse k-means
+index: rows are stored grouped by cluster and a query only scores the
+SIMILAR_NPROBE clusters closest to the track.
+
+The index lives in SIMILAR_INDEX_PATH, by default a similar_index directory
+next to the SQLite database (or next to this module for other databases),
+so the builder and the API find it whatever their working directory.
+NumPy is a dependency, an install without it skips this stage in the
+builder and the endpoint answers 503.
+"""
+
+import contextlib
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.engine import make_url
+
+import changelog
+import db
+from config import get_settings
+from suggest import fold
+
+# NumPy is optional and slow to import, available() loads it
+np: Any = None
+_numpy_checked = False
+
+SIMILAR_INDEX_PATH = os.getenv("SIMILAR_INDEX_PATH")  # See index_path()
+SIMILAR_DIM = int(os.getenv("SIMILAR_DIM", "128"))
+SIMILAR_CLUSTER_MIN = int(os.getenv("SIMILAR_CLUSTER_MIN", "50000"))
+SIMILAR_NPROBE = int(os.getenv("SIMILAR_NPROBE", "8"))
+SIMILAR_REFRESH_SECONDS = float(os.getenv("SIMILAR_REFRESH_SECONDS", "30"))
+MAX_LIMIT = 100
+MANIFEST = "index.json"
+
+# Token weights, the artist dominates and the coarser tokens break ties
+WEIGHTS = {
+    "genre": 1.0,
+    "genre_word": 0.5,
+    "artist": 1.5,
+    "album": 0.75,
+    "decade": 0.5,
+    "year": 0.25,
+    "duration": 0.3,
+    "loudness": 0.3,
+}
+
+
+def available() -> bool:
+    """
+    Whether NumPy is installed, importing it on the first call
+    """
+    global np, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+
+            np = numpy
+        except ImportError:  # pragma: no cover - depends on the environment
+            np = None
+        _numpy_checked = True
+    return np is not None
+
+
+def tokens(
+    genre: Optional[str],
+    artist: Optional[str],
+    album: Optional[str],
+    year: Optional[int],
+    duration: Optional[float],
+    loudness: Optional[float],
+) -> List[Tuple[str, float]]:
+    """
+    Returns the weighted tokens describing a track
+    """
+    result = []
+    if genre:
+        folded = " ".join(fold(genre).split())
+        result.append((f"genre:{folded}", WEIGHTS["genre"]))
+        words = folded.replace("/", " ").replace("-", " ").split()
+        if len(words) > 1:
+            result.extend((f"genre_word:{word}", WEIGHTS["genre_word"]) for word in words)
+    if artist:
+        result.append((f"artist:{artist}", WEIGHTS["artist"]))
+    if album:
+        result.append((f"album:{album}", WEIGHTS["album"]))
+    if year:
+        result.append((f"decade:{year // 10}", WEIGHTS["decade"]))
+        result.append((f"year:{year}", WEIGHTS["year"]))
+    if duration and duration > 0:
+        # Half-octave buckets: 2:00 and 2:40 share one, 2:00 and 8:00 do not
+        result.append((f"duration:{round(math.log2(duration) * 2)}", WEIGHTS["duration"]))
+    if loudness is not None:
+        result.append((f"loudness:{round(loudness / 3)}", WEIGHTS["loudness"]))
+    return result
+
+
+class Encoder:
+    """
+    Feature-hashes tokens into `dim` slots with a sign bit, so colliding
+    tokens cancel out on average instead of adding up
+    """
+
+    def __init__(self, dim: int = SIMILAR_DIM):
+        self.dim = dim
+        self._slots: Dict[str, Tuple[int, float]] = {}
+
+    def slot(self, token: str) -> Tuple[int, float]:
+        slot = self._slots.get(token)
+        if slot is None:
+            value = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "big")
+            slot = (value % self.dim, 1.0 if value >> 63 else -1.0)
+            self._slots[token] = slot
+        return slot
+
+    def encode(self, rows: Iterable[List[Tuple[str, float]]]) -> "np.ndarray":
+        columns: List[int] = []
+        values: List[float] = []
+        offsets = [0]
+        for row in rows:
+            for token, weight in row:
+                column, sign = self.slot(token)
+                columns.append(column)
+                values.append(sign * weight)
+            offsets.append(len(columns))
+        count = len(offsets) - 1
+        matrix = np.zeros((count, self.dim), dtype=np.float32)
+        row_index = np.repeat(np.arange(count), np.diff(offsets))
+        np.add.at(matrix, (row_index, np.asarray(columns, dtype=np.int64)), values)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+def load_tracks(session) -> Tuple[List[str], List[List[Tuple[str, float]]]]:
+    """
+    Reads the tokens of every track that is not a duplicate
+    """
+    query = (
+        session.query(
+            db.Track.uuid,
+            db.Track.genre,
+            db.Track.artist,
+            db.Track.album,
+            db.Track.year,
+            db.Audio.duration,
+            db.Audio.loudness,
+        )
+        .outerjoin(db.Audio, db.Audio.uuid == db.Track.audio)
+        .filter(db.Audio.canonical.is_(None))
+        .order_by(db.Track.uuid)
+    )
+    uuids = []
+    rows = []
+    for track_uuid, *features in query:
+        uuids.append(track_uuid)
+        rows.append(tokens(*features))
+    return uuids, rows
+
+
+def kmeans(
+    matrix: "np.ndarray", clusters: int, iterations: int = 10, seed: int = 0
+) -> Tuple["np.ndarray", "np.ndarray"]:
+    """
+    Spherical k-means on a row-normalized matrix
+
+    Returns:
+        Tuple[ndarray, ndarray]: Centroids and the cluster of every row
+    """
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), clusters, replace=False)].copy()
+    assignment = np.zeros(len(matrix), dtype=np.int32)
+    for _ in range(iterations):
+        for start in range(0, len(matrix), 65536):
+            block = matrix[start : start + 65536]
+            assignment[start : start + 65536] = np.argmax(block @ centroids.T, axis=1)
+        for cluster in range(clusters):
+            members = matrix[assignment == cluster]
+            if len(members):
+                centroid = members.sum(axis=0)
+                norm = np.linalg.norm(centroid)
+                centroids[cluster] = centroid / norm if norm > 0 else centroid
+    return centroids, assignment
+
+
+def index_path() -> Path:
+    """
+    Where the index is kept, see the module docstring
+    """
+    if SIMILAR_INDEX_PATH:
+        return Path(SIMILAR_INDEX_PATH)
+    url = make_url(get_settings().database_url)
+    if url.get_backend_name() == "sqlite" and url.database and url.database != ":memory:":
+        return Path(url.database).resolve().parent / "similar_index"
+    return Path(__file__).resolve().parent / "similar_index"
+
+
+def build_index(session, path: Optional[Path] = None, dim: int = SIMILAR_DIM) -> int:
+    """
+    Encodes every track and writes the index to `path` (index_path() by
+    default). The manifest is replaced last, so readers never see a half
+    written index.
+
+    Returns:
+        int: Number of tracks in the index
+    """
+    if not available():
+        raise RuntimeError("NumPy is required to build the similarity index")
+    path = path or index_path()
+    generation = changelog.current_seq(session)
+    uuids, rows = load_tracks(session)
+    matrix = Encoder(dim).encode(rows)
+
+    offsets = None
+    if len(uuids) >= SIMILAR_CLUSTER_MIN:
+        clusters = max(int(math.sqrt(len(uuids))), 1)
+        centroids, assignment = kmeans(matrix, clusters)
+        order = np.argsort(assignment, kind="stable")
+        matrix = matrix[order]
+        uuids = [uuids[i] for i in order]
+        offsets = np.searchsorted(assignment[order], np.arange(clusters + 1)).tolist()
+
+    path.mkdir(parents=True, exist_ok=True)
+    name = f"vectors-{generation}-{int(time.time())}"
+    matrix.tofile(path / f"{name}.f32")
+    with open(path / f"{name}.ids.json", "w") as f:
+        json.dump(uuids, f)
+    if offsets is not None:
+        centroids.astype(np.float32).tofile(path / f"{name}.centroids.f32")
+
+    manifest = {
+        "generation": generation,
+        "dim": dim,
+        "count": len(uuids),
+        "name": name,
+        "cluster_offsets": offsets,
+    }
+    temporary = path / f"{MANIFEST}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temporary, path / MANIFEST)
+
+    for stale in path.glob("vectors-*"):
+        if not stale.name.startswith(f"{name}."):
+            # Fails while still mapped by a reader on platforms that forbid it
+            with contextlib.suppress(OSError):
+                stale.unlink()
+    return len(uuids)
+
+
+class SimilarIndex:
+    def __init__(self, path: Path, manifest: Dict[str, Any]):
+        self.generation = manifest["generation"]
+        self.dim = manifest["dim"]
+        name = manifest["name"]
+        count = manifest["count"]
+        self.vectors = (
+            np.memmap(path / f"{name}.f32", dtype=np.float32, mode="r", shape=(count, self.dim))
+            if count
+            else np.zeros((0, self.dim), dtype=np.float32)
+        )
+        with open(path / f"{name}.ids.json") as f:
+            self.uuids: List[str] = json.load(f)
+        self.rows = {track_uuid: row for row, track_uuid in enumerate(self.uuids)}
+        self.offsets: Optional[List[int]] = manifest.get("cluster_offsets")
+        self.centroids = None
+        if self.offsets is not None:
+            self.centroids = np.fromfile(
+                path / f"{name}.centroids.f32", dtype=np.float32
+            ).reshape(-1, self.dim)
+
+    def _candidates(self, vector: "np.ndarray", nprobe: int) -> List[Tuple[int, int]]:
+        if self.centroids is None or self.offsets is None:
+            return [(0, len(self.uuids))]
+        closest = np.argsort(self.centroids @ vector)[::-1][:nprobe]
+        return [(self.offsets[c], self.offsets[c + 1]) for c in sorted(closest)]
+
+    def search(
+        self, track_uuid: str, limit: int = 10, nprobe: int = SIMILAR_NPROBE
+    ) -> Optional[List[Tuple[str, float]]]:
+        """
+        Returns the `limit` most similar tracks with their cosine similarity,
+        None if the track is not in the index
+        """
+        row = self.rows.get(track_uuid)
+        if row is None:
+            return None
+        vector = np.asarray(self.vectors[row])
+        ranges = self._candidates(vector, nprobe)
+        scores = np.concatenate([self.vectors[lo:hi] @ vector for lo, hi in ranges])
+        positions = np.concatenate([np.arange(lo, hi) for lo, hi in ranges])
+        keep = positions != row
+        scores, positions = scores[keep], positions[keep]
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.uuids[positions[i]], float(scores[i])) for i in top]
+
+
+class SimilarService:
+    """
+    Holds the memory-mapped index and reloads it when the builder writes a
+    new manifest. Checks are throttled to one every SIMILAR_REFRESH_SECONDS.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self._path = path
+        self.index: Optional[SimilarIndex] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[SimilarIndex]:
+        if not available():
+            return None
+        now = time.monotonic()
+        if self.index is not None and now - self._checked_at < SIMILAR_REFRESH_SECONDS:
+            return self.index
+        with self._lock:
+            self._checked_at = now
+            if self._path is None:
+                self._path = index_path()
+            try:
+                mtime = (self._path / MANIFEST).stat().st_mtime
+            except OSError:
+                return self.index
+            if mtime != self._mtime:
+                with open(self._path / MANIFEST) as f:
+                    manifest = json.load(f)
+                self.index = SimilarIndex(self._path, manifest)
+                self._mtime = mtime
+            return self.index
+
+
+similar_tracks = SimilarService()
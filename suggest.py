@@ -0,0 +1,175 @@
+"""
+In-memory typeahead index over track, artist and album names.
+
+Names are case- and diacritic-folded and every word start becomes a key in
+one sorted array, so a prefix lookup is two bisects. The top results of
+prefixes matching many keys are precomputed. The index is immutable: when
+the library generation (the newest change log seq) moves, a new one is
+built in the background and swapped in.
+"""
+
+import heapq
+import os
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+
+import changelog
+import db
+
+SUGGEST_REFRESH_SECONDS = float(os.getenv("SUGGEST_REFRESH_SECONDS", "30"))
+# Play counts change without moving the generation, rebuild this often anyway
+SUGGEST_REBUILD_SECONDS = float(os.getenv("SUGGEST_REBUILD_SECONDS", "3600"))
+SCAN_LIMIT = 256  # Largest key range searched at query time
+MAX_LIMIT = 50
+
+# (type, uuid, name, popularity)
+Item = Tuple[str, str, str, float]
+
+
+def fold(text: str) -> str:
+    """
+    Lowercases and strips diacritics, "Motörhead" -> "motorhead"
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+class SuggestIndex:
+    def __init__(self, items: List[Item], generation: int = 0):
+        self.items = items
+        self.generation = generation
+        self.built_at = time.monotonic()
+        # Rank of each item, lower is better: most popular, then shortest name
+        order = sorted(range(len(items)), key=lambda i: (-items[i][3], len(items[i][2])))
+        self.rank = [0] * len(items)
+        for position, index in enumerate(order):
+            self.rank[index] = position
+
+        pairs = []
+        for index, (_, _, name, _) in enumerate(items):
+            words = fold(name).split()
+            for start in range(len(words)):
+                pairs.append((" ".join(words[start:]), index))
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.refs = [ref for _, ref in pairs]
+
+        # Every prefix matching more than SCAN_LIMIT keys gets its top results
+        # precomputed, so no lookup scans more than SCAN_LIMIT entries. Such
+        # prefixes are found by splitting the sorted keys one character at a
+        # time, only descending into ranges that are still too large.
+        self.top: Dict[str, List[int]] = {}
+        stack = [(0, len(self.keys), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= SCAN_LIMIT:
+                continue
+            if depth:
+                self.top[self.keys[lo][:depth]] = self._best(lo, hi, MAX_LIMIT)
+            position = lo
+            while position < hi and len(self.keys[position]) == depth:
+                position += 1
+            while position < hi:
+                child = self.keys[position][: depth + 1]
+                end = bisect_left(self.keys, child + "\U0010ffff", position, hi)
+                stack.append((position, end, depth + 1))
+                position = end
+
+    def _best(self, lo: int, hi: int, limit: int) -> List[int]:
+        return heapq.nsmallest(limit, set(self.refs[lo:hi]), key=self.rank.__getitem__)
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        prefix = " ".join(fold(query).split())
+        if not prefix:
+            return []
+        refs = self.top.get(prefix)
+        if refs is None:
+            lo = bisect_left(self.keys, prefix)
+            hi = bisect_left(self.keys, prefix + "\U0010ffff", lo)
+            refs = self._best(lo, hi, limit)
+        return [
+            {"type": kind, "uuid": uuid, "name": name}
+            for kind, uuid, name, _ in (self.items[ref] for ref in refs[:limit])
+        ]
+
+
+def load_items(session) -> List[Item]:
+    """
+    Reads every artist, album and track with its popularity: plays for
+    tracks, track count plus plays of their tracks for artists and albums
+    """
+    items: List[Item] = []
+    plays = func.coalesce(db.PlayCount.plays, 0)
+    artist_popularity = dict(
+        session.query(db.Track.artist, func.count(db.Track.uuid) + func.sum(plays))
+        .outerjoin(db.PlayCount, db.PlayCount.track == db.Track.uuid)
+        .group_by(db.Track.artist)
+    )
+    album_popularity = dict(
+        session.query(db.Track.album, func.count(db.Track.uuid) + func.sum(plays))
+        .outerjoin(db.PlayCount, db.PlayCount.track == db.Track.uuid)
+        .group_by(db.Track.album)
+    )
+    for uuid, name in session.query(db.Artist.uuid, db.Artist.name):
+        if name:
+            items.append(("artist", uuid, name, artist_popularity.get(uuid, 0)))
+    for uuid, name in session.query(db.Album.uuid, db.Album.name):
+        if name:
+            items.append(("album", uuid, name, album_popularity.get(uuid, 0)))
+    tracks = (
+        session.query(db.Track.uuid, db.Track.name, plays)
+        .outerjoin(db.Audio, db.Audio.uuid == db.Track.audio)
+        .outerjoin(db.PlayCount, db.PlayCount.track == db.Track.uuid)
+        .filter(db.Audio.canonical.is_(None))
+    )
+    for uuid, name, track_plays in tracks:
+        if name:
+            items.append(("track", uuid, name, track_plays))
+    return items
+
+
+class SuggestService:
+    """
+    Holds the current index and swaps in a rebuilt one when the library
+    generation changes, or at least every SUGGEST_REBUILD_SECONDS to pick up
+    play counts. Checks are throttled to one every SUGGEST_REFRESH_SECONDS
+    and never block a request.
+    """
+
+    def __init__(self, refresh_seconds: float = SUGGEST_REFRESH_SECONDS):
+        self.index: Optional[SuggestIndex] = None
+        self.refresh_seconds = refresh_seconds
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> SuggestIndex:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            with db.ReadSession() as session:
+                generation = changelog.current_seq(session)
+                if (
+                    not force
+                    and self.index is not None
+                    and self.index.generation == generation
+                    and time.monotonic() - self.index.built_at < SUGGEST_REBUILD_SECONDS
+                ):
+                    return self.index
+                items = load_items(session)
+            self.index = SuggestIndex(items, generation)
+            return self.index
+
+    def refresh_if_stale(self) -> None:
+        if time.monotonic() - self._checked_at < self.refresh_seconds:
+            return
+        if self._lock.locked():
+            return
+        self._checked_at = time.monotonic()
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+
+suggestions = SuggestService()
@@ -0,0 +1,292 @@
+"""
+Header-only tag reader for the common MP3 (ID3v2.3/2.4) and FLAC (Vorbis
+comment) layouts.
+
+mutagen builds full file objects and scans audio frames for stream info.
+For the library builder only the tags and the stream header matter, and
+both sit at the start of the file: this reader gets them with one read of
+HEAD_SIZE bytes. Frames and blocks past that are read one by one, and the
+ones it does not need (cover art above all) are skipped by their size
+rather than read. Anything it does not fully understand (ID3v2.2, MP3s
+without an ID3v2 tag or whose ID3v2 tag has no title, artist or album,
+since mutagen also reads ID3v1, unsynchronised or compressed frames, FLAC
+files with an ID3 prefix, other containers) makes it return None, and the
+caller falls back to mutagen.
+"""
+
+import os
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+
+HEAD_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 1024 * 1024  # Larger text frames or comment blocks go through mutagen
+
+EXTENSIONS = {".mp3", ".flac"}
+
+# ID3 frame -> TagRecord field, TYER is the ID3v2.3 year frame
+ID3_FRAMES = {
+    "TIT2": "title",
+    "TPE1": "artist",
+    "TALB": "album",
+    "TCON": "genre",
+    "TRCK": "track_number",
+    "TPOS": "disc",
+    "TDRC": "year",
+    "TYER": "year",
+}
+VORBIS_FIELDS = {
+    "TITLE": "title",
+    "ARTIST": "artist",
+    "ALBUM": "album",
+    "GENRE": "genre",
+    "TRACKNUMBER": "track_number",
+    "DISCNUMBER": "disc",
+    "DATE": "year",
+}
+TEXT_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+# MPEG Layer III bitrates in kbps, by [MPEG-1?][index]
+MP3_BITRATES = (
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+)
+MP3_SAMPLE_RATES = (44100, 48000, 32000)
+
+
+class TagRecord:
+    __slots__ = (
+        "title",
+        "artist",
+        "album",
+        "genre",
+        "track_number",
+        "disc",
+        "year",
+        "duration",
+        "loudness",
+    )
+
+    def __init__(self):
+        self.title: Optional[str] = None
+        self.artist: Optional[str] = None
+        self.album: Optional[str] = None
+        self.genre: Optional[str] = None
+        self.track_number: Optional[str] = None
+        self.disc: Optional[str] = None
+        self.year: Optional[str] = None
+        self.duration: Optional[float] = None
+        self.loudness: Optional[str] = None  # Raw ReplayGain track gain
+
+
+class FileHead:
+    """
+    The first HEAD_SIZE bytes of an open file, and reads of the ranges past
+    them. The builder shares one between this reader and the fingerprint.
+    """
+
+    def __init__(self, f: BinaryIO, size: int):
+        self.f = f
+        self.size = size
+        self.data = f.read(HEAD_SIZE)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Up to `length` bytes at `offset`, fewer at the end of the file
+        """
+        end = min(offset + length, self.size)
+        cached = len(self.data)
+        if end <= cached:
+            return self.data[offset:end]
+        if offset < cached:
+            self.f.seek(cached)
+            return self.data[offset:] + self.f.read(end - cached)
+        self.f.seek(offset)
+        return self.f.read(max(end - offset, 0))
+
+
+def _synchsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _decode_text(payload: bytes) -> Optional[str]:
+    if not payload or payload[0] >= len(TEXT_ENCODINGS):
+        return None
+    encoding = TEXT_ENCODINGS[payload[0]]
+    text = payload[1:].decode(encoding, errors="replace")
+    # UTF-16 repeats the byte order mark on every value
+    values = [value.lstrip("\ufeff") for value in text.split("\x00")]
+    values = [value for value in values if value]
+    return "\x00".join(values) if values else None
+
+
+def _mp3_duration(head: FileHead, offset: int) -> Optional[float]:
+    data = head.read(offset, 4096 + 64)
+    end = min(len(data) - 4, 4096)
+    position = data.find(b"\xff", 0, end)
+    while 0 <= position < end:
+        b1, b2, b3 = data[position + 1], data[position + 2], data[position + 3]
+        version = (b1 >> 3) & 3
+        layer = (b1 >> 1) & 3
+        bitrate_index = b2 >> 4
+        rate_index = (b2 >> 2) & 3
+        if (
+            b1 & 0xE0 == 0xE0
+            and version != 1
+            and layer == 1  # Layer III
+            and 0 < bitrate_index < 15
+            and rate_index < 3
+        ):
+            mpeg1 = version == 3
+            sample_rate = MP3_SAMPLE_RATES[rate_index] >> (0 if mpeg1 else 1 if version == 2 else 2)
+            samples_per_frame = 1152 if mpeg1 else 576
+            mono = (b3 >> 6) == 3
+            side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+            xing = position + 4 + side_info
+            if data[xing : xing + 4] in (b"Xing", b"Info"):
+                flags = int.from_bytes(data[xing + 4 : xing + 8], "big")
+                if flags & 1 and len(data) >= xing + 12:
+                    frames = int.from_bytes(data[xing + 8 : xing + 12], "big")
+                    return frames * samples_per_frame / sample_rate
+            vbri = position + 36
+            if data[vbri : vbri + 4] == b"VBRI" and len(data) >= vbri + 18:
+                frames = int.from_bytes(data[vbri + 14 : vbri + 18], "big")
+                return frames * samples_per_frame / sample_rate
+            bitrate = MP3_BITRATES[mpeg1][bitrate_index] * 1000
+            return (head.size - offset - position) * 8 / bitrate
+        position = data.find(b"\xff", position + 1, end)
+    return None
+
+
+def _read_id3(head: FileHead) -> Optional[TagRecord]:
+    data = head.data
+    if data[:3] != b"ID3":
+        return None
+    major, flags = data[3], data[5]
+    if major not in (3, 4) or flags & 0x80:  # Whole-tag unsynchronisation
+        return None
+    record = TagRecord()
+    tag_end = 10 + _synchsafe(data[6:10])
+    audio_start = tag_end + (10 if flags & 0x10 else 0)  # v2.4 footer
+
+    position = 10
+    if flags & 0x40:  # Extended header
+        size = int.from_bytes(data[10:14], "big")
+        position += _synchsafe(data[10:14]) if major == 4 else size + 4
+
+    while position + 10 <= tag_end:
+        header = head.read(position, 10)
+        if len(header) < 10:
+            return None
+        frame_id = header[:4]
+        if frame_id[0] == 0:  # Padding
+            break
+        size_bytes = header[4:8]
+        size = _synchsafe(size_bytes) if major == 4 else int.from_bytes(size_bytes, "big")
+        frame_flags = int.from_bytes(header[8:10], "big")
+        start = position + 10
+        position = start + size
+        name = frame_id.decode("latin-1")
+        if name not in ID3_FRAMES and name != "TXXX":
+            continue  # Pictures and the like are never read
+        # Compressed, encrypted, grouped or unsynchronised frames
+        if frame_flags & (0x00E0 if major == 3 else 0x004F) or size > MAX_FRAME_SIZE:
+            return None
+        payload = head.read(start, size)
+        if name == "TXXX":
+            text = _decode_text(payload)
+            if text and "\x00" in text:
+                description, _, value = text.partition("\x00")
+                if description.upper() == "REPLAYGAIN_TRACK_GAIN":
+                    record.loudness = value
+            continue
+        field = ID3_FRAMES[name]
+        if getattr(record, field) is None:
+            setattr(record, field, _decode_text(payload))
+
+    if record.title is None and record.artist is None and record.album is None:
+        return None  # Probably tagged in ID3v1 only, which mutagen merges in
+    record.duration = _mp3_duration(head, audio_start)
+    return record
+
+
+def _read_flac(head: FileHead) -> Optional[TagRecord]:
+    if head.data[:4] != b"fLaC":
+        return None
+    record = TagRecord()
+    comments: Dict[str, List[str]] = {}
+    position = 4
+    while True:
+        header = head.read(position, 4)
+        if len(header) < 4:
+            return None
+        last, block_type = header[0] & 0x80, header[0] & 0x7F
+        length = int.from_bytes(header[1:4], "big")
+        start = position + 4
+        position = start + length
+        if block_type in (0, 4):  # Pictures and padding are skipped
+            if length > MAX_FRAME_SIZE:
+                return None
+            block = head.read(start, length)
+            if len(block) < length:
+                return None
+            if block_type == 0:
+                packed = int.from_bytes(block[10:18], "big")
+                sample_rate = packed >> 44
+                total_samples = packed & 0xFFFFFFFFF
+                if sample_rate:
+                    record.duration = total_samples / sample_rate
+            else:
+                _vorbis_comments(block, comments)
+        if last or (record.duration is not None and comments):
+            break
+
+    for key, field in VORBIS_FIELDS.items():
+        values = comments.get(key)
+        if values:
+            setattr(record, field, values[0])
+    gain = comments.get("REPLAYGAIN_TRACK_GAIN")
+    record.loudness = gain[0] if gain else None
+    return record
+
+
+def _vorbis_comments(block: bytes, comments: Dict[str, List[str]]) -> None:
+    vendor_length = int.from_bytes(block[0:4], "little")
+    position = 4 + vendor_length
+    count = int.from_bytes(block[position : position + 4], "little")
+    position += 4
+    for _ in range(count):
+        length = int.from_bytes(block[position : position + 4], "little")
+        entry = block[position + 4 : position + 4 + length].decode("utf-8", errors="replace")
+        position += 4 + length
+        key, separator, value = entry.partition("=")
+        if separator:
+            comments.setdefault(key.upper(), []).append(value)
+
+
+def read_tags(
+    path: Path, size: Optional[int] = None, head: Optional[FileHead] = None
+) -> Optional[TagRecord]:
+    """
+    Reads tags and duration from the head of an MP3 or FLAC file
+
+    Args:
+        path (Path): The file to read
+        size (int, optional): Its size, stat'ed here if omitted
+        head (FileHead, optional): The file, already open and read
+
+    Returns:
+        Optional[TagRecord]: The tags, None if mutagen has to handle the file
+    """
+    suffix = path.suffix.lower()
+    if suffix not in EXTENSIONS:
+        return None
+    read = _read_flac if suffix == ".flac" else _read_id3
+    try:
+        if head is not None:
+            return read(head)
+        with open(path, "rb") as f:
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            return read(FileHead(f, size))
+    except (OSError, ValueError, IndexError):
+        return None
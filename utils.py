@@ -1,19 +1,136 @@
-from argon2 import PasswordHasher
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable
 
-from db import SessionLocal, User
+from db import ReadSession, SessionLocal, User
+from metrics import CallbackMetric
 
-hasher = PasswordHasher()
+if TYPE_CHECKING:
+    from argon2 import PasswordHasher
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))  # Threads reserved for hashing
+HASH_QUEUE_LIMIT = int(
+    os.getenv("HASH_QUEUE_LIMIT", str(HASH_WORKERS * 4))
+)  # Running + waiting hash jobs before new ones are rejected
+
+
+@lru_cache(maxsize=1)
+def get_hasher() -> "PasswordHasher":
+    """
+    The argon2 hasher, imported on first use. Changing the cost parameters
+    makes existing hashes get rehashed on the next successful login.
+    """
+    import argon2
+
+    return argon2.PasswordHasher(
+        time_cost=int(os.getenv("ARGON2_TIME_COST", str(argon2.DEFAULT_TIME_COST))),
+        memory_cost=int(
+            os.getenv("ARGON2_MEMORY_COST", str(argon2.DEFAULT_MEMORY_COST))
+        ),  # KiB
+        parallelism=int(
+            os.getenv("ARGON2_PARALLELISM", str(argon2.DEFAULT_PARALLELISM))
+        ),
+    )
+
+
+# argon2-cffi releases the GIL while hashing, so a small dedicated pool keeps
+# the cost off the event loop and away from the default threadpool used by
+# sync dependencies.
+hash_executor = ThreadPoolExecutor(
+    max_workers=HASH_WORKERS, thread_name_prefix="argon2"
+)
+_hash_jobs = 0
+
+
+CallbackMetric(
+    "heavymetal_hash_queue_depth",
+    "Password hash jobs running or waiting for the hash pool",
+    lambda: [((), _hash_jobs)],
+)
+CallbackMetric(
+    "heavymetal_hash_queue_limit",
+    "Hash jobs accepted before new logins are rejected",
+    lambda: [((), HASH_QUEUE_LIMIT)],
+)
+
+
+class HasherBusyError(Exception):
+    """Raised when the hashing pool already has HASH_QUEUE_LIMIT jobs queued."""
 
 
 def get_user(username: str):
-    db = SessionLocal()
-    user = db.query(User).filter(User.name == username).first()
+    # The session is closed before returning, the user comes back detached
+    # with its columns already loaded.
+    with ReadSession() as db:
+        user = db.query(User).filter(User.name == username).first()
     return user
 
 
+def set_user_password_hash(uuid: str, hashed_password: str) -> None:
+    # Through the ORM, not a bulk update, so the after_update hook in
+    # security drops the cached principals of the user
+    with SessionLocal() as db:
+        user = db.get(User, uuid)
+        if user is not None:
+            user.hashed_password = hashed_password
+            db.commit()
+
+
+def create_user(username: str, hashed_password: str) -> None:
+    with SessionLocal() as db:
+        db.add(User(name=username, hashed_password=hashed_password))
+        db.commit()
+
+
 def verify_password(plain_password, hashed_password):
-    return hasher.verify(hashed_password, plain_password)
+    from argon2.exceptions import InvalidHashError, VerificationError
+
+    try:
+        return get_hasher().verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 
 def get_password_hash(password):
-    return hasher.hash(password)
+    return get_hasher().hash(password)
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    from argon2.exceptions import InvalidHashError
+
+    try:
+        return get_hasher().check_needs_rehash(hashed_password)
+    except InvalidHashError:
+        return True
+
+
+def hash_queue_depth() -> int:
+    return _hash_jobs
+
+
+async def run_in_hasher(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs a hashing function on the bounded hash pool
+
+    Raises:
+        HasherBusyError: If the pool is saturated, so callers can shed load
+    """
+    global _hash_jobs
+    if _hash_jobs >= HASH_QUEUE_LIMIT:
+        raise HasherBusyError()
+    _hash_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(hash_executor, func, *args)
+    finally:
+        _hash_jobs -= 1
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await run_in_hasher(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password) -> str:
+    return await run_in_hasher(get_password_hash, password)